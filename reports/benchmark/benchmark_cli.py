@@ -0,0 +1,148 @@
+import click
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+sys.path.append(r'C:\Users\borja\PycharmProjects\osoigo_ia')
+
+from reports.benchmark.dataset_generator import SCALES, generate_dataset
+from reports.monthly_reports.controllers import report_controller as monthly_report
+from reports.lead_report.controllers import lead_report_controller as lead_report
+from reports.utils.profiler import profiler
+
+
+@click.command()
+@click.option('--scale',
+              default='100k',
+              required=False,
+              type=click.Choice(choices=list(SCALES.keys())),
+              help='number of users of the synthetic database')
+@click.option('--deliveries-mean',
+              default=1.5,
+              required=False,
+              type=click.FloatRange(min=0),
+              help='mean number of deliveries per user of the synthetic database')
+@click.option('--database',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='SQLite file of the synthetic database. It is generated if it does not exist')
+@click.option('--generate',
+              is_flag=True,
+              default=False,
+              help='generate the synthetic database even if the file already exists')
+@click.option('--report', '-r',
+              default='all',
+              required=False,
+              type=click.Choice(choices=['monthly', 'lead', 'all']),
+              help='report to benchmark')
+@click.option('--start', '-s',
+              default=None,
+              required=False,
+              type=click.DateTime(),
+              help='start date (yyyy-mm-dd format) of the monthly report (Included)')
+@click.option('--end', '-e',
+              default=None,
+              required=False,
+              type=click.DateTime(),
+              help='end date (yyyy-mm-dd format) of the monthly report (Not included)')
+@click.option('--ong', '-o',
+              default=['msf'],
+              required=False,
+              multiple=True,
+              help='client alias of the lead report')
+@click.option('--repeat',
+              default=1,
+              required=False,
+              type=click.IntRange(min=1),
+              help='number of runs of each report')
+@click.option('--sorted-merges',
+              is_flag=True,
+              default=False,
+              help='load the database tables ordered by their merge keys and merge them on sorted indexes')
+@click.option('--output',
+              default='benchmark_results.jsonl',
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON lines file where one line per run is appended')
+def command_line_interface(scale: str, deliveries_mean: float, database: str, generate: bool, report: str,
+                           start: datetime, end: datetime, ong: list, repeat: int, sorted_merges: bool, output: str):
+    """
+    Command line user interface developed to benchmark the reports against a synthetic SQLite database.
+    Every run is profiled and appended to the output file together with the current commit, so runs from different
+    commits can be compared stage by stage.
+
+    :param scale: (string) number of users of the synthetic database.
+        :example: --scale 1m  --> scale = 1m
+        :example:             --> scale = 100k
+    :param deliveries_mean: (float) mean number of deliveries per user of the synthetic database.
+    :param database: (string) SQLite file of the synthetic database. None to use 'benchmark_[scale].sqlite'.
+    :param generate: (bool) flag to generate the synthetic database even if the file already exists.
+    :param report: (string) report to benchmark: 'monthly', 'lead' or 'all'.
+    :param start: (datetime) start date of the monthly report. None to take from the first record.
+    :param end: (datetime) end date of the monthly report. None to take until present.
+    :param ong: (list) client aliases of the lead report.
+        :example: -o acnur -o msf --> ong = [acnur, msf]
+    :param repeat: (int) number of runs of each report.
+    :param sorted_merges: (bool) flag to merge the tables on sorted indexes.
+    :param output: (string) JSON lines file where the runs are appended.
+    :return: void
+    """
+
+    if database is None:
+        database = 'benchmark_{0}.sqlite'.format(scale)
+
+    if generate or not os.path.exists(database):
+        generate_dataset(file=database, users=SCALES[scale], deliveries_mean=deliveries_mean)
+
+    db_url = 'sqlite:///' + os.path.abspath(database)
+
+    reports = {'monthly': lambda: monthly_report.generate_report(start_date=start, end_date=end, country=None,
+                                                                 client=None, sorted_merges=sorted_merges,
+                                                                 db_url=db_url),
+               'lead': lambda: lead_report.generate_report(clients=list(ong), sorted_merges=sorted_merges,
+                                                           db_url=db_url)}
+
+    if report != 'all':
+        reports = {report: reports[report]}
+
+    for report_name, run_report in reports.items():
+        for run in range(repeat):
+            profiler.enable()
+
+            with profiler.stage(report_name + '_report'):
+                run_report()
+
+            profiler.print_summary()
+            _append_run(output=output, run={'commit': _get_commit(),
+                                            'date': datetime.datetime.now().isoformat(),
+                                            'report': report_name,
+                                            'scale': scale,
+                                            'deliveries_mean': deliveries_mean,
+                                            'sorted_merges': sorted_merges,
+                                            'run': run,
+                                            'stages': profiler.records})
+            profiler.disable()
+
+
+def _get_commit():
+    """
+    :return: (str) current git commit. None if it cannot be read.
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _append_run(output: str, run: dict):
+    with open(output, 'a', encoding='utf-8') as output_file:
+        output_file.write(json.dumps(run, default=str) + '\n')
+
+
+if __name__ == '__main__':
+    command_line_interface()
@@ -0,0 +1,271 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+"""
+Synthetic replica of the production database, used to benchmark the reports without touching MariaDB.
+Every table and column read by 'report_config.json' is generated, with realistic cardinalities:
+    - users, profile, score: one row per user.
+    - facebookuser, twitteruser: one row per user signed up with the social network.
+    - user_given_to: a Poisson number of deliveries per user ('deliveries_mean'). Users with 0 deliveries are undelivered.
+    - push: a Poisson number of campaign supports per user ('supports_mean').
+    - user_privacy_policy: 1 to 3 privacy policy choices per user.
+    - country, terms, question, privacy_policy, privacy_policy_checkbox: small dimension tables.
+"""
+
+# Number of users of each predefined scale
+SCALES = {'100k': 100000,
+          '1m': 1000000,
+          '10m': 10000000}
+
+COUNTRIES = ['España', 'México', 'Colombia', 'Chile', 'Argentina', 'Perú']
+COUNTRY_WEIGHTS = [0.55, 0.15, 0.1, 0.1, 0.06, 0.04]
+
+CLIENTS = ['msf', 'cris-contra-el-cancer', 'unoentrecienmil', 'acnur', 'ach', 'plan-internacional',
+           'aldeas-infantiles', 'anar', 'mx-unicef-mx', 'chile-world-vision', 'argentina-techo']
+
+FIRST_NAMES = ['maria', 'jose', 'carmen', 'antonio', 'ana', 'manuel', 'laura', 'david', 'lucia', 'juan_carlos']
+LAST_NAMES = ['garcia', 'rodriguez', 'gonzalez', 'fernandez', 'lopez', 'martinez', 'sanchez perez', 'gomez']
+
+FIRST_DATE = np.datetime64('2018-01-01T00:00:00')
+LAST_DATE = np.datetime64('2021-12-31T23:59:59')
+
+NUMBER_OF_POLICIES = 31
+NUMBER_OF_TERMS = 20
+
+
+def generate_dataset(file: str, users=100000, deliveries_mean=1.5, supports_mean=1.0, chunksize=500000, seed=0):
+    """
+    Writes a synthetic database into a SQLite file. Users are generated in chunks, so the memory used does not depend on
+    the scale.
+
+    :param file: (str) SQLite file path. It is replaced if it already exists.
+    :param users: (int) number of users.
+    :param deliveries_mean: (float) mean number of deliveries (user_given_to rows) per user.
+    :param supports_mean: (float) mean number of campaign supports (push rows) per user.
+    :param chunksize: (int) number of users generated at a time.
+    :param seed: (int) random seed. The same seed and parameters always generate the same database.
+    :return: void
+    """
+
+    if os.path.exists(file):
+        os.remove(file)
+
+    random = np.random.default_rng(seed)
+    number_of_questions = max(100, users // 1000)
+
+    with sqlite3.connect(file) as connexion:
+        _write(connexion, 'country', _get_countries())
+        _write(connexion, 'terms', _get_terms())
+        _write(connexion, 'privacy_policy', _get_privacy_policies())
+        _write(connexion, 'privacy_policy_checkbox', _get_privacy_policy_checkboxes())
+        _write(connexion, 'question', _get_questions(random=random, number_of_questions=number_of_questions,
+                                                     users=users))
+
+        first_choice_id = 1
+
+        for first_user in range(1, users + 1, chunksize):
+            user_ids = np.arange(first_user, min(first_user + chunksize, users + 1))
+
+            user_df = _get_users(random=random, user_ids=user_ids)
+            _write(connexion, 'users', user_df)
+            _write(connexion, 'profile', _get_profiles(random=random, user_ids=user_ids))
+            _write(connexion, 'score', _get_scores(random=random, user_ids=user_ids))
+            _write(connexion, 'facebookuser', _get_facebook_users(random=random, user_df=user_df))
+            _write(connexion, 'twitteruser', _get_twitter_users(random=random, user_ids=user_ids))
+            _write(connexion, 'push', _get_pushes(random=random, user_df=user_df, supports_mean=supports_mean,
+                                                  number_of_questions=number_of_questions))
+
+            _write(connexion, 'user_given_to', _get_deliveries(random=random, user_df=user_df,
+                                                               deliveries_mean=deliveries_mean))
+
+            choices_df = _get_privacy_choices(random=random, user_ids=user_ids, first_id=first_choice_id)
+            _write(connexion, 'user_privacy_policy', choices_df)
+            first_choice_id += choices_df.shape[0]
+
+            print('users={0}/{1}'.format(user_ids[-1], users))
+
+        _create_indexes(connexion)
+
+
+def _write(connexion, table_name: str, dataframe: pd.DataFrame):
+    dataframe.to_sql(table_name, con=connexion, if_exists='append', index=False)
+
+
+def _create_indexes(connexion):
+    """
+    Creates the indexes production has on the merge keys, so the benchmark queries use the same access paths.
+
+    :param connexion: (sqlite3.Connection) database connexion.
+    :return: void
+    """
+
+    indexes = {'users': ['id', 'created_at'],
+               'profile': ['user_id'],
+               'score': ['user_id'],
+               'facebookuser': ['user_id'],
+               'twitteruser': ['user_id'],
+               'user_given_to': ['user_id', 'given_at'],
+               'push': ['user_id', 'question_id'],
+               'question': ['id'],
+               'user_privacy_policy': ['user_id'],
+               'country': ['id'],
+               'terms': ['id'],
+               'privacy_policy': ['id'],
+               'privacy_policy_checkbox': ['id']}
+
+    for table_name, columns in indexes.items():
+        for column_name in columns:
+            connexion.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1})'.format(table_name, column_name))
+
+
+def _random_dates(random, start, end, size: int):
+    """
+    :return: (ndarray) datetime64[s] values uniformly distributed between 'start' and 'end' (arrays or scalars).
+    """
+
+    seconds = (np.asarray(end) - np.asarray(start)).astype('timedelta64[s]').astype(np.int64)
+    offsets = (random.random(size) * seconds).astype(np.int64)
+
+    return np.asarray(start).astype('datetime64[s]') + offsets.astype('timedelta64[s]')
+
+
+def _with_nulls(random, values, ratio: float):
+    """
+    :return: (Series) values with a 'ratio' of them replaced by null values.
+    """
+
+    values = pd.Series(values)
+
+    return values.mask(random.random(values.shape[0]) < ratio)
+
+
+def _get_countries():
+    return pd.DataFrame({'id': np.arange(1, len(COUNTRIES) + 1), 'name': COUNTRIES})
+
+
+def _get_terms():
+    ids = np.arange(1, NUMBER_OF_TERMS + 1)
+
+    return pd.DataFrame({'id': ids, 'name_es': ['Tema {0}'.format(term_id) for term_id in ids]})
+
+
+def _get_privacy_policies():
+    ids = np.arange(1, NUMBER_OF_POLICIES + 1)
+
+    return pd.DataFrame({'id': ids, 'name': ['Política {0}'.format(policy_id) for policy_id in ids]})
+
+
+def _get_privacy_policy_checkboxes():
+    ids = np.arange(1, NUMBER_OF_POLICIES + 1)
+
+    return pd.DataFrame({'id': ids, 'privacy_policy_id': ids})
+
+
+def _get_questions(random, number_of_questions: int, users: int):
+    ids = np.arange(1, number_of_questions + 1)
+
+    # Most campaigns are original ones: only a few are copies of another campaign
+    parent_ids = np.where(random.random(number_of_questions) < 0.9, 0, random.integers(1, number_of_questions + 1,
+                                                                                         number_of_questions))
+
+    return pd.DataFrame({'id': ids,
+                         'parent_id': parent_ids,
+                         'user_id': random.integers(1, users + 1, number_of_questions),
+                         'privacy_policy_id': random.integers(1, NUMBER_OF_POLICIES + 1, number_of_questions),
+                         'question': ['Campaña {0}'.format(question_id) for question_id in ids],
+                         'term_id': random.integers(1, NUMBER_OF_TERMS + 1, number_of_questions)})
+
+
+def _get_users(random, user_ids):
+    size = user_ids.shape[0]
+
+    return pd.DataFrame({'id': user_ids,
+                         'created_at': np.sort(_random_dates(random, FIRST_DATE, LAST_DATE, size)),
+                         'first_name': random.choice(FIRST_NAMES, size),
+                         'last_name': random.choice(LAST_NAMES, size),
+                         'email': ['user{0}@example.com'.format(user_id) for user_id in user_ids]})
+
+
+def _get_profiles(random, user_ids):
+    size = user_ids.shape[0]
+    telephones = pd.Series(random.integers(600000000, 700000000, size)).astype(str)
+
+    profile_df = pd.DataFrame({'user_id': user_ids,
+                               'age': _with_nulls(random, random.integers(0, 95, size), 0.3),
+                               'telephone': telephones.mask(random.random(size) < 0.4, ''),
+                               'country_id': random.choice(np.arange(1, len(COUNTRIES) + 1), size, p=COUNTRY_WEIGHTS),
+                               'gender': _with_nulls(random, random.choice(['male', 'female'], size), 0.2),
+                               'birthday': _with_nulls(random, _random_dates(random, np.datetime64('1940-01-01'),
+                                                                             np.datetime64('2005-01-01'), size), 0.5),
+                               'postal_code': random.integers(1000, 52999, size).astype(str),
+                               'emailUnsubscribedDate': _with_nulls(random, _random_dates(random, FIRST_DATE,
+                                                                                          LAST_DATE, size), 0.9),
+                               'device': random.choice(['android', 'ios', 'web'], size)})
+
+    for flag, ratio in [('emailConfirmed', 0.6), ('telephoneConfirmed', 0.3), ('emailSubscribed', 0.5),
+                        ('telephoneSubscribed', 0.4), ('shareMyData', 0.7), ('robinson', 0.05), ('cant_call', 0.1)]:
+        profile_df[flag] = _with_nulls(random, (random.random(size) < ratio).astype(int), 0.05)
+
+    return profile_df
+
+
+def _get_scores(random, user_ids):
+    return pd.DataFrame({'user_id': user_ids, 'score': random.integers(0, 100, user_ids.shape[0])})
+
+
+def _get_facebook_users(random, user_df: pd.DataFrame):
+    facebook_df = user_df.loc[random.random(user_df.shape[0]) < 0.3, ['id', 'first_name', 'last_name', 'email']]
+    size = facebook_df.shape[0]
+
+    return pd.DataFrame({'user_id': facebook_df['id'].values,
+                         'facebook_id': random.integers(10 ** 14, 10 ** 15, size).astype(str),
+                         'birthday': _with_nulls(random, _random_dates(random, np.datetime64('1940-01-01'),
+                                                                       np.datetime64('2005-01-01'), size), 0.4),
+                         'first_name': facebook_df['first_name'].values,
+                         'last_name': facebook_df['last_name'].values,
+                         'location': random.choice(COUNTRIES, size),
+                         'email': facebook_df['email'].values})
+
+
+def _get_twitter_users(random, user_ids):
+    twitter_ids = user_ids[random.random(user_ids.shape[0]) < 0.05]
+
+    return pd.DataFrame({'user_id': twitter_ids,
+                         'twitter_id': random.integers(10 ** 9, 10 ** 10, twitter_ids.shape[0]).astype(str)})
+
+
+def _get_deliveries(random, user_df: pd.DataFrame, deliveries_mean: float):
+    deliveries = random.poisson(deliveries_mean, user_df.shape[0])
+    user_ids = np.repeat(user_df['id'].values, deliveries)
+    created_at = np.repeat(user_df['created_at'].values, deliveries)
+
+    # Leads are delivered after they are created
+    return pd.DataFrame({'user_id': user_ids,
+                         'given_to': random.choice(CLIENTS, user_ids.shape[0]),
+                         'given_at': _random_dates(random, created_at, LAST_DATE, user_ids.shape[0])})
+
+
+def _get_pushes(random, user_df: pd.DataFrame, supports_mean: float, number_of_questions: int):
+    supports = random.poisson(supports_mean, user_df.shape[0])
+    user_ids = np.repeat(user_df['id'].values, supports)
+    created_at = np.repeat(user_df['created_at'].values, supports)
+    size = user_ids.shape[0]
+
+    return pd.DataFrame({'user_id': user_ids,
+                         'question_id': random.integers(1, number_of_questions + 1, size),
+                         'date': _random_dates(random, created_at, LAST_DATE, size),
+                         'ip': ['10.{0}.{1}.{2}'.format(*octets) for octets in random.integers(0, 256, (size, 3))]})
+
+
+def _get_privacy_choices(random, user_ids, first_id: int):
+    choices = random.integers(1, 4, user_ids.shape[0])
+    choice_user_ids = np.repeat(user_ids, choices)
+    size = choice_user_ids.shape[0]
+
+    # Checkbox 1 is the platform privacy policy, shown to non-sponsored users
+    return pd.DataFrame({'id': np.arange(first_id, first_id + size),
+                         'user_id': choice_user_ids,
+                         'privacy_policies_checkbox_id': random.integers(1, NUMBER_OF_POLICIES + 1, size),
+                         'checked': (random.random(size) < 0.7).astype(int)})
@@ -1,18 +1,143 @@
+import pandas as pd
 from reports.data_extraction.database.models.database_model import DatabaseReport
+from reports.data_extraction.database.models.database_session import DatabaseSession
+from reports.utils.profiler import profiler
 
+# Sessions opened by this process, by database. They are reused by every 'get_data' and 'get_data_chunks' call
+_sessions = dict()
 
-def get_data(report_type):
+
+def get_session(db_name='local_backup', db_url=None, pool_size=5):
+    """
+    Gets the session of a database, creating it the first time it is requested. The connexion pool of a session keeps
+    the size requested on its creation.
+
+    :param db_name: (str) entry of 'db_access_credentials.json' with the database to connect to.
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with 'db_access_credentials.json'.
+    :param pool_size: (int) number of connexions kept open in the engine pool.
+    :return: (DatabaseSession) database session.
+    """
+
+    key = (db_name, db_url)
+
+    if key not in _sessions:
+        _sessions[key] = DatabaseSession(db_name=db_name, db_url=db_url, pool_size=pool_size)
+
+    return _sessions[key]
+
+
+@profiler.profile()
+def get_data(report_type, filters: list = None, max_workers=1, snapshot_path=None, sql_joins=False, max_fan_out=None,
+             abort_on_fan_out=False, sorted_merges=False, db_name='local_backup', db_url=None, required_columns=None,
+             arrow=False, partitions=1, max_processes=None, shard_function=None, memory_budget=None, spill_path=None,
+             checkpoint=None, query_report=None):
     """
     Executes the data collection pipeline to get all the required data according to 'report_type' parameter.
 
     :param report_type: (str) report configuration type to load from the 'report_config.json' configuration file.
-    :return: (pd.DataFrame) dataset with the clean data generated within the month and year received as parameter.
+    :param filters: (list) filter spec pushed down to the database so only the requested slice of data is loaded.
+    None to load the whole tables.
+    :param max_workers: (int) maximum number of tables loaded in parallel. 1 to load them one after another.
+    :param snapshot_path: (str) folder where local snapshots of the tables are kept and incrementally refreshed. None to
+    read every table from the database.
+    :param sql_joins: (bool) flag to run the merges in the database, as a single SQL statement per merge tree, instead
+    of merging the tables with pandas. Parallelism and snapshots do not apply in this mode.
+    :param max_fan_out: (float) maximum number of rows per left table row allowed in a pandas merge, for the joins that
+    do not define their own 'max_fan_out' in the 'report_config.json' configuration file. None to allow any fan-out.
+    :param abort_on_fan_out: (bool) flag to abort, instead of printing a warning, when a merge exceeds its maximum
+    fan-out.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param db_name: (str) entry of 'db_access_credentials.json' with the database to connect to (MariaDB server or local
+    SQLite/DuckDB replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with 'db_access_credentials.json'.
+    :param required_columns: (list) merged columns consumed by the report, one list per merge tree. Only them (and the
+    merge keys) are loaded and merged (see 'MergePlan.prune'). None to load every configured column.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param partitions: (int) number of shards the tables are hash-partitioned into by user id, to merge them in a
+    process pool (see 'DatabaseReport.merge_partitions'). 1 to merge them in this process.
+    :param max_processes: (int) maximum number of shards merged in parallel. None to use one process per core.
+    :param shard_function: (function) picklable function applied in the pool to the merged tables of each shard. None
+    to concatenate the merged shards.
+    :param memory_budget: (float) maximum MB of tables held in memory while merging. Finished merge trees above it are
+    spilled to Feather files until every tree is merged. None to keep every table in memory.
+    :param spill_path: (str) folder of the spilled merge trees. None to use a temporary folder.
+    :param checkpoint: (CheckpointStore) checkpoints of the run. The extracted tables ('extracted' stage) and the merged
+    trees ('merged' stage) are stored in it and, if they already are, they are not loaded or merged again. None to omit
+    them.
+    :param query_report: (str) JSON file where the SQL, server, transfer and convert times, bytes, rows and EXPLAIN
+    output of every table load are written (see 'DatabaseReport._read_measured_query'). None to omit it.
+    :return: (pd.DataFrame) dataset with the clean data generated within the month and year received as parameter. If
+    'shard_function' is given, the list of its results, one per shard.
     """
 
-    report = DatabaseReport(report_type=report_type)
+    if (checkpoint is not None) and (shard_function is None):
+        merged_table = checkpoint.load('merged')
+
+        if merged_table is not None:
+            return merged_table
+
+    session = get_session(db_name=db_name, db_url=db_url, pool_size=max(max_workers, 5))
+    report = DatabaseReport(report_type=report_type, snapshot_path=snapshot_path, session=session,
+                            required_columns=required_columns)
+
+    if (partitions > 1) and sql_joins:
+        raise ValueError("Partitioned merges are run in memory: 'partitions' cannot be combined with 'sql_joins'")
+
+    if not sql_joins:
+        tables = checkpoint.load('extracted') if checkpoint is not None else None
+
+        if tables is not None:
+            report.restore_tables(tables=tables)
+        else:
+            report.load_db_tables(filters=filters, max_workers=max_workers, sort_keys=sorted_merges, arrow=arrow,
+                                  measure_queries=query_report is not None)
 
-    report.set_db_connexion()
-    report.load_db_tables()
-    report.merge_tables()
+            if query_report is not None:
+                report.write_query_report(file=query_report)
+
+            if checkpoint is not None:
+                checkpoint.save('extracted', report.tables)
+
+    if partitions > 1:
+        results = report.merge_partitions(partitions=partitions, max_processes=max_processes,
+                                          shard_function=shard_function, max_fan_out=max_fan_out,
+                                          abort_on_fan_out=abort_on_fan_out, sorted_merges=sorted_merges)
+
+        if shard_function is not None:
+            return results
+
+        report.merged_table = [pd.concat([shard[tree] for shard in results], ignore_index=True)
+                               for tree in range(len(report.trees))]
+    elif sql_joins:
+        report.load_merged_tables(filters=filters, arrow=arrow)
+    else:
+        report.merge_tables(max_fan_out=max_fan_out, abort_on_fan_out=abort_on_fan_out, sorted_merges=sorted_merges,
+                            memory_budget=memory_budget, spill_path=spill_path)
+
+    if checkpoint is not None:
+        checkpoint.save('merged', report.merged_table)
 
     return report.merged_table
+
+
+def get_data_chunks(report_type, filters: list = None, chunksize=100000, db_name='local_backup', db_url=None,
+                    required_columns=None):
+    """
+    Streaming version of 'get_data'. Merges are run in the database and the merged data is read in chunks, so it can
+    be filtered and cleaned without holding the whole dataset in memory.
+
+    :param report_type: (str) report configuration type to load from the 'report_config.json' configuration file.
+    :param filters: (list) filter spec pushed down to the database so only the requested slice of data is loaded.
+    None to load the whole tables.
+    :param chunksize: (int) number of rows of each DataFrame chunk.
+    :param db_name: (str) entry of 'db_access_credentials.json' with the database to connect to.
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with 'db_access_credentials.json'.
+    :param required_columns: (list) merged columns consumed by the report, one list per merge tree. None to load every
+    configured column.
+    :return: (list) iterators of DataFrame chunks, one per merge tree in the 'report_config.json' order.
+    """
+
+    report = DatabaseReport(report_type=report_type, session=get_session(db_name=db_name, db_url=db_url),
+                            required_columns=required_columns)
+
+    return report.stream_merged_tables(filters=filters, chunksize=chunksize)
@@ -1,7 +1,15 @@
 import pandas as pd
+import json
 import os
-from sqlalchemy import create_engine
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from reports.data_extraction.database.utils.Tree import *
+from reports.data_extraction.database.utils.backends import get_backend
+from reports.data_extraction.database.utils.merge_plan import MergePlan
+from reports.data_extraction.database.utils.query_builder import QueryBuilder
+from reports.data_extraction.database.utils.snapshot_store import SnapshotStore
+from reports.utils.profiler import profiler, get_peak_rss_mb
 
 
 class DatabaseReport:
@@ -10,85 +18,534 @@ class DatabaseReport:
     db_config_file = "report_config.json"
 
     # default constructor
-    def __init__(self, report_type):
+    def __init__(self, report_type, snapshot_path=None, session=None, required_columns=None):
         self.report_type = report_type
-
-        self.mariadb_engine = None
-        self.table_indexes = list()
-        self.list_of_tables = None
-        self.master_table = list()
+        self.session = session
+        self.required_columns = required_columns
+
+        self.snapshot_store = SnapshotStore(snapshot_path) if snapshot_path is not None else None
+        self.backend = session.backend if session is not None else None
+        self.db_engine = session.db_engine if session is not None else None
+        self.plan = None
+        self.tables = dict()
+        self.table_keys = dict()
         self.merged_table = list()
         self.trees = list()
+        self.load_timings = list()
+        self.merge_timings = list()
+        self.query_stats = list()
 
-    def set_db_connexion(self, db_name='local_backup'):
+    def set_db_connexion(self, db_name='local_backup', pool_size=5, db_url=None):
         """
         Establish an active and stable connexion session with the database.
 
         :param db_name: (str) set of credentials stored in 'db_access_credentials.json' file used to connect to the database.
+        Its 'backend' field selects the database engine: 'mariadb' (default), 'sqlite' or 'duckdb' (see
+        'DatabaseBackend').
+        :param pool_size: (int) number of connexions kept open in the engine pool. It should be at least the maximum
+        number of tables loaded in parallel.
+        :param db_url: (str) SQLAlchemy URL of the database, used instead of the credentials file (e.g. the SQLite file
+        written by 'reports.benchmark.dataset_generator').
+            :example: 'sqlite:///benchmark_100k.sqlite'
         :return: void
         """
 
-        dbapi = pd.read_json(os.path.join(self.config_path, "db_access_credentials.json"), orient='index')
+        self.backend = get_backend(credentials_file=os.path.join(self.config_path, "db_access_credentials.json"),
+                                   db_name=db_name, db_url=db_url)
+
+        self.db_engine = self.backend.create_engine(pool_size=pool_size)
+
+    def _get_plan(self):
+        """
+        Gets the table parameters and the merge plan of the report type, from the session if the report has one or
+        from the 'report_config.json' configuration file otherwise. The plan is pruned to the required columns of the
+        report (see 'MergePlan.prune').
+
+        :return: (list, MergePlan) table parameters and merge plan.
+        """
 
-        # Let's create a connexion from the DBAPI variables
-        connexion = 'mysql+mysqlconnector://{0}:{1}@{2}:{3}/{4}?auth_plugin={5}'
-        connexion = connexion.format(dbapi['user'][db_name],
-                                     dbapi['password'][db_name],
-                                     dbapi['server_url'][db_name],
-                                     dbapi['port'][db_name],
-                                     dbapi['schema'][db_name],
-                                     dbapi['authentication_plugin'][db_name])
+        if self.session is not None:
+            plan = self.session.get_plan(self.report_type, required_columns=self.required_columns)
+        else:
+            table_params = pd.read_json(os.path.join(self.config_path, self.db_config_file),
+                                        orient='records')[self.report_type]['table']
+            plan = MergePlan(table_params=table_params).prune(required_columns=self.required_columns)
 
-        self.mariadb_engine = create_engine(connexion)
+        return plan.table_params, plan
 
-    def load_db_tables(self):
+    @profiler.profile()
+    def load_db_tables(self, filters: list = None, max_workers=1, sort_keys=False, arrow=False, measure_queries=False):
         """
         Loads all the tables and columns indicated in the 'table_properties.json' file.
 
+        :param filters: (list) filter spec to push down to the database. Each filter is a dictionary with the keys
+        'table', 'column', 'operator', 'value' and, optionally, 'keep_unmatched'. None to load the whole tables.
+            :example: [{'table': 'country', 'column': 'name', 'operator': '==', 'value': 'España'}]
+        :param max_workers: (int) maximum number of tables loaded in parallel. 1 to load them one after another.
+        :param sort_keys: (bool) flag to read each table ordered by its merge key, so 'merge_tables' can index it
+        without sorting it.
+        :param arrow: (bool) flag to fetch the tables as Arrow record batches and keep them in pyarrow-backed columns
+        (see 'DatabaseBackend.read_arrow'), instead of converting the driver rows value by value.
+        :param measure_queries: (bool) flag to record, in 'query_stats', the SQL, timings, bytes, rows and EXPLAIN
+        output of every load (see '_read_measured_query'). Measured loads are read through the database driver.
+        :return: void
+        """
+
+        table_params, self.plan = self._get_plan()
+        self.trees = self.plan.trees
+
+        # Filters are compiled into per-table SQL restrictions following the merge trees. Snapshots store whole tables,
+        # so filters are not pushed down when they are enabled
+        if self.snapshot_store is not None:
+            filters = None
+
+        query_builder = QueryBuilder(plan=self.plan, filters=filters)
+
+        # Each physical table is read once and shared by all the tables of the configuration file that request it
+        loads = query_builder.get_load_plan(table_params=table_params, sort_keys=sort_keys)
+
+        # Loading tables from database. Loads are independent of each other, so they can be read simultaneously
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(self._load_table, load, arrow, measure_queries) for load in loads]
+
+                for future in as_completed(futures):
+                    self._set_loaded_table(*future.result())
+        else:
+            for load in loads:
+                self._set_loaded_table(*self._load_table(load=load, arrow=arrow, measure=measure_queries))
+
+    def restore_tables(self, tables: dict):
+        """
+        Alternative to 'load_db_tables' for tables loaded by a previous run (e.g. read from a checkpoint).
+
+        :param tables: (dict) pairs table position - loaded table, as stored in 'tables' by 'load_db_tables'.
+        :return: void
+        """
+
+        _, self.plan = self._get_plan()
+        self.trees = self.plan.trees
+        self.tables = dict(tables)
+
+    def _load_table(self, load: dict, arrow=False, measure=False):
+        """
+        Reads a single table from the database.
+        If snapshots are enabled and the load has a watermark, the table is read from its local snapshot and only the
+        new rows are read from the database. The snapshot is then updated with them.
+
+        :param load: (dict) load from the load plan built by 'QueryBuilder.get_load_plan'.
+        :param arrow: (bool) flag to fetch the table as Arrow record batches.
+        :param measure: (bool) flag to record the query stats of the load.
+        :return: (dict, DataFrame, dict) load, loaded table and its load timing.
+        """
+
+        with profiler.stage('load_table', table=load['table'], positions=load['positions']) as record:
+            start = time.perf_counter()
+
+            snapshot = None
+            query = load['query']
+            incremental = (self.snapshot_store is not None) and (load['watermark'] is not None)
+
+            if incremental:
+                snapshot, last_value = self.snapshot_store.read(table_name=load['table'], columns=load['columns'],
+                                                                watermark=load['watermark'], dtypes=load['dtypes'],
+                                                                parse_dates=load['parse_dates'])
+                if snapshot is not None:
+                    watermark = query.selected_columns[load['watermark']]
+                    query = query.where((watermark >= last_value) | watermark.is_(None))
+
+            if measure:
+                dataframe = self._read_measured_query(load=load, query=query)
+            else:
+                dataframe = self._read_query(query=query, parse_dates=load['parse_dates'], arrow=arrow)
+            database_rows = dataframe.shape[0]
+
+            if snapshot is not None:
+                dataframe = pd.concat([snapshot, dataframe], ignore_index=True)
+
+            dataframe = compact_dtypes(dataframe=dataframe, dtypes=load['dtypes'])
+
+            if incremental:
+                self.snapshot_store.write(table_name=load['table'], columns=load['columns'], dataframe=dataframe,
+                                          dtypes=load['dtypes'], parse_dates=load['parse_dates'],
+                                          full_read=snapshot is None)
+
+            record['rows_in'], record['rows_out'] = database_rows, dataframe.shape[0]
+
+        timing = {'table': load['table'],
+                  'positions': load['positions'],
+                  'rows': dataframe.shape[0],
+                  'database_rows': database_rows,
+                  'seconds': time.perf_counter() - start}
+
+        return load, dataframe, timing
+
+    def _set_loaded_table(self, load: dict, dataframe: pd.DataFrame, timing: dict):
+        """
+        Stores a loaded table in 'tables', in every position served by the load, and reports its load timing.
+        Each position gets a projection with its own columns. When it requests every loaded column, the DataFrame is
+        shared instead of copied (merges never modify their input DataFrames).
+
+        :param load: (dict) load from the load plan built by 'QueryBuilder.get_load_plan'.
+        :param dataframe: (DataFrame) loaded table.
+        :param timing: (dict) load timing of the table.
+        :return: void
+        """
+
+        for position in load['positions']:
+            columns = self.plan.get_node(position).columns
+
+            if columns == load['columns']:
+                self.tables[position] = dataframe
+            else:
+                self.tables[position] = dataframe.loc[:, columns]
+
+        self.load_timings.append(timing)
+
+        print('table={0} positions={1} rows={2} database_rows={3} seconds={4:.3f}'.format(
+            timing['table'], timing['positions'], timing['rows'], timing['database_rows'], timing['seconds']))
+
+    def load_merged_tables(self, filters: list = None, chunksize=100000, arrow=False):
+        """
+        Alternative to 'load_db_tables' + 'merge_tables': each merge tree is compiled into a single SQL statement, so
+        the joins are run next to the data and only the merged rows are transferred. Results are read through a
+        server-side cursor in chunks of 'chunksize' rows.
+
+        :param filters: (list) filter spec to push down to the database. None to load the whole tables.
+        :param chunksize: (int) number of rows fetched from the server-side cursor at a time.
+        :param arrow: (bool) flag to fetch each merged tree as Arrow record batches instead of through the server-side
+        cursor.
+        :return: void
+        """
+
+        table_params, self.plan = self._get_plan()
+        self.trees = self.plan.trees
+        query_builder = QueryBuilder(plan=self.plan, filters=filters)
+
+        for tree in self.trees:
+            with profiler.stage('load_tree', table=tree.node.name, positions=[tree.node.position]) as record:
+                start = time.perf_counter()
+                query, parse_dates, dtypes = query_builder.get_tree_query(tree=tree, table_params=table_params)
+
+                if arrow:
+                    merged_table = self._read_query(query=query, parse_dates=parse_dates, arrow=True)
+                else:
+                    merged_table = pd.concat(self._stream_query(query=query, parse_dates=parse_dates, dtypes=dtypes,
+                                                                chunksize=chunksize), ignore_index=True)
+
+                # Chunks with different categories are concatenated as object columns
+                merged_table = compact_dtypes(dataframe=merged_table, dtypes=dtypes)
+                record['rows_out'] = merged_table.shape[0]
+                self.merged_table.append(merged_table)
+
+            timing = {'table': tree.node.name,
+                      'positions': [tree.node.position],
+                      'rows': merged_table.shape[0],
+                      'database_rows': merged_table.shape[0],
+                      'seconds': time.perf_counter() - start}
+            self.load_timings.append(timing)
+
+            print('tree={0} position={1} rows={2} seconds={3:.3f}'.format(timing['table'], tree.node.position,
+                                                                         timing['rows'], timing['seconds']))
+
+    def stream_merged_tables(self, filters: list = None, chunksize=100000):
+        """
+        Streaming version of 'load_merged_tables': instead of DataFrames, it returns one iterator of DataFrame chunks
+        per merge tree. Each iterator reads its merge tree through a server-side cursor only when it is consumed, so
+        at most 'chunksize' merged rows per iterator are held in memory by the extraction.
+
+        :param filters: (list) filter spec to push down to the database. None to load the whole tables.
+        :param chunksize: (int) number of rows of each DataFrame chunk.
+        :return: (list) iterators of DataFrame chunks, one per merge tree in the 'report_config.json' order.
+        """
+
+        table_params, self.plan = self._get_plan()
+        self.trees = self.plan.trees
+        query_builder = QueryBuilder(plan=self.plan, filters=filters)
+
+        iterators = list()
+        for tree in self.trees:
+            query, parse_dates, dtypes = query_builder.get_tree_query(tree=tree, table_params=table_params)
+            iterators.append(self._stream_query(query=query, parse_dates=parse_dates, dtypes=dtypes,
+                                                chunksize=chunksize))
+
+        return iterators
+
+    def _read_query(self, query, parse_dates: list, arrow=False):
+        """
+        Reads the whole result of a query.
+
+        :param query: (sqlalchemy.Select) query to execute.
+        :param parse_dates: (list) columns to parse as dates.
+        :param arrow: (bool) flag to fetch the result as Arrow record batches through the database backend.
+        :return: (DataFrame) result of the query.
+        """
+
+        if arrow:
+            return self.backend.read_arrow(engine=self.db_engine, query=query, parse_dates=parse_dates)
+
+        return pd.read_sql(sql=query, con=self.db_engine, parse_dates=parse_dates)
+
+    def _read_measured_query(self, load: dict, query):
+        """
+        Reads the whole result of a load query splitting its cost, and records it in 'query_stats':
+            - 'sql': SQL text of the query, with its parameters rendered as literals.
+            - 'server_seconds': time until the database starts returning rows (rows are read through a server-side
+            cursor, so it is the execution time on the server).
+            - 'transfer_seconds': time fetching the rows through the database driver.
+            - 'convert_seconds': time building the DataFrame from the fetched rows.
+            - 'bytes_received': bytes sent by the server. None if the database does not report them.
+            - 'memory_bytes': memory of the resultant DataFrame.
+            - 'rows': number of rows.
+            - 'explain': EXPLAIN output of the query.
+
+        :param load: (dict) load from the load plan built by 'QueryBuilder.get_load_plan'.
+        :param query: (sqlalchemy.Select) query to execute.
+        :return: (DataFrame) result of the query.
+        """
+
+        with self.db_engine.connect() as connexion:
+            explain = self.backend.explain(connexion=connexion, query=query)
+            bytes_before = self.backend.get_bytes_received(connexion=connexion)
+
+            start = time.perf_counter()
+            result = connexion.execution_options(stream_results=True).execute(query)
+            server_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rows = result.fetchall()
+            columns = list(result.keys())
+            transfer_seconds = time.perf_counter() - start
+
+            bytes_after = self.backend.get_bytes_received(connexion=connexion)
+
+        start = time.perf_counter()
+        dataframe = pd.DataFrame.from_records(rows, columns=columns)
+        del rows
+
+        for name in load['parse_dates'] or list():
+            dataframe[name] = pd.to_datetime(dataframe[name], errors='coerce')
+        convert_seconds = time.perf_counter() - start
+
+        stats = {'table': load['table'],
+                 'positions': load['positions'],
+                 'sql': self.backend.get_sql(engine=self.db_engine, query=query),
+                 'server_seconds': server_seconds,
+                 'transfer_seconds': transfer_seconds,
+                 'convert_seconds': convert_seconds,
+                 'bytes_received': bytes_after - bytes_before if bytes_before is not None else None,
+                 'memory_bytes': int(dataframe.memory_usage(deep=True).sum()),
+                 'rows': dataframe.shape[0],
+                 'explain': explain}
+        self.query_stats.append(stats)
+
+        print('query={0} positions={1} server={2:.3f}s transfer={3:.3f}s convert={4:.3f}s bytes={5} rows={6}'.format(
+            stats['table'], stats['positions'], stats['server_seconds'], stats['transfer_seconds'],
+            stats['convert_seconds'], stats['bytes_received'], stats['rows']))
+
+        return dataframe
+
+    def write_query_report(self, file: str):
+        """
+        Stores the query stats recorded by the measured loads in a JSON run report.
+
+        :param file: (str) run report file path.
+        :return: void
+        """
+
+        with open(file, 'w', encoding='utf-8') as report_file:
+            json.dump({'report_type': self.report_type,
+                       'database': self.db_engine.url.render_as_string(hide_password=True),
+                       'queries': self.query_stats}, report_file, indent=2, default=str)
+
+    def _stream_query(self, query, parse_dates: list, dtypes: dict, chunksize: int):
+        """
+        Reads the result of a query in chunks through a server-side cursor.
+
+        :param query: (sqlalchemy.Select) query to execute.
+        :param parse_dates: (list) columns to parse as dates.
+        :param dtypes: (dict) pairs column - dtype applied to every chunk.
+        :param chunksize: (int) number of rows of each DataFrame chunk.
+        :return: (generator) DataFrame chunks.
+        """
+
+        with self.db_engine.connect().execution_options(stream_results=True) as connexion:
+            for chunk in pd.read_sql(sql=query, con=connexion, parse_dates=parse_dates, chunksize=chunksize):
+                yield compact_dtypes(dataframe=chunk, dtypes=dtypes)
+
+    @profiler.profile()
+    def merge_tables(self, max_fan_out: float = None, abort_on_fan_out=False, sorted_merges=False, memory_budget=None,
+                     spill_path=None):
+        """
+        Takes the merge plan built from the 'report_config.json' configuration file by 'load_db_tables' and translates
+        it into one single DataFrame per merge tree.
+
+        The fan-out of a merge is the number of resulting rows per left table row. It is estimated before each merge and
+        compared with the 'max_fan_out' field of the join in the configuration file or, if the join does not define it,
+        with the 'max_fan_out' parameter.
+
+        :param max_fan_out: (float) default maximum fan-out allowed per merge. None to allow any fan-out.
+        :param abort_on_fan_out: (bool) flag to raise a ValueError, instead of printing a warning, when a merge exceeds
+        its maximum fan-out.
+        :param sorted_merges: (bool) flag to merge on sorted indexes instead of hashing the join keys on every merge.
+        Each table is indexed by its merge key (and sorted, unless it was loaded ordered by it) and the index of a
+        parent table is reused by all the children merged on the same key. Merged tables come out ordered by their
+        master key.
+        :param memory_budget: (float) maximum MB of tables held in memory. When a merge tree is finished and the loaded
+        and merged tables exceed it, the finished merge trees are spilled to Feather files and they are read back once
+        every tree is merged. None to keep every table in memory.
+        :param spill_path: (str) folder of the spilled merge trees. None to use a temporary folder, removed once the
+        merge finishes or fails.
         :return: void
         """
 
-        self.list_of_tables = pd.read_json(os.path.join(self.config_path, self.db_config_file),
-                                           orient='records')[self.report_type]['table']
+        spilled = dict()
+        temporary_directory = None
+
+        try:
+            for tree in self.trees:
+                self._recursive_merge(tree=tree, max_fan_out=max_fan_out, abort_on_fan_out=abort_on_fan_out,
+                                      sorted_merges=sorted_merges)
+
+                # The merged master table is moved from 'tables' to 'merged_table'
+                merged_df = self.tables.pop(tree.node.position)
+
+                if self.table_keys.pop(tree.node.position, None) is not None:
+                    merged_df = merged_df.reset_index(drop=True)
+
+                self.merged_table.append(merged_df)
+
+                if (memory_budget is not None) and (self._get_memory_usage() > memory_budget):
+                    if spill_path is None:
+                        temporary_directory = tempfile.TemporaryDirectory(prefix='reports_spill_')
+                        spill_path = temporary_directory.name
+
+                    self._spill_merged_tables(spill_path=spill_path, spilled=spilled)
+
+            for index, file in spilled.items():
+                self.merged_table[index] = pd.read_feather(file)
+                os.remove(file)
+        finally:
+            if temporary_directory is not None:
+                temporary_directory.cleanup()
+
+        peak_rss = get_peak_rss_mb()
+        print('merged_trees={0} spilled_trees={1} peak_rss={2}'.format(
+            len(self.merged_table), len(spilled), '{0:.1f}MB'.format(peak_rss) if peak_rss is not None else 'unknown'))
+
+    def _get_memory_usage(self):
+        """
+        :return: (float) MB held by the loaded and merged tables in memory. DataFrames shared by several tables are
+        counted once.
+        """
 
-        # Loading tables from database
-        for aux_index, table in enumerate(self.list_of_tables):
-            """
-            table_indexes: position in which each table is located in the list variable 'list_of_tables'.
-            list_of_tables: list data structure used to allocate the database tables in DataFrame format.
-            """
-            self.table_indexes.append(table['name'])
-            self.list_of_tables[aux_index] = pd.read_sql_table(table_name=table['name'],
-                                                               con=self.mariadb_engine,
-                                                               columns=table['columns'],
-                                                               parse_dates=table['parse_dates'])
+        dataframes = {id(dataframe): dataframe for dataframe in list(self.tables.values()) + self.merged_table
+                      if isinstance(dataframe, pd.DataFrame)}
 
-            if table['master_table']:
-                self.master_table.append(table['name'])
+        return sum([dataframe.memory_usage(deep=True).sum() for dataframe in dataframes.values()]) / 2 ** 20
 
-    def merge_tables(self):
+    def _spill_merged_tables(self, spill_path: str, spilled: dict):
         """
-        Takes the instructions contained in the 'report_config.json' configuration file and translates it into one
-        single DataFrame taking into account the merge strategy specified in the previous configuration file.
+        Writes the merged trees held in memory to Feather files and releases them.
 
+        :param spill_path: (str) folder of the spilled merge trees.
+        :param spilled: (dict) pairs merge tree index - Feather file, updated with the spilled trees.
         :return: void
         """
 
-        table_params = pd.read_json(os.path.join(self.config_path, self.db_config_file),
-                                    orient='records')[self.report_type]['table']
+        os.makedirs(spill_path, exist_ok=True)
 
-        self.trees = create_tree(table_params)
+        for index, merged_df in enumerate(self.merged_table):
+            if index in spilled:
+                continue
+
+            file = os.path.join(spill_path, '{0}_{1}_{2}.feather'.format(self.report_type, index, os.getpid()))
+            merged_df.reset_index(drop=True).to_feather(file)
+
+            # The file path stands for the tree until it is read back
+            self.merged_table[index] = file
+            spilled[index] = file
+
+    def merge_partitions(self, partitions: int, max_processes=None, shard_function=None, max_fan_out: float = None,
+                         abort_on_fan_out=False, sorted_merges=False):
+        """
+        Parallel version of 'merge_tables'. The loaded tables are hash-partitioned by their merge keys into shards
+        (see '_get_partition_keys') and each shard is merged by 'merge_tables' in a process of a process pool:
+            - Master tables are partitioned by the key most of their joins are made on (the user id).
+            - Tables joined on the partition key of their parent are partitioned by their own join key, so all the rows
+            of a user land in the same shard.
+            - Any other table (e.g. 'country', joined on 'country_id') is copied, with its whole subtree, into every
+            shard.
+        Left merges of a partitioned table only match rows of its own shard, so concatenating the merged shards gives
+        the rows of 'merge_tables' (in a different order).
+
+        :param partitions: (int) number of shards.
+        :param max_processes: (int) maximum number of shards merged in parallel. None to use one process per core.
+        :param shard_function: (function) picklable function applied, in the same process, to the merged tables of each
+        shard (list of DataFrames, one per merge tree), so per-user work also runs in parallel and only its result is
+        sent back. None to send back the merged tables.
+        :param max_fan_out: (float) default maximum fan-out allowed per merge. None to allow any fan-out.
+        :param abort_on_fan_out: (bool) flag to raise a ValueError when a merge exceeds its maximum fan-out.
+        :param sorted_merges: (bool) flag to merge on sorted indexes.
+        :return: (list) result of every shard, in shard order: the output of 'shard_function' or the merged tables.
+        """
+
+        shards = [dict() for _ in range(partitions)]
 
         for tree in self.trees:
-            self._recursive_merge(tree=tree)
-            self.merged_table.append(self._get_table(self.master_table[0]))
+            for position, key in self._get_partition_keys(tree=tree).items():
+                dataframe = self._get_table(position)
+
+                if key is None:
+                    for shard in shards:
+                        shard[position] = dataframe
+                    continue
+
+                groups = dict(list(dataframe.groupby(get_shard_ids(keys=dataframe[key], partitions=partitions),
+                                                     sort=False)))
+                for shard_id, shard in enumerate(shards):
+                    shard[position] = groups.get(shard_id, dataframe.iloc[0:0])
+
+        # Shards hold their own copies of the tables, which are not needed anymore
+        self.tables = dict()
+
+        merge_options = {'max_fan_out': max_fan_out, 'abort_on_fan_out': abort_on_fan_out,
+                         'sorted_merges': sorted_merges}
+
+        with profiler.stage('merge_partitions', partitions=partitions):
+            with ProcessPoolExecutor(max_workers=max_processes) as executor:
+                futures = [executor.submit(_merge_partition, self.report_type, self.plan, shard, merge_options,
+                                           shard_function) for shard in shards]
 
-            # Drop table from list_of_tables, table_indexes and master_table
-            del self.list_of_tables[self.table_indexes.index(self.master_table[0])]
-            self.table_indexes.remove(self.master_table[0])
-            del self.master_table[0]
+                return [future.result() for future in futures]
 
-    def _recursive_merge(self, tree: Tree):
+    def _get_partition_keys(self, tree: Tree, key: str = None):
+        """
+        Chooses the column each table of a merge tree is partitioned by.
+
+        :param tree: (Tree) subtree whose tables are partitioned.
+        :param key: (str) partition key of the subtree root. None to choose it for a master table.
+        :return: (dict) pairs table position - partition key. The key is None for the tables copied into every shard.
+        """
+
+        if (key is None) and tree.node.master_table:
+            key = self.plan.get_sort_key(tree.node.position)
+
+        keys = {tree.node.position: key}
+
+        for child in tree.children:
+            join = self.plan.get_join(left_node=tree.node, right_node=child.node)
+            child_key = join['join_with_on'] if (key is not None) and (join['on'] == key) else None
+
+            if child_key is None:
+                # Unpartitioned tables are copied whole, so their whole subtree is copied too
+                keys.update({position: None for position in self._get_partition_keys(tree=child, key=None)})
+            else:
+                keys.update(self._get_partition_keys(tree=child, key=child_key))
+
+        return keys
+
+    def _recursive_merge(self, tree: Tree, max_fan_out: float = None, abort_on_fan_out=False, sorted_merges=False):
         """
         Replicates the tree's hierarchical merge structure using pandas DataFrames.
             - Tree nodes represent database tables.
@@ -108,101 +565,290 @@ class DatabaseReport:
         > master_table = merge(master_table & table_4)
         > end
 
+        The children of a node are merged in the order chosen by '_plan_merges': one-to-one children first, so they are
+        not replicated by the one-to-many ones. Columns are named and sorted as in the tree order, so the resultant
+        DataFrame does not depend on the merge order.
+
         :param tree: (Tree) object that contains the hierarchical structure to be replicated.
+        :param max_fan_out: (float) default maximum fan-out allowed per merge. None to allow any fan-out.
+        :param abort_on_fan_out: (bool) flag to raise a ValueError when a merge exceeds its maximum fan-out.
+        :param sorted_merges: (bool) flag to merge on sorted indexes.
         :return: void
         """
 
-        # Keep record of the parent subtree
-        parent = tree
+        # Children with their own children are merged recursively before being merged with their parent
+        for child in tree.children:
+            if len(child.children) > 0:
+                self._recursive_merge(tree=child, max_fan_out=max_fan_out, abort_on_fan_out=abort_on_fan_out,
+                                      sorted_merges=sorted_merges)
+
+        if len(tree.children) == 0:
+            return
+
+        columns, renames = self._get_merged_columns(tree=tree)
+        merges = self._plan_merges(tree=tree)
+
+        print('plan={0}[{1}] order={2}'.format(tree.node.name, tree.node.position,
+                                               ['{0}[{1}]:{2}'.format(merge['node'].name, merge['node'].position,
+                                                                      merge['cardinality']) for merge in merges]))
+
+        for merge in merges:
+            self._check_fan_out(left_node=tree.node, merge=merge, max_fan_out=max_fan_out,
+                                abort_on_fan_out=abort_on_fan_out)
+            self._merge_dataframes(left_node=tree.node, right_node=merge['node'],
+                                   renames=renames[merge['node'].position], estimated_fan_out=merge['fan_out'],
+                                   sorted_merges=sorted_merges)
+
+        merged_df = self._get_table(tree.node.position)
+        if list(merged_df.columns) != columns:
+            self._set_table(tree.node.position, merged_df.loc[:, columns])
+
+    def _plan_merges(self, tree: Tree):
+        """
+        Chooses the order in which the children of the tree root node are merged with it, from the key uniqueness and
+        row counts of the loaded tables:
+            - One-to-one children (unique join key in the child table) are merged first. They never add rows.
+            - One-to-many children are merged afterwards, in tree order, so the row order of the resultant DataFrame is
+            the same as merging them in tree order.
+
+        :param tree: (Tree) subtree whose root node merges are planned.
+        :return: (list) merges in execution order. Each merge is a dictionary with the keys:
+            - 'node': (Node) child node.
+            - 'join': (dict) join definition.
+            - 'cardinality': (str) 'one-to-one' or 'one-to-many'.
+            - 'fan_out': (float) estimated number of rows per left table row after the merge.
+        """
+
+        left_dataframe = self._get_table(tree.node.position)
+        merges = list()
 
-        # Visit all child nodes:
-        #   1) If child node is a leaf node, then merge parent node with child node
-        #   2) If child node is a root node, then:
-        #       2.1) Merge recursively all its children.
-        #       2.2) Merge parent node with child node
         for child in tree.children:
-            if len(child.children) == 0:
-                self._merge_dataframes(left_node=parent.node, right_node=child.node)
-                parent.children = parent.children[1:]
+            join = self.plan.get_join(left_node=tree.node, right_node=child.node)
+            right_keys = self._get_table(child.node.position)[join['join_with_on']]
+
+            if right_keys.is_unique:
+                cardinality, fan_out = 'one-to-one', 1.0
             else:
-                self._recursive_merge(child)
-                self._merge_dataframes(left_node=parent.node, right_node=child.node)
+                # Left rows without any match are kept once by the left merge
+                matches = left_dataframe[join['on']].map(right_keys.value_counts()).fillna(1).clip(lower=1)
+                cardinality, fan_out = 'one-to-many', float(matches.sum()) / max(left_dataframe.shape[0], 1)
+
+            merges.append({'node': child.node, 'join': join, 'cardinality': cardinality, 'fan_out': fan_out})
+
+        return sorted(merges, key=lambda merge: merge['cardinality'] != 'one-to-one')
+
+    def _check_fan_out(self, left_node: Node, merge: dict, max_fan_out: float = None, abort_on_fan_out=False):
+        """
+        Compares the estimated fan-out of a merge with its maximum fan-out.
+
+        :param left_node: (Node) that represents the left side of the merge.
+        :param merge: (dict) merge from the merges planned by '_plan_merges'.
+        :param max_fan_out: (float) default maximum fan-out, used when the join does not define its own.
+        :param abort_on_fan_out: (bool) flag to raise a ValueError instead of printing a warning.
+        :return: void
+        """
+
+        max_fan_out = merge['join'].get('max_fan_out', max_fan_out)
+
+        if (max_fan_out is None) or (merge['fan_out'] <= max_fan_out):
+            return
+
+        message = "Merge of '{0}' (position {1}) with '{2}' (position {3}) has a fan-out of {4:.2f} rows per row, " \
+                  "above the maximum of {5}".format(left_node.name, left_node.position, merge['node'].name,
+                                                    merge['node'].position, merge['fan_out'], max_fan_out)
+
+        if abort_on_fan_out:
+            raise ValueError(message)
+
+        print('WARNING: ' + message)
+
+    def _get_merged_columns(self, tree: Tree):
+        """
+        Calculates the columns that merging the children of the tree root node in tree order would produce, so merges
+        can be run in any order: overlapping child columns get the '_<child table>' suffix and merge keys with the same
+        name are stored only once.
+
+        :param tree: (Tree) subtree whose root node merges are calculated.
+        :return: (list, dict) merged columns in tree order and pairs child node position - columns to rename.
+        """
+
+        columns = list(self._get_table(tree.node.position).columns)
+        renames = dict()
+
+        for child in tree.children:
+            join = self.plan.get_join(left_node=tree.node, right_node=child.node)
+            child_columns = [name for name in self._get_table(child.node.position).columns
+                             if (join['on'] != join['join_with_on']) or (name != join['join_with_on'])]
+
+            rename = {name: name + '_' + child.node.name for name in child_columns if name in columns}
+            columns.extend([rename.get(name, name) for name in child_columns])
+            renames[child.node.position] = rename
+
+        return columns, renames
 
-    def _merge_dataframes(self, left_node: Node, right_node: Node):
+    def _merge_dataframes(self, left_node: Node, right_node: Node, renames: dict = None, estimated_fan_out=None,
+                          sorted_merges=False):
         """
-        Merges the tables received as parameters and updates 'list_of_tables' with the resultant DataFrame.
+        Merges the tables received as parameters and updates 'tables' with the resultant DataFrame.
 
         :param left_node: (Node) that represents the left side of the merge.
         :param right_node: (Node) that represents the object to merge with.
+        :param renames: (dict) right table columns to rename before the merge, as calculated by '_get_merged_columns'.
+        :param estimated_fan_out: (float) fan-out estimated by '_plan_merges', reported with the observed one.
+        :param sorted_merges: (bool) flag to merge on the sorted indexes built by '_index_table'.
         :return: void
         """
 
-        left_dataframe = self._get_table(left_node.name)
-        right_dataframe = self._get_table(right_node.name)
+        with profiler.stage('merge', left=left_node.name, right=right_node.name,
+                            positions=[left_node.position, right_node.position]) as record:
+            start = time.perf_counter()
 
-        join_id = 0
-        while left_node.inner_joins[join_id]['join_with'] != right_node.name:
-            join_id += 1
+            join = self.plan.get_join(left_node=left_node, right_node=right_node)
 
-        merged_df = left_dataframe.merge(right_dataframe,
-                                         how='left',
-                                         left_on=left_node.inner_joins[join_id]['on'],
-                                         right_on=left_node.inner_joins[join_id]['join_with_on'],
-                                         suffixes=(None, "_" + right_node.name))
-        self._set_table(left_node.name, merged_df)
+            if sorted_merges:
+                # Merge keys with the same name are stored only once, so the right one is only kept as index
+                left_dataframe = self._index_table(position=left_node.position, key=join['on'], drop=False)
+                right_dataframe = self._index_table(position=right_node.position, key=join['join_with_on'],
+                                                    drop=join['on'] == join['join_with_on'])
+            else:
+                left_dataframe = self._get_table(left_node.position)
+                right_dataframe = self._get_table(right_node.position)
+
+            right_on = join['join_with_on']
 
-    def _get_table(self, table_name: str):
-        return self.list_of_tables[self.table_indexes.index(table_name)]
+            if renames:
+                right_dataframe = right_dataframe.rename(columns=renames)
+                right_on = renames.get(right_on, right_on)
 
-    def _set_table(self, table_name: str, table: pd.DataFrame):
-        self.list_of_tables[self.table_indexes.index(table_name)] = table
+            if sorted_merges:
+                merged_df = left_dataframe.merge(right_dataframe,
+                                                 how='left',
+                                                 left_index=True,
+                                                 right_index=True,
+                                                 suffixes=(None, "_" + right_node.name))
+            else:
+                merged_df = left_dataframe.merge(right_dataframe,
+                                                 how='left',
+                                                 left_on=join['on'],
+                                                 right_on=right_on,
+                                                 suffixes=(None, "_" + right_node.name))
+            self._set_table(left_node.position, merged_df)
+            record['rows_in'], record['rows_out'] = left_dataframe.shape[0], merged_df.shape[0]
+
+            # The child table has been consumed, so it is released as soon as it is merged
+            self.tables.pop(right_node.position)
+            self.table_keys.pop(right_node.position, None)
+
+        timing = {'left': left_node.name,
+                  'right': right_node.name,
+                  'positions': [left_node.position, right_node.position],
+                  'left_rows': left_dataframe.shape[0],
+                  'right_rows': right_dataframe.shape[0],
+                  'rows': merged_df.shape[0],
+                  'estimated_fan_out': estimated_fan_out,
+                  'fan_out': merged_df.shape[0] / max(left_dataframe.shape[0], 1),
+                  'seconds': time.perf_counter() - start}
+        self.merge_timings.append(timing)
+
+        print('merge={0}<-{1} positions={2} left_rows={3} right_rows={4} rows={5} fan_out={6:.2f} '
+              'seconds={7:.3f}'.format(timing['left'], timing['right'], timing['positions'], timing['left_rows'],
+                                       timing['right_rows'], timing['rows'], timing['fan_out'], timing['seconds']))
+
+    def _index_table(self, position: int, key: str, drop=False):
+        """
+        Indexes a table by a merge key, sorting it if it was not loaded ordered by the key. Left tables keep the index
+        in 'tables', so it is built only once for all the children merged on the same key.
 
+        :param position: (int) position of the table in the 'report_config.json' configuration file.
+        :param key: (str) merge key.
+        :param drop: (bool) flag to remove the key column once it is the index.
+        :return: (DataFrame) table indexed by the key.
+        """
 
-def create_tree(table_params):
-    """
+        if (self.table_keys.get(position) == key) and not drop:
+            return self._get_table(position)
+
+        dataframe = self._get_table(position).set_index(key, drop=drop)
+        dataframe.index.name = None
+
+        if not dataframe.index.is_monotonic_increasing:
+            dataframe = dataframe.sort_index(kind='mergesort')
+
+        if not drop:
+            self._set_table(position, dataframe)
+            self.table_keys[position] = key
+
+        return dataframe
+
+    def _get_table(self, position: int):
+        return self.tables[position]
 
+    def _set_table(self, position: int, table: pd.DataFrame):
+        self.tables[position] = table
 
-    :param table_params:
-    :return:
+
+def get_shard_ids(keys: pd.Series, partitions: int):
     """
+    Hash-partitions a column of merge keys. Equal keys get the same shard in every table, even when they are stored
+    with different numeric dtypes (e.g. 'id' as int64 and 'user_id' as float64 because of its null values).
 
-    # Skeleton definition
-    #   1) Root nodes creation
-    #   2) Branch and leaf nodes creation
-    nodes = list()
-    tree_nodes = list()
-    trees = list()
+    :param keys: (Series) merge keys.
+    :param partitions: (int) number of shards.
+    :return: (Series) shard of every key, from 0 to 'partitions' - 1. Null keys go to the shard 0.
+    """
 
-    for table in table_params:
-        node = Node(name=table['name'],
-                    columns=table['columns'],
-                    master_table=table['master_table'],
-                    inner_joins=table['inner_joins'])
+    if pd.api.types.is_numeric_dtype(keys):
+        return (keys.fillna(0) % partitions).astype('int64')
 
-        if table['master_table']:
-            tree = Tree(node=node)
-            tree_nodes.append(tree)
+    return (pd.util.hash_pandas_object(keys.astype('string'), index=False) % partitions).astype('int64')
 
-        else:
-            nodes.append(node)
 
-    # Trees composition
-    #   1) For each Tree in trees, recursively add all its child nodes
-    for tree in tree_nodes:
-        trees.append(_recursive_node_addition(tree=tree, joins=tree.node.inner_joins, parent_node=tree.node, node_list=nodes))
+def _merge_partition(report_type: str, plan: MergePlan, tables: dict, merge_options: dict, shard_function=None):
+    """
+    Merges one shard of 'DatabaseReport.merge_partitions' in a worker process.
+
+    :param report_type: (str) report configuration type of the 'report_config.json' configuration file.
+    :param plan: (MergePlan) merge plan of the loaded tables.
+    :param tables: (dict) pairs table position - shard of the table.
+    :param merge_options: (dict) keyword arguments of 'merge_tables'.
+    :param shard_function: (function) function applied to the merged tables. None to return them.
+    :return: output of 'shard_function' or merged tables of the shard.
+    """
+
+    report = DatabaseReport(report_type=report_type)
+    report.plan = plan
+    report.trees = plan.trees
+    report.tables = tables
 
-    return trees
+    report.merge_tables(**merge_options)
 
+    if shard_function is None:
+        return report.merged_table
 
-def _recursive_node_addition(tree: Tree, joins: list, parent_node: Node, node_list: list):
-    for join in joins:
-        node = get_node(node_list=node_list, node_name=join['join_with'])
+    return shard_function(report.merged_table)
 
-        if len(node.inner_joins) == 0:
-            add_node(tree=tree, node=node, parent_node=parent_node)
 
+def compact_dtypes(dataframe: pd.DataFrame, dtypes: dict):
+    """
+    Casts the DataFrame columns to the compact dtypes given in the 'dtypes' field of the 'report_config.json'
+    configuration file. Columns not present in the DataFrame are ignored.
+
+    :param dataframe: (DataFrame) table to cast.
+    :param dtypes: (dict) pairs column - dtype. Any pandas dtype is accepted ('Int8', 'boolean', 'category',
+    'string[pyarrow]', etc.) and also 'downcast', which casts integer columns to the smallest integer dtype that holds
+    their values (columns with null values are kept as they are).
+        :example: {'user_id': 'downcast', 'emailConfirmed': 'Int8', 'given_to': 'category'}
+    :return: (DataFrame) casted table.
+    """
+
+    for column_name, dtype in dtypes.items():
+        if column_name not in dataframe.columns:
+            continue
+
+        if dtype == 'downcast':
+            dataframe[column_name] = pd.to_numeric(dataframe[column_name], downcast='integer')
         else:
-            add_node(tree=tree, node=node, parent_node=parent_node)
-            _recursive_node_addition(tree=tree, joins=node.inner_joins, parent_node=node, node_list=node_list)
+            dataframe[column_name] = dataframe[column_name].astype(dtype)
+
+    return dataframe
 
-    return tree
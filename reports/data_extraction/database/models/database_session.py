@@ -0,0 +1,79 @@
+import os
+import pandas as pd
+from reports.data_extraction.database.utils.backends import get_backend
+from reports.data_extraction.database.utils.merge_plan import MergePlan
+
+
+class DatabaseSession:
+    """
+    Long-lived state shared by all the reports generated in a process: the database backend, its engine (and pool),
+    the parsed 'report_config.json' configuration file and the merge plan of every report type. Reports created with a
+    session skip reading the configuration files, creating the engine and connecting again.
+
+    Every report type is validated (see 'MergePlan') when the session is created, so a wrong configuration file fails
+    before any table is loaded.
+    """
+
+    config_path = os.path.join(os.path.dirname(__file__), "../config")
+    db_config_file = "report_config.json"
+    credentials_file = "db_access_credentials.json"
+
+    # default constructor
+    def __init__(self, db_name='local_backup', db_url=None, pool_size=5):
+        self.db_name = db_name
+        self.db_url = db_url
+
+        self.backend = get_backend(credentials_file=os.path.join(self.config_path, self.credentials_file),
+                                   db_name=db_name, db_url=db_url)
+        self.db_engine = self.backend.create_engine(pool_size=pool_size)
+
+        self.table_params = dict()
+        self.plans = dict()
+        self.pruned_plans = dict()
+
+        config = pd.read_json(os.path.join(self.config_path, self.db_config_file), orient='records')
+
+        for report_type in config.columns:
+            self.table_params[report_type] = list(config[report_type]['table'])
+            self.plans[report_type] = MergePlan(table_params=self.table_params[report_type])
+
+    def get_table_params(self, report_type: str):
+        """
+        :param report_type: (str) report configuration type of the 'report_config.json' configuration file.
+        :return: (list) table parameters of the report type.
+        """
+
+        if report_type not in self.table_params:
+            raise ValueError("Report type '{0}' is not defined in '{1}'".format(report_type, self.db_config_file))
+
+        return self.table_params[report_type]
+
+    def get_plan(self, report_type: str, required_columns: list = None):
+        """
+        :param report_type: (str) report configuration type of the 'report_config.json' configuration file.
+        :param required_columns: (list) merged columns consumed by the report, one list per merge tree (see
+        'MergePlan.prune'). Pruned plans are built once per set of required columns. None to get the whole plan.
+        :return: (MergePlan) merge plan of the report type.
+        """
+
+        if report_type not in self.plans:
+            raise ValueError("Report type '{0}' is not defined in '{1}'".format(report_type, self.db_config_file))
+
+        if required_columns is None:
+            return self.plans[report_type]
+
+        key = (report_type, tuple([tuple(columns) if columns is not None else None for columns in required_columns]))
+
+        if key not in self.pruned_plans:
+            self.pruned_plans[key] = self.plans[report_type].prune(required_columns=required_columns)
+
+        return self.pruned_plans[key]
+
+    def close(self):
+        """
+        Closes every connexion of the engine pool.
+
+        :return: void
+        """
+
+        self.db_engine.dispose()
@@ -8,11 +8,13 @@ class Node:
     def __init__(self, name: str,
                  columns: list,
                  master_table: int,
-                 inner_joins: list):
+                 inner_joins: list,
+                 position: int = None):
         self.name = name
         self.columns = columns
         self.master_table = master_table
         self.inner_joins = inner_joins
+        self.position = position
 
 
 def add_node(tree: Tree, node: Node, parent_node: Node):
@@ -0,0 +1,256 @@
+import glob
+import os
+import pandas as pd
+from sqlalchemy import create_engine, event
+
+
+class DatabaseBackend:
+    """
+    Database engine the 'report_config.json' plans are run against. Each backend is configured by one entry of the
+    'db_access_credentials.json' file, whose 'backend' field selects the backend class ('mariadb' if it is missing):
+        - mariadb: production server. Fields: 'user', 'password', 'server_url', 'port', 'schema' and
+        'authentication_plugin'.
+        - sqlite: local replica in a SQLite file. Fields: 'file'.
+        - duckdb: embedded DuckDB database. Fields: 'file' (optional, in-memory database if it is missing) and
+        'parquet_path' (optional), a folder with one '[table].parquet' file (or '[table]' folder of Parquet files) per
+        database table, exposed as views. Requires the 'duckdb_engine' package.
+
+    Every backend can also read query results as Arrow data ('read_arrow') instead of through the DBAPI driver rows.
+    """
+
+    # default constructor
+    def __init__(self, settings: dict):
+        self.settings = settings
+
+    def create_engine(self, pool_size=5):
+        """
+        :param pool_size: (int) number of connexions kept open in the engine pool, for the backends that use one.
+        :return: (sqlalchemy.Engine) engine connected to the database.
+        """
+
+        raise NotImplementedError
+
+    def read_arrow(self, engine, query, parse_dates: list = None):
+        """
+        Reads the result of a query as Arrow record batches, so no Python object is created per value, and hands them
+        to pandas as pyarrow-backed columns. Requires the 'connectorx' package.
+
+        :param engine: (sqlalchemy.Engine) engine created by the backend.
+        :param query: (sqlalchemy.Select) query to execute. Its parameters are rendered as SQL literals.
+        :param parse_dates: (list) columns to parse as dates, unless the database already returns them as timestamps.
+        None to omit them.
+        :return: (DataFrame) result of the query.
+        """
+
+        import connectorx
+
+        arrow_table = connectorx.read_sql(conn=self.get_arrow_url(engine), query=_compile(engine.dialect, query),
+                                          return_type='arrow')
+
+        return arrow_to_pandas(arrow_table=arrow_table, parse_dates=parse_dates)
+
+    def get_arrow_url(self, engine):
+        """
+        :param engine: (sqlalchemy.Engine) engine created by the backend.
+        :return: (str) connexion URL of the database in the 'connectorx' format.
+        """
+
+        return engine.url.set(drivername=engine.url.get_backend_name()).render_as_string(hide_password=False)
+
+    def get_sql(self, engine, query):
+        """
+        :param engine: (sqlalchemy.Engine or sqlalchemy.Connection) engine or connexion the query is run on.
+        :param query: (sqlalchemy.Select) query to compile.
+        :return: (str) SQL text of the query, with its parameters rendered as literals.
+        """
+
+        return _compile(engine.dialect, query)
+
+    def explain(self, connexion, query):
+        """
+        Gets the execution plan chosen by the database for a query.
+
+        :param connexion: (sqlalchemy.Connection) open connexion to the database.
+        :param query: (sqlalchemy.Select) query to explain.
+        :return: (list) rows of the EXPLAIN output, as dictionaries.
+        """
+
+        prefix = EXPLAIN_PREFIXES.get(connexion.dialect.name, 'EXPLAIN ')
+        result = connexion.exec_driver_sql(prefix + self.get_sql(connexion, query))
+
+        return [dict(row._mapping) for row in result]
+
+    def get_bytes_received(self, connexion):
+        """
+        :param connexion: (sqlalchemy.Connection) open connexion to the database.
+        :return: (int) bytes received by the client through the connexion so far. None if the database does not
+        report them (only MariaDB/MySQL servers do).
+        """
+
+        if connexion.dialect.name not in ['mysql', 'mariadb']:
+            return None
+
+        # Session counter of the server, so it only counts the traffic of this connexion
+        row = connexion.exec_driver_sql("SHOW SESSION STATUS LIKE 'Bytes_sent'").fetchone()
+
+        return int(row[1]) if row is not None else None
+
+
+class MariaDBBackend(DatabaseBackend):
+
+    def create_engine(self, pool_size=5):
+        connexion = 'mysql+mysqlconnector://{0}:{1}@{2}:{3}/{4}?auth_plugin={5}'
+        connexion = connexion.format(self.settings['user'],
+                                     self.settings['password'],
+                                     self.settings['server_url'],
+                                     self.settings['port'],
+                                     self.settings['schema'],
+                                     self.settings['authentication_plugin'])
+
+        return create_engine(connexion, pool_size=pool_size, pool_pre_ping=True)
+
+
+class SQLiteBackend(DatabaseBackend):
+
+    def create_engine(self, pool_size=5):
+        return create_engine('sqlite:///' + os.path.abspath(self.settings['file']))
+
+    def get_arrow_url(self, engine):
+        return 'sqlite://' + os.path.abspath(engine.url.database)
+
+
+class DuckDBBackend(DatabaseBackend):
+
+    def create_engine(self, pool_size=5):
+        file = self.settings.get('file', ':memory:')
+        if file != ':memory:':
+            file = os.path.abspath(file)
+
+        engine = create_engine('duckdb:///' + file)
+
+        if self.settings.get('parquet_path') is not None:
+            views = _get_parquet_views(self.settings['parquet_path'])
+
+            # Views live in the connexion catalog, so every new connexion of the pool gets them
+            @event.listens_for(engine, 'connect')
+            def create_views(dbapi_connexion, connexion_record):
+                cursor = dbapi_connexion.cursor()
+                for table_name, source in views.items():
+                    cursor.execute("CREATE OR REPLACE VIEW \"{0}\" AS SELECT * FROM read_parquet('{1}')".format(
+                        table_name, source.replace("'", "''")))
+                cursor.close()
+
+        return engine
+
+    def read_arrow(self, engine, query, parse_dates: list = None):
+        # DuckDB produces Arrow natively. The query is run on a connexion of the pool, which holds the Parquet views
+        connexion = engine.raw_connection()
+
+        try:
+            arrow_table = connexion.driver_connection.execute(_compile(engine.dialect, query)).fetch_arrow_table()
+        finally:
+            connexion.close()
+
+        return arrow_to_pandas(arrow_table=arrow_table, parse_dates=parse_dates)
+
+
+class UrlBackend(DatabaseBackend):
+    """
+    Any database given by its SQLAlchemy URL (settings field 'url').
+    """
+
+    def create_engine(self, pool_size=5):
+        return create_engine(self.settings['url'])
+
+
+# Statement prefixes that return the execution plan of a query, by SQLAlchemy dialect ('EXPLAIN ' by default)
+EXPLAIN_PREFIXES = {'sqlite': 'EXPLAIN QUERY PLAN '}
+
+BACKENDS = {'mariadb': MariaDBBackend,
+            'sqlite': SQLiteBackend,
+            'duckdb': DuckDBBackend,
+            'url': UrlBackend}
+
+
+def get_backend(credentials_file: str, db_name='local_backup', db_url=None):
+    """
+    Gets the backend of a database.
+
+    :param credentials_file: (str) path of the 'db_access_credentials.json' file.
+    :param db_name: (str) entry of the credentials file that configures the backend.
+    :param db_url: (str) SQLAlchemy URL of the database, used instead of the credentials file. None to omit it.
+    :return: (DatabaseBackend) database backend.
+    """
+
+    if db_url is not None:
+        return UrlBackend({'url': db_url})
+
+    credentials = pd.read_json(credentials_file, orient='index')
+
+    if db_name not in credentials.index:
+        raise ValueError("Database '{0}' is not defined in '{1}'".format(db_name, credentials_file))
+
+    settings = credentials.loc[db_name].dropna().to_dict()
+    backend = settings.get('backend', 'mariadb')
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend '{0}' for database '{1}'. Valid backends: {2}".format(
+            backend, db_name, list(BACKENDS.keys())))
+
+    return BACKENDS[backend](settings)
+
+
+def arrow_to_pandas(arrow_table, parse_dates: list = None):
+    """
+    Converts an Arrow table into a DataFrame whose columns keep the Arrow buffers (pyarrow-backed dtypes) instead of
+    being copied into numpy arrays or Python objects.
+
+    :param arrow_table: (pyarrow.Table) table to convert.
+    :param parse_dates: (list) columns to parse as dates, unless they already are Arrow timestamps or dates. None to
+    omit them.
+    :return: (DataFrame) converted table.
+    """
+
+    import pyarrow
+
+    dataframe = arrow_table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    for name in parse_dates or list():
+        if name not in arrow_table.column_names:
+            continue
+
+        arrow_type = arrow_table.schema.field(name).type
+        if not (pyarrow.types.is_timestamp(arrow_type) or pyarrow.types.is_date(arrow_type)):
+            dataframe[name] = pd.to_datetime(dataframe[name])
+
+    return dataframe
+
+
+def _compile(dialect, query):
+    """
+    :param dialect: (sqlalchemy.Dialect) dialect of the database the query is run on.
+    :param query: (sqlalchemy.Select) query to compile.
+    :return: (str) SQL text of the query in the dialect, with its parameters rendered as literals.
+    """
+
+    return str(query.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def _get_parquet_views(parquet_path: str):
+    """
+    Finds the Parquet sources of the database tables: '[table].parquet' files and '[table]' folders of Parquet files.
+
+    :param parquet_path: (str) folder with the Parquet sources.
+    :return: (dict) pairs table name - Parquet file or glob pattern.
+    """
+
+    views = dict()
+
+    for file in glob.glob(os.path.join(parquet_path, '*.parquet')):
+        views[os.path.splitext(os.path.basename(file))[0]] = os.path.abspath(file)
+
+    for folder in glob.glob(os.path.join(parquet_path, '*', '')):
+        if len(glob.glob(os.path.join(folder, '*.parquet'))) > 0:
+            views[os.path.basename(os.path.normpath(folder))] = os.path.join(os.path.abspath(folder), '*.parquet')
+
+    return views
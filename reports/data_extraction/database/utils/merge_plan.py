@@ -0,0 +1,231 @@
+from reports.data_extraction.database.utils.Tree import Tree, Node, depth_first_search
+
+
+class MergePlan:
+    """
+    Merge strategy of a report type, as defined in the 'report_config.json' configuration file.
+
+    Every table of the configuration file is a node identified by its position in the file, so the same database table
+    can appear several times (e.g. 'users') without being mistaken for another of its appearances. Master tables are the
+    roots of the merge trees and the rest of the tables are attached to them following the 'inner_joins' definitions.
+    A join targets the only non-master table with the 'join_with' name.
+
+    The plan is validated while it is built. A ValueError is raised when:
+        - A join targets a table that does not exist or that is defined more than once as non-master table.
+        - A table is joined by more than one table.
+        - The joins contain a cycle.
+    """
+
+    # default constructor
+    def __init__(self, table_params: list):
+        self.table_params = table_params
+
+        self.nodes = dict()
+        self.subtrees = dict()
+        self.parents = dict()
+        self.joins = dict()
+        self.trees = list()
+
+        self._joinable_nodes = dict()
+
+        self._create_nodes()
+        self._create_trees()
+
+    def get_node(self, position: int):
+        """
+        :param position: (int) node identifier (position of the table in the 'report_config.json' configuration file).
+        :return: (Node) node.
+        """
+
+        return self.nodes[position]
+
+    def get_subtree(self, position: int):
+        """
+        :param position: (int) node identifier (position of the table in the 'report_config.json' configuration file).
+        :return: (Tree) subtree whose root is the node.
+        """
+
+        return self.subtrees[position]
+
+    def get_join(self, left_node: Node, right_node: Node):
+        """
+        Gets the join definition that links a parent node with one of its children.
+
+        :param left_node: (Node) parent node.
+        :param right_node: (Node) child node.
+        :return: (dict) join definition as it appears in the 'inner_joins' list of the parent node.
+        """
+
+        return self.joins[(left_node.position, right_node.position)]
+
+    def get_sort_key(self, position: int):
+        """
+        Gets the column a table is best sorted by for merging: the key it is joined on by its parent or, for master
+        tables, the key most of its joins are made on.
+
+        :param position: (int) node identifier (position of the table in the 'report_config.json' configuration file).
+        :return: (str) sort key. None if the table is not joined at all.
+        """
+
+        node = self.nodes[position]
+
+        if position in self.parents:
+            return self.joins[(self.parents[position], position)]['join_with_on']
+
+        keys = [join['on'] for join in node.inner_joins]
+
+        return max(keys, key=keys.count) if len(keys) > 0 else None
+
+    def get_merged_columns(self, tree: Tree):
+        """
+        Calculates the columns of the DataFrame that merging a subtree in tree order produces: when a child column
+        already exists in its parent, it gets the '_<child table>' suffix, and merge keys with the same name are stored
+        only once.
+
+        :param tree: (Tree) subtree whose merged columns are calculated.
+        :return: (list) tuples (output name, source node position, source column name).
+        """
+
+        node = tree.node
+
+        columns = [(name, node.position, name) for name in node.columns]
+
+        for child in tree.children:
+            join = self.get_join(left_node=node, right_node=child.node)
+            child_columns = self.get_merged_columns(tree=child)
+
+            # Merge keys with the same name are stored only once
+            if join['on'] == join['join_with_on']:
+                child_columns = [column_tuple for column_tuple in child_columns if column_tuple[0] != join['on']]
+
+            names = [name for name, _, _ in columns]
+            columns.extend([(name + '_' + child.node.name if name in names else name, position, source)
+                            for name, position, source in child_columns])
+
+        return columns
+
+    def prune(self, required_columns: list):
+        """
+        Builds the plan of a report that only consumes some of the merged columns, so the rest are neither loaded nor
+        merged. A table keeps a column when:
+            - It is the source of a required merged column.
+            - It is a merge key or the watermark of the table.
+            - Its name is shared with another column of the merge tree. Removing it would change the '_<child table>'
+            suffixes of the merged columns, so the required ones would not be found.
+
+        :param required_columns: (list) merged columns consumed by the report, one list per merge tree in the
+        'report_config.json' order. None, for the whole list or for a merge tree, to keep every column.
+            :example: [['id', 'age', 'name'], None]
+        :return: (MergePlan) pruned plan. The plan itself if there is nothing to prune.
+        """
+
+        if required_columns is None:
+            return self
+
+        table_params = [dict(table_param) for table_param in self.table_params]
+
+        for tree, required in zip(self.trees, required_columns):
+            if required is None:
+                continue
+
+            merged_columns = self.get_merged_columns(tree=tree)
+            names = [source for _, _, source in merged_columns]
+            names.extend([name for name, _, source in merged_columns if name != source])
+
+            kept = dict()
+            for name, position, source in merged_columns:
+                if (name in required) or (names.count(source) > 1):
+                    kept.setdefault(position, set()).add(source)
+
+            positions = list()
+            depth_first_search(tree, lambda node: positions.append(node.position))
+
+            for position in positions:
+                table_param = table_params[position]
+                keys = set(kept.get(position, set()))
+                keys.update([join['on'] for join in table_param['inner_joins']])
+                keys.add(table_param.get('watermark'))
+
+                if position in self.parents:
+                    keys.add(self.joins[(self.parents[position], position)]['join_with_on'])
+
+                table_param['columns'] = [name for name in table_param['columns'] if name in keys]
+                table_param['parse_dates'] = [name for name in table_param['parse_dates'] or list() if name in keys] \
+                    or None
+
+        if all([table_param['columns'] == original['columns']
+                for table_param, original in zip(table_params, self.table_params)]):
+            return self
+
+        return MergePlan(table_params=table_params)
+
+    def _create_nodes(self):
+        """
+        Creates one node per table of the configuration file and indexes the non-master ones by name.
+
+        :return: void
+        """
+
+        for position, table in enumerate(self.table_params):
+            node = Node(name=table['name'],
+                        columns=table['columns'],
+                        master_table=table['master_table'],
+                        inner_joins=table['inner_joins'],
+                        position=position)
+
+            self.nodes[position] = node
+
+            if not table['master_table']:
+                self._joinable_nodes.setdefault(node.name, list()).append(node)
+
+    def _create_trees(self):
+        """
+        Creates one merge tree per master table and attaches to it, recursively, every joined table.
+
+        :return: void
+        """
+
+        for node in self.nodes.values():
+            if node.master_table:
+                tree = Tree(node=node)
+                self.subtrees[node.position] = tree
+                self.trees.append(tree)
+
+                self._add_children(tree=tree, ancestors={node.position})
+
+    def _add_children(self, tree: Tree, ancestors: set):
+        """
+        Attaches to a subtree all the tables joined by its root node.
+
+        :param tree: (Tree) subtree whose children are added.
+        :param ancestors: (set) positions of the nodes in the path from the tree root to the subtree root.
+        :return: void
+        """
+
+        parent_node = tree.node
+
+        for join in parent_node.inner_joins:
+            candidates = self._joinable_nodes.get(join['join_with'], list())
+
+            if len(candidates) != 1:
+                raise ValueError("Table '{0}' (position {1}) joins '{2}', which is defined {3} times as non-master "
+                                 "table".format(parent_node.name, parent_node.position, join['join_with'],
+                                                len(candidates)))
+
+            node = candidates[0]
+
+            if node.position in ancestors:
+                raise ValueError("Cycle found: table '{0}' (position {1}) joins its ancestor '{2}'".format(
+                    parent_node.name, parent_node.position, node.name))
+
+            if node.position in self.parents:
+                raise ValueError("Table '{0}' is joined by more than one table".format(node.name))
+
+            subtree = Tree(node=node)
+            tree.children.append(subtree)
+
+            self.subtrees[node.position] = subtree
+            self.parents[node.position] = parent_node.position
+            self.joins[(parent_node.position, node.position)] = join
+
+            self._add_children(tree=subtree, ancestors=ancestors | {node.position})
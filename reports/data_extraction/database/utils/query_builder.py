@@ -0,0 +1,297 @@
+import operator
+from sqlalchemy import and_, or_, select, table, column
+from reports.data_extraction.database.utils.Tree import Tree, Node, depth_first_search
+from reports.data_extraction.database.utils.merge_plan import MergePlan
+
+
+# Operators accepted in the 'operator' field of a filter spec
+OPERATORS = {'==': operator.eq,
+             '!=': operator.ne,
+             '<': operator.lt,
+             '<=': operator.le,
+             '>': operator.gt,
+             '>=': operator.ge,
+             'in': lambda sql_column, value: sql_column.in_(value)}
+
+
+class QueryBuilder:
+    """
+    Translates the merge trees defined in 'report_config.json' into the SQL statements used to load each table.
+
+    A filter spec is a list of predicates over the database tables:
+        [{'table': 'users', 'column': 'created_at', 'operator': '>=', 'value': start_date},
+         {'table': 'user_given_to', 'column': 'given_at', 'operator': '<=', 'value': end_date, 'keep_unmatched': True}]
+
+    Every predicate is pushed down to the WHERE clause of all the tree nodes that load its table. Then, restrictions
+    are propagated along the tree joins as semi-joins:
+        - Upwards: a parent only keeps the rows that have at least one matching child row. If every predicate of a
+        child has 'keep_unmatched' set to True, parent rows without any child row are also kept (as in the left merge,
+        where they would get null values).
+        - Downwards: a child only keeps the rows that match one of the (already restricted) parent rows.
+    """
+
+    # default constructor
+    def __init__(self, plan: MergePlan, filters: list = None):
+        self.plan = plan
+        self.trees = plan.trees
+        self.filters = filters if filters is not None else list()
+
+        self.tables = dict()
+        self.restrictions = dict()
+
+        self._create_tables()
+
+        for tree in self.trees:
+            self._upward_restrictions(tree=tree)
+            self._downward_restrictions(tree=tree, parent_tree=None)
+
+    def get_query(self, table_name: str, columns: list, position: int):
+        """
+        Builds the SELECT statement that loads a table with all its restrictions.
+
+        :param table_name: (str) name of the database table.
+        :param columns: (list) columns to load.
+        :param position: (int) position of the table in the 'report_config.json' configuration file.
+        :return: (sqlalchemy.Select) query to execute.
+        """
+
+        sql_table = self.tables[table_name]
+        query = select(*[sql_table.c[name] for name in columns])
+
+        clauses = [clause for clause, _ in self.restrictions.get(position, list())]
+        if len(clauses) > 0:
+            query = query.where(and_(*clauses))
+
+        return query
+
+    def get_tree_query(self, tree: Tree, table_params: list):
+        """
+        Compiles a whole merge tree into one SELECT statement with a LEFT JOIN per tree branch, so the merge is run by
+        the database. Each node is joined as a subquery with its own restrictions.
+        Output columns are named as 'DatabaseReport._recursive_merge' names them (see 'MergePlan.get_merged_columns').
+        Row order is not guaranteed to match the pandas merge.
+
+        :param tree: (Tree) merge tree to compile.
+        :param table_params: (list) table parameters from the 'report_config.json' configuration file.
+        :return: (sqlalchemy.Select, list, dict) query to execute, output columns to parse as dates and output columns
+        dtypes.
+        """
+
+        subqueries = dict()
+
+        def create_subquery(node: Node):
+            subqueries[node.position] = self.get_query(table_name=node.name, columns=node.columns,
+                                                       position=node.position).\
+                subquery('{0}_{1}'.format(node.name, node.position))
+
+        depth_first_search(tree, create_subquery)
+
+        joined = self._join_subqueries(tree=tree, subqueries=subqueries, joined=subqueries[tree.node.position])
+        columns = self.plan.get_merged_columns(tree=tree)
+
+        query = select(*[subqueries[position].c[source_name].label(name) for name, position, source_name in columns]).\
+            select_from(joined)
+
+        parse_dates = list()
+        dtypes = dict()
+        for name, position, source_name in columns:
+            if source_name in (table_params[position]['parse_dates'] or list()):
+                parse_dates.append(name)
+            if source_name in table_params[position].get('dtypes', dict()):
+                dtypes[name] = table_params[position]['dtypes'][source_name]
+
+        return query, parse_dates if len(parse_dates) > 0 else None, dtypes
+
+    def _join_subqueries(self, tree: Tree, subqueries: dict, joined):
+        """
+        Left joins the subqueries of every descendant of the tree root node, parents before children.
+
+        :param tree: (Tree) subtree to join.
+        :param subqueries: (dict) pairs node position - node subquery.
+        :param joined: (sqlalchemy.Join) join built so far.
+        :return: (sqlalchemy.Join) join including the whole subtree.
+        """
+
+        parent = subqueries[tree.node.position]
+
+        for child in tree.children:
+            join = self.plan.get_join(left_node=tree.node, right_node=child.node)
+            subquery = subqueries[child.node.position]
+
+            joined = joined.outerjoin(subquery, parent.c[join['on']] == subquery.c[join['join_with_on']])
+            joined = self._join_subqueries(tree=child, subqueries=subqueries, joined=joined)
+
+        return joined
+
+    def get_load_plan(self, table_params: list, sort_keys=False):
+        """
+        Groups the tables of the 'report_config.json' configuration file so each physical table is read only once.
+        Tables sharing name and restrictions are loaded together with the union of their columns and dates to parse.
+
+        :param table_params: (list) table parameters from the 'report_config.json' configuration file.
+        :param sort_keys: (bool) flag to read each table ordered by its merge key (see 'MergePlan.get_sort_key'). Loads
+        whose tables are merged on different keys are not ordered.
+        :return: (list) loads to execute. Each load is a dictionary with the keys:
+            - 'table': (str) name of the database table.
+            - 'columns': (list) union of the columns requested by every table of the load.
+            - 'parse_dates': (list) union of the date columns requested by every table of the load.
+            - 'dtypes': (dict) union of the column dtypes requested by every table of the load.
+            - 'positions': (list) positions in the configuration file of the tables served by the load.
+            - 'watermark': (str) column used to refresh local snapshots incrementally. None unless every table of the
+            load declares the same watermark.
+            - 'sort_key': (str) column the load is ordered by. None if it is not ordered.
+            - 'query': (sqlalchemy.Select) query to execute.
+        """
+
+        loads = dict()
+
+        for position, table_param in enumerate(table_params):
+            key = (table_param['name'], self._get_restrictions_key(position=position))
+
+            load = loads.setdefault(key, {'table': table_param['name'],
+                                          'columns': list(),
+                                          'parse_dates': list(),
+                                          'dtypes': dict(),
+                                          'positions': list(),
+                                          'watermarks': list()})
+
+            load['columns'].extend([name for name in table_param['columns'] if name not in load['columns']])
+            load['parse_dates'].extend([name for name in table_param['parse_dates'] or list()
+                                        if name not in load['parse_dates']])
+            load['dtypes'].update(table_param.get('dtypes', dict()))
+            load['positions'].append(position)
+            load['watermarks'].append(table_param.get('watermark'))
+
+        for load in loads.values():
+            watermarks = set(load.pop('watermarks'))
+            load['watermark'] = watermarks.pop() if len(watermarks) == 1 else None
+
+            if load['watermark'] not in load['columns']:
+                load['watermark'] = None
+
+            load['query'] = self.get_query(table_name=load['table'], columns=load['columns'],
+                                           position=load['positions'][0])
+
+            sort_keys_of_load = set([self.plan.get_sort_key(position) for position in load['positions']])
+            load['sort_key'] = sort_keys_of_load.pop() if sort_keys and (len(sort_keys_of_load) == 1) else None
+
+            if load['sort_key'] in load['columns']:
+                load['query'] = load['query'].order_by(load['query'].selected_columns[load['sort_key']])
+            else:
+                load['sort_key'] = None
+
+            if len(load['parse_dates']) == 0:
+                load['parse_dates'] = None
+
+        return list(loads.values())
+
+    def _get_restrictions_key(self, position: int):
+        """
+        Gets a hashable representation of the restrictions of a table, so equally restricted tables can be grouped.
+
+        :param position: (int) position of the table in the 'report_config.json' configuration file.
+        :return: (tuple) SQL text of the restrictions and their parameter values.
+        """
+
+        clauses = [clause for clause, _ in self.restrictions.get(position, list())]
+
+        if len(clauses) == 0:
+            return '', ''
+
+        compiled = and_(*clauses).compile()
+
+        return str(compiled), repr(sorted(compiled.params.items()))
+
+    def _create_tables(self):
+        """
+        Creates one SQL table object per database table holding every column referenced by the trees and the filters.
+
+        :return: void
+        """
+
+        table_columns = dict()
+
+        def register(node: Node):
+            columns = table_columns.setdefault(node.name, list())
+            columns.extend(node.columns)
+            columns.extend([join['on'] for join in node.inner_joins])
+
+            for join in node.inner_joins:
+                table_columns.setdefault(join['join_with'], list()).append(join['join_with_on'])
+
+        for tree in self.trees:
+            depth_first_search(tree, register)
+
+        for predicate in self.filters:
+            table_columns.setdefault(predicate['table'], list()).append(predicate['column'])
+
+        for name, columns in table_columns.items():
+            self.tables[name] = table(name, *[column(column_name) for column_name in dict.fromkeys(columns)])
+
+    def _upward_restrictions(self, tree: Tree):
+        """
+        Gets the restrictions of the tree root node: its own predicates plus one semi-join for each restricted child.
+
+        :param tree: (Tree) subtree whose root node restrictions are calculated.
+        :return: (list) pairs (SQL clause, strict). A clause is strict when it discards the rows that have no match.
+        """
+
+        node = tree.node
+        sql_table = self.tables[node.name]
+
+        restrictions = [(OPERATORS[predicate['operator']](sql_table.c[predicate['column']], predicate['value']),
+                         not predicate.get('keep_unmatched', False))
+                        for predicate in self.filters if predicate['table'] == node.name]
+
+        for child in tree.children:
+            child_restrictions = self._upward_restrictions(tree=child)
+
+            if len(child_restrictions) > 0:
+                join = self.plan.get_join(left_node=node, right_node=child.node)
+                child_table = self.tables[child.node.name]
+                strict = any(child_strict for _, child_strict in child_restrictions)
+
+                matched = select(child_table.c[join['join_with_on']]).\
+                    where(and_(*[clause for clause, _ in child_restrictions])).correlate(None)
+                clause = sql_table.c[join['on']].in_(matched)
+
+                if not strict:
+                    # Rows without any child row are merged with null values, which are accepted by the predicates
+                    child_keys = select(child_table.c[join['join_with_on']]).\
+                        where(child_table.c[join['join_with_on']].isnot(None)).correlate(None)
+                    clause = or_(clause, sql_table.c[join['on']].notin_(child_keys))
+
+                restrictions.append((clause, strict))
+
+        self.restrictions[node.position] = restrictions
+
+        return restrictions
+
+    def _downward_restrictions(self, tree: Tree, parent_tree):
+        """
+        Restricts every node to the rows that can be merged with its (already restricted) parent node.
+
+        :param tree: (Tree) subtree whose nodes are going to be restricted.
+        :param parent_tree: (Tree) parent of the subtree. None if the subtree is the whole tree.
+        :return: void
+        """
+
+        node = tree.node
+
+        if parent_tree is not None:
+            parent_node = parent_tree.node
+            parent_restrictions = self.restrictions.get(parent_node.position, list())
+
+            if len(parent_restrictions) > 0:
+                join = self.plan.get_join(left_node=parent_node, right_node=node)
+                parent_table = self.tables[parent_node.name]
+
+                parent_keys = select(parent_table.c[join['on']]).\
+                    where(and_(*[clause for clause, _ in parent_restrictions])).correlate(None)
+
+                self.restrictions.setdefault(node.position, list()).append(
+                    (self.tables[node.name].c[join['join_with_on']].in_(parent_keys), True))
+
+        for child in tree.children:
+            self._downward_restrictions(tree=child, parent_tree=tree)
+
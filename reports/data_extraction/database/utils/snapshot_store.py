@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import json
+import os
+import pandas as pd
+
+
+class SnapshotStore:
+    """
+    Local columnar copy of the database tables. Each snapshot is a Parquet file keyed by table name, column set and
+    column types, next to a JSON file with the date the whole table was last read:
+        [snapshot_path]/[table]_[hash].parquet
+        [snapshot_path]/[table]_[hash].json
+
+    Snapshots are refreshed incrementally through a watermark column (an ever-growing column such as 'id' or a creation
+    date): only the rows whose watermark is equal or greater than the highest stored one, or null, are read from the
+    database. Rows sharing the highest watermark and rows without watermark are dropped from the snapshot before
+    appending the new ones, so none of them is lost or duplicated.
+
+    Rows updated after being inserted (e.g. the subscription flags of a user, with an 'id' watermark) keep their stored
+    values until the whole table is read again, which happens when the snapshot is older than 'max_age_days'. Tables
+    whose rows are updated often must not be given a watermark.
+    """
+
+    # default constructor
+    def __init__(self, snapshot_path: str, max_age_days=7):
+        self.snapshot_path = snapshot_path
+        self.max_age_days = max_age_days
+
+        os.makedirs(self.snapshot_path, exist_ok=True)
+
+    def get_file(self, table_name: str, columns: list, dtypes: dict = None, parse_dates: list = None):
+        """
+        Gets the snapshot file path of a table, column set and column types.
+
+        :param table_name: (str) name of the database table.
+        :param columns: (list) columns stored in the snapshot.
+        :param dtypes: (dict) pairs column - dtype the columns are cast to. None if they are not cast.
+        :param parse_dates: (list) columns parsed as dates. None if no column is parsed.
+        :return: (str) snapshot file path, without extension.
+        """
+
+        key = json.dumps([columns, dtypes or dict(), parse_dates or list()], sort_keys=True)
+        key_hash = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+
+        return os.path.join(self.snapshot_path, '{0}_{1}'.format(table_name, key_hash))
+
+    def read(self, table_name: str, columns: list, watermark: str, dtypes: dict = None, parse_dates: list = None):
+        """
+        Reads a snapshot and removes the rows that will be read again from the database.
+
+        :param table_name: (str) name of the database table.
+        :param columns: (list) columns stored in the snapshot.
+        :param watermark: (str) column used to refresh the snapshot incrementally.
+        :param dtypes: (dict) pairs column - dtype the columns are cast to. None if they are not cast.
+        :param parse_dates: (list) columns parsed as dates. None if no column is parsed.
+        :return: (DataFrame, object) snapshot rows and watermark value from which rows must be read. (None, None) if
+        the snapshot does not exist or it is older than 'max_age_days', so the whole table must be read.
+        """
+
+        file = self.get_file(table_name=table_name, columns=columns, dtypes=dtypes, parse_dates=parse_dates)
+
+        if not (os.path.exists(file + '.parquet') and os.path.exists(file + '.json')):
+            return None, None
+
+        with open(file + '.json', 'r') as metadata_file:
+            full_read_at = datetime.datetime.fromisoformat(json.load(metadata_file)['full_read_at'])
+
+        if (self.max_age_days is not None) and \
+                (datetime.datetime.now() - full_read_at > datetime.timedelta(days=self.max_age_days)):
+            return None, None
+
+        snapshot = pd.read_parquet(file + '.parquet')
+        last_value = snapshot[watermark].max()
+
+        if pd.isna(last_value):
+            return None, None
+
+        # Database drivers only bind Python values: pandas timestamps and numpy scalars are converted
+        if isinstance(last_value, pd.Timestamp):
+            last_value = last_value.to_pydatetime()
+        elif hasattr(last_value, 'item'):
+            last_value = last_value.item()
+
+        # Null watermarks are read again along with the new rows (see 'DatabaseReport._load_table')
+        return snapshot[snapshot[watermark] < last_value], last_value
+
+    def write(self, table_name: str, columns: list, dataframe: pd.DataFrame, dtypes: dict = None,
+              parse_dates: list = None, full_read=False):
+        """
+        Stores a snapshot replacing the previous one.
+
+        :param table_name: (str) name of the database table.
+        :param columns: (list) columns stored in the snapshot.
+        :param dataframe: (DataFrame) table rows.
+        :param dtypes: (dict) pairs column - dtype the columns are cast to. None if they are not cast.
+        :param parse_dates: (list) columns parsed as dates. None if no column is parsed.
+        :param full_read: (bool) flag to record that the whole table has been read from the database.
+        :return: void
+        """
+
+        file = self.get_file(table_name=table_name, columns=columns, dtypes=dtypes, parse_dates=parse_dates)
+
+        # Written aside and then moved, so a failed run never leaves a truncated snapshot behind
+        dataframe.to_parquet(file + '.parquet.tmp', index=False)
+        os.replace(file + '.parquet.tmp', file + '.parquet')
+
+        if full_read:
+            with open(file + '.json.tmp', 'w') as metadata_file:
+                json.dump({'full_read_at': datetime.datetime.now().isoformat()}, metadata_file, indent=2)
+
+            os.replace(file + '.json.tmp', file + '.json')
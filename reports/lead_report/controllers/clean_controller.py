@@ -2,8 +2,22 @@ import pandas as pd
 import numpy as np
 import datetime
 from nameparser import HumanName
-
-
+from reports.utils.profiler import profiler
+
+# Personal data columns consumed by 'clean_pipeline'
+REQUIRED_COLUMNS = ['id',
+                    'telephone',
+                    'birthday',
+                    'birthday_facebookuser',
+                    'first_name',
+                    'first_name_facebookuser',
+                    'last_name',
+                    'last_name_facebookuser',
+                    'facebook_id',
+                    'twitter_id']
+
+
+@profiler.profile()
 def clean_pipeline(data: pd.DataFrame):
     """
     It performs all cleaning tasks included in the pipeline.
@@ -21,16 +35,7 @@ def clean_pipeline(data: pd.DataFrame):
     :return: (DataFrame) cleaned data.
     """
 
-    required_columns = ['id',
-                        'telephone',
-                        'birthday',
-                        'birthday_facebookuser',
-                        'first_name',
-                        'first_name_facebookuser',
-                        'last_name',
-                        'last_name_facebookuser',
-                        'facebook_id',
-                        'twitter_id']
+    required_columns = list(REQUIRED_COLUMNS)
     # Lead data may contain duplicates. It is important not to repeat the same transformations with duplicated registers
     aux_data = data.loc[:, required_columns].drop_duplicates(subset=['id'], keep='first')
 
@@ -2,8 +2,10 @@ import pandas as pd
 import xlsxwriter
 import os
 import datetime
+from reports.utils.profiler import profiler
 
 
+@profiler.profile()
 def to_excel(date=datetime.datetime.now(), data=['uno', 'dos', 'tres', 'cuatro'], clients_config=[{'name': 'Medicos Sin Fronteras', 'alias': 'msf', 'acronym': 'MSF', 'identifier': 2, 'entry_date': '2020-04-23 00:00:00', 'exclude_from_delivery': ['msf'], 'months': [1, 3, 6], 'deliveries': [{'campaign_name': 'Entrega leads mayores de 35 años', 'delivery_type': 'hot_list', 'frequency': 'daily', 'delivery_days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'], 'maximum_delivery_time': '09:00:00', 'columns': {'first_name': 'fName', 'last_name_full': 'fSurname', 'email': 'fEmail', 'gender': 'fGender', 'telephone': 'fPhone', 'birthday': 'fBirthdate', 'ip': 'fIp', 'id': 'Id', 'signature_method': 'fOptions', 'question': 'fOptions2', 'date': 'fDate'}, 'filters': {'more_than_35': '(`age` > 35)', 'from_spain': '(`name` == "España")', 'has_telephone': '(`telephone` == `telephone`)', 'share_data': '(`shareMyData` == 1)', 'cant_call': '(`cant_call` != 1)'}, 'date_columns': ['birthday', 'date'], 'date_format': '%m-%d-%Y'}, {'campaign_name': 'Entrega leads entre 30 y 35 años', 'delivery_type': 'hot_list', 'frequency': 'daily', 'delivery_days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'], 'maximum_delivery_time': '09:00:00', 'columns': {'first_name': 'fName', 'last_name_full': 'fSurname', 'email': 'fEmail', 'gender': 'fGender', 'telephone': 'fPhone', 'birthday': 'fBirthdate', 'ip': 'fIp', 'id': 'Id', 'signature_method': 'fOptions', 'question': 'fOptions2', 'date': 'fDate'}, 'filters': {'from_30_to_35': '(`age` >= 30 and `age` <=35)', 'from_spain': '(`name` == "España")', 'has_telephone': '(`telephone` == `telephone`)', 'share_data': '(`shareMyData` == 1)', 'cant_call': '(`cant_call` != 1)'}, 'date_columns': ['birthday', 'date'], 'date_format': '%m-%d-%Y'}]}, {
       "name": "Cris Contra El Cancer",
       "alias": "cris-contra-el-cancer",
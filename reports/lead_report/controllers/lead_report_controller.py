@@ -1,38 +1,102 @@
 import pandas as pd
 import numpy as np
 import os
+import re
 import datetime
 from reports.data_extraction.database.controllers.database_controller import get_data
-from reports.lead_report.controllers.clean_controller import clean_pipeline
+from reports.data_extraction.database.models.database_session import DatabaseSession
+from reports.lead_report.controllers.clean_controller import clean_pipeline, REQUIRED_COLUMNS
 from pathlib import Path
+from reports.utils.checkpoint_store import CheckpointStore, run_stage
+from reports.utils.profiler import profiler
 
 
-def generate_report(clients: list):
+def generate_report(clients: list, max_workers=1, snapshot_path=None, sorted_merges=False, db_name='local_backup',
+                    db_url=None, arrow=False, memory_budget=None, checkpoint=None, query_report=None):
     """
     Main function in this script. It gets the lead delivery report for the client or set of clients given as parameters.
 
     :param clients: (list of strings) the list of clients as they appear in the client 'alias' whose lead delivery
     report is to be obtained.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param memory_budget: (float) maximum MB of tables held in memory while merging. None to keep every table in memory.
+    :param checkpoint: (CheckpointStore) checkpoints of the run (see 'get_checkpoint'). The report resumes from the
+    last stored stage: leads info, cleaned data, merged trees or extracted tables. None to run every stage.
+    :param query_report: (str) JSON file where the SQL, timings, bytes, rows and EXPLAIN output of every table load are
+    written. None to omit it.
     :return: (2x DataFrame) lead report DataFrame with the delivery format wanted by the recipient NGO and the config
     DataFrame that contains the whole set of characteristics applied in the present lead delivery report.
     """
 
-    cleaned_data = get_report_data()
+    leads_info = checkpoint.load('leads') if checkpoint is not None else None
+
+    if leads_info is not None:
+        return leads_info
+
+    cleaned_data = run_stage(checkpoint, 'cleaned', get_report_data, max_workers=max_workers,
+                             snapshot_path=snapshot_path, sorted_merges=sorted_merges, db_name=db_name, db_url=db_url,
+                             arrow=arrow, clients=clients, memory_budget=memory_budget, checkpoint=checkpoint,
+                             query_report=query_report)
     leads_report, client_config_list = get_leads_info(data=cleaned_data, clients=clients)
 
+    if checkpoint is not None:
+        checkpoint.save('leads', (leads_report, client_config_list))
+
     return leads_report, client_config_list
 
 
-def get_report_data():
+def get_checkpoint(checkpoint_path: str, clients: list, db_name='local_backup', db_url=None, arrow=False):
+    """
+    Gets the checkpoints of a lead report run, keyed by its clients, the database it reads and the
+    'report_config.json' and 'client_requirements.json' configuration files.
+
+    :param checkpoint_path: (str) folder where the checkpoints are stored.
+    :param clients: (list of strings) clients of the run.
+    :param db_name: (str) entry of the credentials file with the database the run reads.
+    :param db_url: (str) SQLAlchemy URL of the database the run reads. None if it connects with the credentials file.
+    :param arrow: (bool) flag of the runs that fetch the data as Arrow record batches (their tables have other dtypes).
+    :return: (CheckpointStore) checkpoints of the run.
+    """
+
+    return CheckpointStore(checkpoint_path=checkpoint_path, report_type='lead_report',
+                           params={'clients': clients, 'db_name': db_name, 'db_url': db_url, 'arrow': arrow},
+                           config_files=[os.path.join(DatabaseSession.config_path, DatabaseSession.db_config_file),
+                                         _get_client_config_file()])
+
+
+@profiler.profile()
+def get_report_data(max_workers=1, snapshot_path=None, sorted_merges=False, db_name='local_backup', db_url=None,
+                    arrow=False, clients: list = None, memory_budget=None, checkpoint=None, query_report=None):
     """
     Loads road data from the SQL database as it is stored on it.
     It uses the 'lead_report' configuration file to decide which tables to load and how to merge them.
     It uses 'clean_pipeline' to perform some basic transformations and verifications on personal data.
 
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param clients: (list of strings) clients whose deliveries are going to be generated. Only the personal data columns
+    they consume are loaded. None to load every configured column.
+    :param memory_budget: (float) maximum MB of tables held in memory while merging. Finished merge trees above it are
+    spilled to disk until every tree is merged. None to keep every table in memory.
+    :param checkpoint: (CheckpointStore) checkpoints of the extracted tables and merged trees. None to omit them.
+    :param query_report: (str) JSON file with the stats of every table load. None to omit it.
     :return: (list of DataFrames) personal, deliveries, campaigns and privacy policy loaded DataFrames.
     """
 
-    data = get_data(report_type='lead_report')
+    required_columns = get_required_columns(clients=clients) if clients is not None else None
+
+    data = get_data(report_type='lead_report', max_workers=max_workers, snapshot_path=snapshot_path,
+                    sorted_merges=sorted_merges, db_name=db_name, db_url=db_url, required_columns=required_columns,
+                    arrow=arrow, memory_budget=memory_budget, checkpoint=checkpoint, query_report=query_report)
     personal_data = clean_pipeline(data[0])
     deliveries_data = data[1]
     campaigns_data = data[2]
@@ -41,6 +105,36 @@ def get_report_data():
     return [personal_data, deliveries_data, campaigns_data, privacy_data]
 
 
+def get_required_columns(clients: list):
+    """
+    Gets the merged columns consumed by the deliveries of a set of clients: the personal data columns read by
+    'clean_pipeline' and 'merge_data' plus the ones declared in the 'columns', 'filters' and 'date_columns' fields of
+    each delivery. Columns created by 'clean_pipeline' or taken from other datasets are ignored by the extraction.
+    Deliveries, campaigns and privacy policy data are used whole.
+
+    :param clients: (list of strings) the list of clients as they appear in the client 'alias'.
+    :return: (list) [personal data columns, None, None, None].
+    """
+
+    columns = list(REQUIRED_COLUMNS)
+    columns.append('telephoneConfirmed')
+
+    for client_config in _read_client_config()['client']:
+        if client_config['alias'] not in clients:
+            continue
+
+        for delivery in client_config['deliveries']:
+            columns.extend(delivery['columns'].keys())
+            columns.extend(delivery['date_columns'])
+
+            # Filters are query strings whose columns are quoted with backticks
+            for query in delivery['filters'].values():
+                columns.extend(re.findall(r'`([^`]+)`', query))
+
+    return [list(dict.fromkeys(columns)), None, None, None]
+
+
+@profiler.profile()
 def get_leads_info(data: list, clients: list):
     """
     Collects all the information for each different delivery type from the ones included for each of the client in the
@@ -57,11 +151,8 @@ def get_leads_info(data: list, clients: list):
     Data schema [client_1_data: [delivery_df_1, delivery_df_2], client_2_data: [delivery_df_1], etc.]
     """
 
-    current_directory = Path(os.path.dirname(__file__))
-    config_file = os.path.join(current_directory.parent.absolute(), "config/client_requirements.json")
-
     # Load client requirements
-    config = pd.read_json(config_file, orient='records')
+    config = _read_client_config()
 
     # Unpacking DataFrames from 'data' list
     personal_data = data[0]
@@ -246,6 +337,7 @@ def filter_campaigns_data(data: list, check_privacy_policy=False):
     return merged_data
 
 
+@profiler.profile()
 def merge_data(personal_data: pd.DataFrame, campaigns_data: pd.DataFrame, deliveries_data: pd.DataFrame, delivery):
     """
     Merges and stacks together all the partial DataFrames into a single one that gathers all the information.
@@ -288,3 +380,21 @@ def merge_data(personal_data: pd.DataFrame, campaigns_data: pd.DataFrame, delive
     merged_df = merged_df.sort_values(['total_deliveries', 'telephoneConfirmed'], ascending=[True, False])
 
     return merged_df
+
+
+def _read_client_config():
+    """
+    :return: (DataFrame) client requirements from the 'client_requirements.json' configuration file.
+    """
+
+    return pd.read_json(_get_client_config_file(), orient='records')
+
+
+def _get_client_config_file():
+    """
+    :return: (str) path of the 'client_requirements.json' configuration file.
+    """
+
+    current_directory = Path(os.path.dirname(__file__))
+
+    return os.path.join(current_directory.parent.absolute(), "config/client_requirements.json")
@@ -7,8 +7,9 @@ from pathlib import Path
 
 sys.path.append(r'C:\Users\borja\PycharmProjects\osoigo_ia')
 
-from reports.lead_report.controllers.lead_report_controller import generate_report
+from reports.lead_report.controllers.lead_report_controller import generate_report, get_checkpoint
 from reports.lead_report.controllers.excel_controller import to_excel
+from reports.utils.profiler import profiler
 
 current_directory = Path(os.path.dirname(__file__))
 config_file = os.path.join(current_directory.parent.absolute(), "config/client_requirements.json")
@@ -30,7 +31,50 @@ ngos_list = [ngo['alias'] for ngo in config['client']]
               multiple=True,
               type=click.Choice(choices=ngos_list),
               help='client name for which you want to obtain the report. Attention! case sensitive')
-def command_line_interface(date, ong):
+@click.option('--workers', '-w',
+              default=1,
+              required=False,
+              type=click.IntRange(min=1),
+              help='maximum number of database tables loaded in parallel')
+@click.option('--snapshots',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder where local snapshots of the database tables are kept and incrementally refreshed')
+@click.option('--sorted-merges',
+              is_flag=True,
+              default=False,
+              help='load the database tables ordered by their merge keys and merge them on sorted indexes')
+@click.option('--arrow',
+              is_flag=True,
+              default=False,
+              help='fetch the database tables as Arrow record batches into pyarrow-backed columns')
+@click.option('--db',
+              default='local_backup',
+              required=False,
+              help='entry of the database credentials file to connect to (MariaDB server or SQLite/DuckDB replica)')
+@click.option('--memory-budget',
+              default=None,
+              required=False,
+              type=click.FloatRange(min=0),
+              help='maximum MB of tables held in memory while merging (finished merge trees above it are spilled)')
+@click.option('--checkpoints',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder where the output of every stage is kept, so a failed run resumes from its last stage')
+@click.option('--query-report',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON file where the SQL, timings, bytes, rows and EXPLAIN output of every table load are written')
+@click.option('--profile',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON file where the time, rows and memory of every stage of the run are written')
+def command_line_interface(date, ong, workers, snapshots, sorted_merges, arrow, db, memory_budget, checkpoints,
+                           query_report, profile):
     """
     Command line user interface developed to interact with the lead report script stack.
 
@@ -38,20 +82,60 @@ def command_line_interface(date, ong):
     :param ong: (list) ONG name/s for which the data will be obtained. Required parameter.
         :example: -o acnur        --> ong   = [acnur]
         :example: -o acnur -o msf --> month = [acnur, msf]
+    :param workers: (int) maximum number of database tables loaded in parallel.
+        :example: -w 4 --> workers = 4
+        :example:      --> workers = 1
+    :param snapshots: (string) folder with the local snapshots of the database tables. None to omit them.
+        :example: --snapshots ./snapshots --> snapshots = ./snapshots
+        :example:                         --> snapshots = None
+    :param sorted_merges: (bool) flag to merge the tables on sorted indexes.
+        :example: --sorted-merges --> sorted_merges = True
+        :example:                 --> sorted_merges = False
+    :param arrow: (bool) flag to fetch the database tables as Arrow record batches.
+        :example: --arrow --> arrow = True
+        :example:         --> arrow = False
+    :param db: (string) entry of the database credentials file to connect to.
+        :example: --db local_sqlite --> db = local_sqlite
+        :example:                   --> db = local_backup
+    :param memory_budget: (float) maximum MB of tables held in memory while merging. None to keep them all in memory.
+        :example: --memory-budget 2048 --> memory_budget = 2048
+        :example:                      --> memory_budget = None
+    :param checkpoints: (string) folder with the checkpoints of the run. They are removed once the run succeeds. None to
+    omit them.
+        :example: --checkpoints ./checkpoints --> checkpoints = ./checkpoints
+        :example:                             --> checkpoints = None
+    :param query_report: (string) JSON run report with the stats of every table load. None to omit it.
+        :example: --query-report queries.json --> query_report = queries.json
+        :example:                             --> query_report = None
+    :param profile: (string) JSON trace file with the cost of every stage of the run. None to omit profiling.
+        :example: --profile trace.json --> profile = trace.json
+        :example:                      --> profile = None
     :return: void
     """
 
-    month, country, client = _format_params(month=month, country=country, client=ong)
+    if profile is not None:
+        profiler.enable()
+
+    with profiler.stage('lead_report'):
+        checkpoint = None
+        if checkpoints is not None:
+            checkpoint = get_checkpoint(checkpoint_path=checkpoints, clients=list(ong), db_name=db, arrow=arrow)
+
+        # Getting raw data from the database
+        data, clients_config = generate_report(clients=list(ong), max_workers=workers, snapshot_path=snapshots,
+                                               sorted_merges=sorted_merges, db_name=db, arrow=arrow,
+                                               memory_budget=memory_budget, checkpoint=checkpoint,
+                                               query_report=query_report)
 
-    print(month)
-    print(year)
-    print(country)
-    print(ong)
+        to_excel(date=date, data=data, clients_config=clients_config)
 
-    # Getting raw data from the database
-    data = generate_report(month=month, year=year, country=country, client=client)
+        if checkpoint is not None:
+            checkpoint.clear()
 
-    to_excel(month=month, year=year, country=country, client=ong, data=data)
+    if profile is not None:
+        profiler.print_summary()
+        profiler.write(profile)
+        profiler.disable()
 
 
 def _format_params(month, country, client):
@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
 import datetime
+from reports.utils.profiler import profiler
 
 
+@profiler.profile()
 def clean_pipeline(data: pd.DataFrame):
     """
     It performs all cleaning tasks included in the pipeline.
@@ -21,6 +23,7 @@ def clean_pipeline(data: pd.DataFrame):
     return data
 
 
+@profiler.profile()
 def filter_pipeline(data: pd.DataFrame, start_date: datetime, end_date: datetime, country: str, client: str):
     """
     It performs all filtering tasks included in the pipeline.
@@ -45,6 +48,43 @@ def filter_pipeline(data: pd.DataFrame, start_date: datetime, end_date: datetime
     return data
 
 
+def get_filter_spec(start_date: datetime, end_date: datetime, country: str, client: str):
+    """
+    Translates the 'filter_pipeline' parameters into a filter spec that can be pushed down to the database, so only the
+    requested slice of data is loaded. 'filter_pipeline' must still be applied over the loaded data.
+
+    :param start_date: (datetime) minimum (earlier) date in which leads were created.
+    :param end_date: (datetime) maximum (closest) date in which leads were created.
+    :param country: (str) country where leads were created. None to take the entire database of leads.
+    :param client: (str) client to which the leads have been sent. None to omit this filter.
+    :return: (list) filter spec.
+    """
+
+    filters = list()
+
+    # 1) Lead creation and delivery date
+    if start_date is not None:
+        filters.append({'table': 'users', 'column': 'created_at', 'operator': '>=', 'value': start_date})
+
+    if end_date is not None:
+        filters.append({'table': 'users', 'column': 'created_at', 'operator': '<=' if start_date is None else '<',
+                        'value': end_date})
+
+        # Undelivered leads must be kept
+        filters.append({'table': 'user_given_to', 'column': 'given_at', 'operator': '<=', 'value': end_date,
+                        'keep_unmatched': True})
+
+    # 2) Country
+    if country is not None:
+        filters.append({'table': 'country', 'column': 'name', 'operator': '==', 'value': country})
+
+    # 3) Client
+    if client is not None:
+        filters.append({'table': 'user_given_to', 'column': 'given_to', 'operator': '==', 'value': client})
+
+    return filters
+
+
 def clean_telephone(data: pd.DataFrame):
     """
     Takes the monthly report compound dataset and changes all empty valued telephones to null.
@@ -0,0 +1,351 @@
+import datetime
+import json
+import os
+import pandas as pd
+from reports.data_extraction.database.controllers.database_controller import get_data
+from reports.monthly_reports.controllers.clean_controller import clean_pipeline, get_filter_spec
+from reports.monthly_reports.controllers.metric_controller import get_metric_registry
+from reports.monthly_reports.controllers.report_controller import get_latest_deliveries, \
+    get_leads_by_times_delivered, get_privacy_facts, get_required_columns, get_user_facts
+from reports.utils.profiler import profiler
+
+# Delivery day of the deliveries without date, which pass every delivery date filter (see 'filter_pipeline')
+UNDATED_DELIVERY_DAY = pd.Timestamp('1900-01-01')
+
+
+class DailyCube:
+    """
+    Pre-aggregated data of the monthly report, so a report of any dates, country and client is calculated by adding up
+    cube cells instead of extracting, merging and cleaning the database tables. The cube is a folder of Parquet files:
+        [cube_path]/users.parquet: users by creation day, country, first delivery day and value of every condition of
+        the summable metric groups (see 'MetricRegistry.get_summable_groups').
+        [cube_path]/client_users.parquet: delivered users by client, creation day, country, first delivery day to the
+        client and value of every condition.
+        [cube_path]/deliveries.parquet: deliveries by client, creation day of the user, country and delivery day.
+        [cube_path]/delivery_facts.parquet: delivery table (see 'get_user_facts'). Metric groups that cannot be added up
+        by day (time between deliveries, times delivered by user) are calculated from it.
+        [cube_path]/cube.json: last refresh date, first creation day it rebuilt ('since'), last full rebuild date
+        ('settled_at') and conditions the cells were built with.
+
+    Creation dates are stored as the day they fall in ('created_day') and as the first midnight not earlier than them
+    ('created_ceil_day'), and delivery dates as the latter, so the date filters of 'filter_pipeline' are answered
+    exactly for dates at midnight. Reports of any other date are not answered by the cube.
+
+    The cube is refreshed by creation day: the cells of the users created since a date are rebuilt from the database
+    and older cells are kept, so deliveries made since the last full rebuild to users created before that date are
+    missing until the next full rebuild. Reports whose end date is later than the last refresh, or that reach those
+    users with an end date later than the last full rebuild, are not answered by the cube (see 'can_answer'). Ages
+    are calculated on the refresh date.
+    """
+
+    tables = ['users', 'client_users', 'deliveries', 'delivery_facts']
+    metadata_file = 'cube.json'
+
+    # default constructor
+    def __init__(self, cube_path: str, lookback_days=90):
+        self.cube_path = cube_path
+        self.lookback_days = lookback_days
+
+        self.registry = get_metric_registry()
+        self.summable_groups = self.registry.get_summable_groups()
+        self.conditions = [condition for condition in self.registry.get_conditions(groups=self.summable_groups)
+                           if condition != 'delivered']
+
+        os.makedirs(self.cube_path, exist_ok=True)
+
+        self.metadata = None
+        self.data = dict()
+
+        if os.path.exists(os.path.join(self.cube_path, self.metadata_file)):
+            with open(os.path.join(self.cube_path, self.metadata_file), 'r') as file:
+                self.metadata = json.load(file)
+
+            for table in self.tables:
+                self.data[table] = pd.read_parquet(os.path.join(self.cube_path, table + '.parquet'))
+
+    def is_current(self):
+        """
+        :return: (bool) True if the cube has been built with the conditions of the current metrics and it records its
+        last full rebuild.
+        """
+
+        return (self.metadata is not None) and ('settled_at' in self.metadata) and \
+            (self.metadata['conditions'] == self.conditions)
+
+    def is_refreshed_until(self, end_date=None):
+        """
+        :param end_date: (datetime) maximum (closest) date in which leads were created. None to take the current date.
+        :return: (bool) True if the cube is current and it was last refreshed after the date.
+        """
+
+        if not self.is_current():
+            return False
+
+        end_date = pd.Timestamp(end_date) if end_date is not None else pd.Timestamp.now()
+
+        return end_date <= pd.Timestamp(self.metadata['refreshed_at'])
+
+    def can_answer(self, start_date, end_date):
+        """
+        :param start_date: (datetime) minimum (earlier) date in which leads were created. None to omit it.
+        :param end_date: (datetime) maximum (closest) date in which leads were created. None to omit it.
+        :return: (bool) True if the stats of the report can be calculated from the cube: it is current, the dates are
+        at midnight, it was refreshed after the end date and every selected user was rebuilt after it.
+        """
+
+        if not self.is_current():
+            return False
+
+        if not all([pd.Timestamp(date) == pd.Timestamp(date).floor('D') for date in [start_date, end_date]
+                    if date is not None]):
+            return False
+
+        if not self.is_refreshed_until(end_date=end_date):
+            print('cube={0} refreshed_at={1} answered=False reason=refreshed_before_end_date'.format(
+                self.cube_path, self.metadata['refreshed_at']))
+            return False
+
+        end_date = pd.Timestamp(end_date) if end_date is not None else pd.Timestamp.now()
+        settled_at, since = self.metadata['settled_at'], self.metadata['since']
+
+        # Users created before the last refresh window only have the deliveries made until the last full rebuild
+        settled = (settled_at is not None) and (end_date <= pd.Timestamp(settled_at))
+        refreshed_users = (since is None) or ((start_date is not None) and
+                                             (pd.Timestamp(start_date) >= pd.Timestamp(since)))
+
+        if not (settled or refreshed_users):
+            print('cube={0} settled_at={1} since={2} answered=False reason=deliveries_after_full_rebuild'.format(
+                self.cube_path, settled_at, since))
+            return False
+
+        return True
+
+    def get_refresh_start(self, since=None):
+        """
+        :param since: (datetime) creation date from which the cells are rebuilt. None to take the last refresh date
+        minus 'lookback_days'.
+        :return: (pd.Timestamp) first creation day whose cells are rebuilt. None to rebuild the whole cube, when it is
+        empty or it was built with other conditions.
+        """
+
+        if not self.is_current():
+            return None
+
+        if since is None:
+            since = pd.Timestamp(self.metadata['refreshed_at']) - pd.Timedelta(days=self.lookback_days)
+
+        return pd.Timestamp(since).floor('D')
+
+    def refresh(self, data: pd.DataFrame, privacy_data: pd.DataFrame, since=None):
+        """
+        Rebuilds the cells of the users created since a date.
+
+        :param data: (pd.DataFrame) clean personal data of the users created since 'since'.
+        :param privacy_data: (pd.DataFrame) privacy policy data of those users.
+        :param since: (pd.Timestamp) first creation day of the rebuilt cells (see 'get_refresh_start'). None to rebuild
+        the whole cube.
+        :return: void
+        """
+
+        cells = self._build(data=data, privacy_data=privacy_data)
+
+        for table in self.tables:
+            if (since is not None) and (table in self.data):
+                kept_cells = self.data[table].loc[~(self.data[table]['created_day'] >= since)]
+                cells[table] = pd.concat([kept_cells, cells[table]], ignore_index=True)
+
+            # Written aside and then moved, so a failed refresh never leaves a truncated cube behind
+            file = os.path.join(self.cube_path, table + '.parquet')
+            cells[table].to_parquet(file + '.tmp', index=False)
+            os.replace(file + '.tmp', file)
+
+        refreshed_at = datetime.datetime.now().isoformat()
+
+        # Cells kept from earlier refreshes hold the deliveries made until the last full rebuild
+        if since is None:
+            settled_at = refreshed_at
+        elif self.is_current():
+            settled_at = self.metadata['settled_at']
+        else:
+            settled_at = None
+
+        self.data = cells
+        self.metadata = {'refreshed_at': refreshed_at,
+                         'since': since.isoformat() if since is not None else None,
+                         'settled_at': settled_at,
+                         'conditions': self.conditions}
+
+        with open(os.path.join(self.cube_path, self.metadata_file), 'w') as file:
+            json.dump(self.metadata, file, indent=2)
+
+        print('cube={0} since={1} users={2} cells={3}'.format(self.cube_path, since, self.data['users']['users'].sum(),
+                                                              self.data['users'].shape[0]))
+
+    def _build(self, data: pd.DataFrame, privacy_data: pd.DataFrame):
+        """
+        :param data: (pd.DataFrame) clean personal data.
+        :param privacy_data: (pd.DataFrame) privacy policy data.
+        :return: (dict) cube tables of the data.
+        """
+
+        user_facts, delivery_facts = get_user_facts(data)
+        user_facts = get_privacy_facts(user_facts=user_facts, privacy_data=privacy_data)
+
+        users = pd.DataFrame({'id': user_facts['id'],
+                              'created_day': user_facts['created_at'].dt.floor('D'),
+                              'created_ceil_day': user_facts['created_at'].dt.ceil('D'),
+                              'country': user_facts['name']})
+        users = pd.concat([users, self.registry.get_flags(user_facts=user_facts,
+                                                          groups=self.summable_groups)[self.conditions]], axis=1)
+
+        delivery_facts = delivery_facts.assign(delivery_day=delivery_facts['given_at'].dt.ceil('D').fillna(
+            UNDATED_DELIVERY_DAY))
+        delivery_facts = delivery_facts.merge(users.loc[:, ['id', 'created_day', 'created_ceil_day', 'country']],
+                                              on='id', how='left')
+
+        users['first_delivery_day'] = users['id'].map(delivery_facts.groupby('id')['delivery_day'].min())
+
+        client_users = delivery_facts.groupby(['id', 'given_to'], observed=True)['delivery_day'].min().rename(
+            'first_delivery_day').reset_index().merge(users.drop(columns=['first_delivery_day']), on='id')
+
+        keys = ['created_day', 'created_ceil_day', 'country', 'first_delivery_day'] + self.conditions
+
+        return {'users': users.groupby(keys, dropna=False, observed=True).size().rename('users').reset_index(),
+                'client_users': client_users.groupby(['given_to'] + keys, dropna=False, observed=True).size().rename(
+                    'users').reset_index(),
+                'deliveries': delivery_facts.groupby(['given_to', 'created_day', 'created_ceil_day', 'country',
+                                                      'delivery_day'], dropna=False, observed=True).size().rename(
+                    'deliveries').reset_index(),
+                'delivery_facts': delivery_facts}
+
+    def get_stats(self, start_date, end_date, country: str, client: str):
+        """
+        Calculates the stats of a report from the cube. Summable metric groups are added up from the cells and the
+        rest are calculated from the deliveries of the selected users.
+
+        :param start_date: (datetime) minimum (earlier) date in which leads were created. None to take the entire cube.
+        :param end_date: (datetime) maximum (closest) date in which leads were created. None to take the entire cube.
+        :param country: (str) country where leads were created. None to take every country.
+        :param client: (str) client to which the leads have been sent. None to omit this filter.
+        :return: (list) datasets containing the calculated metrics, as returned by 'get_stats'.
+        """
+
+        users = self._select(table=self.data['users'] if client is None else self.data['client_users'],
+                             start_date=start_date, end_date=end_date, country=country, client=client,
+                             day_column='first_delivery_day')
+
+        if users['users'].sum() == 0:
+            return []
+
+        fallback_groups = [group for group in self.registry.groups.keys() if group not in self.summable_groups]
+
+        print('cube={0} refreshed_at={1} cells={2} fallback_groups={3}'.format(
+            self.cube_path, self.metadata['refreshed_at'], users.shape[0], fallback_groups))
+
+        # 1) Summable metrics, from the user cells
+        counts = users['users'].to_numpy()
+        flags = users.loc[:, self.conditions].assign(delivered=users['first_delivery_day'].notna())
+
+        metric_results = self.registry.count(flags=flags, counts=counts, groups=self.summable_groups)
+
+        # 2) Non-summable metrics, from the deliveries of the selected users
+        delivery_facts = self._select(table=self.data['delivery_facts'], start_date=start_date, end_date=end_date,
+                                      country=country, client=client, day_column='delivery_day')
+
+        latest_deliveries = get_latest_deliveries(delivery_facts)
+        latest_deliveries['user_id'] = delivery_facts.drop_duplicates(subset=['id']).set_index('id')['user_id']
+        latest_deliveries['recurrence_days'] = latest_deliveries['recurrence_days'].where(
+            latest_deliveries['user_id'].notna())
+
+        metric_results.update(self.registry.compute(user_facts=latest_deliveries, groups=fallback_groups))
+
+        # 3) Deliveries
+        delivered = flags['delivered'].to_numpy()
+        group3_dict = {'delivered_leads': int(counts[delivered].sum()),
+                       'undelivered_leads': int(counts[~delivered].sum())}
+
+        times_delivered_df = delivery_facts['id'].dropna().value_counts().reset_index()
+        times_delivered_df.columns = ['user_id', 'times_delivered']
+
+        deliveries = self._select(table=self.data['deliveries'], start_date=start_date, end_date=end_date,
+                                  country=country, client=client, day_column='delivery_day')
+
+        leads_by_ong_df = deliveries.groupby('given_to', observed=True)['deliveries'].sum().loc[
+            lambda volumes: volumes > 0]
+        leads_by_ong_df = leads_by_ong_df.sort_values(ascending=False, kind='mergesort').reset_index()
+        leads_by_ong_df.columns = ['ong_name', 'leads_volume']
+
+        delivery_results_list = [group3_dict, times_delivered_df,
+                                 get_leads_by_times_delivered(times_delivered_df=times_delivered_df), leads_by_ong_df]
+
+        return [metric_results['connectivity'], metric_results['typology'], delivery_results_list,
+                metric_results['recurrence'], metric_results['age'], metric_results['privacy']]
+
+    def _select(self, table: pd.DataFrame, start_date, end_date, country: str, client: str, day_column: str):
+        """
+        Selects the cells of a report, with the filters of 'filter_pipeline'.
+
+        :param table: (pd.DataFrame) cube table.
+        :param start_date: (datetime) minimum (earlier) date in which leads were created. None to omit it.
+        :param end_date: (datetime) maximum (closest) date in which leads were created. None to omit it.
+        :param country: (str) country where leads were created. None to omit it.
+        :param client: (str) client to which the leads have been sent. None to omit it.
+        :param day_column: (str) delivery day column of the table.
+        :return: (pd.DataFrame) selected cells.
+        """
+
+        selected = pd.Series(True, index=table.index)
+
+        # 1) Lead creation and delivery date: undelivered leads and leads delivered until the end date
+        if start_date is not None:
+            selected &= table['created_day'] >= start_date
+
+            if end_date is not None:
+                selected &= table['created_day'] < end_date
+
+        elif end_date is not None:
+            selected &= table['created_ceil_day'] <= end_date
+
+        if end_date is not None:
+            selected &= table[day_column].isna() | (table[day_column] <= end_date)
+
+        # 2) Country
+        if country is not None:
+            selected &= table['country'] == country
+
+        # 3) Client
+        if client is not None:
+            selected &= table['given_to'] == client
+
+        return table.loc[selected]
+
+
+@profiler.profile()
+def refresh_cube(cube: DailyCube, since=None, max_workers=1, snapshot_path=None, db_name='local_backup', db_url=None,
+                 arrow=False):
+    """
+    Refreshes a daily cube with the users created since a date, loaded from the database.
+
+    :param cube: (DailyCube) cube to refresh.
+    :param since: (datetime) creation date from which the cells are rebuilt. None to take the last refresh date of the
+    cube minus its 'lookback_days', or the whole database if the cube is empty or out of date.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :return: void
+    """
+
+    since = cube.get_refresh_start(since=since)
+
+    data = get_data(report_type='database_dashboard',
+                    filters=get_filter_spec(start_date=since, end_date=None, country=None, client=None),
+                    max_workers=max_workers, snapshot_path=snapshot_path, db_name=db_name, db_url=db_url,
+                    required_columns=get_required_columns(), arrow=arrow)
+
+    personal_data = data[0]
+    if since is not None:
+        personal_data = personal_data[personal_data['created_at'] >= since]
+
+    cube.refresh(data=clean_pipeline(personal_data), privacy_data=data[1], since=since)
@@ -2,8 +2,11 @@ import pandas as pd
 import xlsxwriter
 import os
 import datetime
+from reports.monthly_reports.controllers.metric_controller import get_metric_registry
+from reports.utils.profiler import profiler
 
 
+@profiler.profile()
 def to_excel(start_date: datetime, end_date: datetime, country: str, client: str, data: list, output_path='',
              file_name=''):
     """
@@ -122,7 +125,8 @@ def _set_workbook_properties(workbook):
 
 def _add_workbook_data(workbook, header: str, data: list, start_date: datetime, end_date: datetime, country: str):
     """
-    Prepares and formats the data that will be part of the output Excel file.
+    Prepares and formats the data that will be part of the output Excel file. Titles and highlighted rows of the
+    per-user metrics are taken from the 'report_metrics.json' configuration file (see 'MetricRegistry').
 
     :param workbook: (xlsxwriter.Workbook) xlsxwriter Excel object.
     :param header: (str) workbook header.
@@ -206,11 +210,13 @@ def _add_workbook_data(workbook, header: str, data: list, start_date: datetime,
             start_date, end_date, country), formats['warning'])
 
     else:
+        registry = get_metric_registry()
+
         worksheets['worksheet_1'].write(2, 1, data[0]['number_users'], formats['leads_total'])
         worksheets['worksheet_1'].write(3, 0, None)
 
         # 1) Connectivity statistics
-        worksheets['worksheet_1'].merge_range('A5:B5', 'CONNECTIVITY AND PARTICIPATION', formats['title'])
+        worksheets['worksheet_1'].merge_range('A5:B5', registry.get_title('connectivity'), formats['title'])
         worksheets['worksheet_1'].write(5, 0, None)
 
         row_num = 6
@@ -219,12 +225,13 @@ def _add_workbook_data(workbook, header: str, data: list, start_date: datetime,
 
         # 2) Typology statistics
         row_num += 2
-        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), 'USER TYPOLOGY', formats['title'])
+        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), registry.get_title('typology'),
+                                              formats['title'])
         worksheets['worksheet_1'].write(row_num, 0, None)
 
         row_num += 1
         row_num = _write_df(dataframe=data[1], worksheet=worksheets['worksheet_1'], row_number=row_num,
-                            formats=formats, add_index=True, highlight_rows=list(range(0, 25, 4)))
+                            formats=formats, add_index=True, highlight_rows=registry.get_highlight_rows('typology'))
 
         # 3) Delivered leads
         row_num += 2
@@ -252,7 +259,8 @@ def _add_workbook_data(workbook, header: str, data: list, start_date: datetime,
 
         # 4) User recurrence statistics
         row_num += 2
-        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), 'USER RECURRENCE', formats['title'])
+        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), registry.get_title('recurrence'),
+                                              formats['title'])
         worksheets['worksheet_1'].write(row_num, 0, None)
 
         row_num += 1
@@ -261,7 +269,7 @@ def _add_workbook_data(workbook, header: str, data: list, start_date: datetime,
 
         # 5) User age statistics
         row_num += 2
-        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), 'USER AGE', formats['title'])
+        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), registry.get_title('age'), formats['title'])
         worksheets['worksheet_1'].write(row_num, 0, None)
 
         row_num += 1
@@ -269,12 +277,13 @@ def _add_workbook_data(workbook, header: str, data: list, start_date: datetime,
 
         # 6) User privacy statistics
         row_num += 2
-        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), 'USER-SPONSORED', formats['title'])
+        worksheets['worksheet_1'].merge_range('A{0}:B{0}'.format(row_num), registry.get_title('privacy'),
+                                              formats['title'])
         worksheets['worksheet_1'].write(row_num, 0, None)
 
         row_num += 1
         _write_df(dataframe=data[5], worksheet=worksheets['worksheet_1'], row_number=row_num,
-                  formats=formats, add_index=True, highlight_rows=list(range(0, 6, 3)))
+                  formats=formats, add_index=True, highlight_rows=registry.get_highlight_rows('privacy'))
 
     # Close the Workbook object and write the XLSX file
     workbook.close()
@@ -0,0 +1,266 @@
+import functools
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Conditions the metrics are defined on, as functions of the user table (see 'report_controller.get_user_facts').
+# Flags are nullable: null values do not meet any condition
+CONDITIONS = {'known_id': lambda users: users['id'].notna(),
+              'null_id': lambda users: users['id'].isna(),
+              'share_data': lambda users: users['shareMyData'] == 1,
+              'not_share_data': lambda users: users['shareMyData'] == 0,
+              'null_share_data': lambda users: users['shareMyData'].isna(),
+              'robinson': lambda users: users['robinson'] == 1,
+              'null_robinson': lambda users: users['robinson'].isna(),
+              'email_subscribed': lambda users: users['emailSubscribed'] == 1,
+              'null_email_subscribed': lambda users: users['emailSubscribed'].isna(),
+              'verified_email': lambda users: users['emailConfirmed'] == 1,
+              'not_verified_email': lambda users: users['emailConfirmed'] == 0,
+              'null_email_confirmed': lambda users: users['emailConfirmed'].isna(),
+              'null_connectivity_value': lambda users: users.loc[:, ['id', 'shareMyData', 'robinson', 'emailSubscribed',
+                                                                     'emailConfirmed']].isna().any(axis=1),
+              'verified_phone': lambda users: users['telephoneConfirmed'] == 1,
+              'null_telephone_confirmed': lambda users: users['telephoneConfirmed'].isna(),
+              'null_confirmation': lambda users: users['emailConfirmed'].isna() | users['telephoneConfirmed'].isna(),
+              'phone_included': lambda users: users['telephone'].notna(),
+              'age_enough': lambda users: users['age'] >= 30,
+              'man': lambda users: users['gender'] == 'male',
+              'woman': lambda users: users['gender'] == 'female',
+              'facebook_user': lambda users: users['facebook_id'].notna(),
+              'twitter_user': lambda users: users['twitter_id'].notna(),
+              'delivered': lambda users: users['given_to'].notna(),
+              'recurrence_up_to_30_days': lambda users: users['recurrence_days'] <= 30,
+              'recurrence_31_to_90_days': lambda users: users['recurrence_days'].between(31, 3 * 30),
+              'recurrence_91_to_180_days': lambda users: users['recurrence_days'].between((3 * 30) + 1, 6 * 30),
+              'recurrence_181_to_365_days': lambda users: users['recurrence_days'].between((6 * 30) + 1, 365),
+              'recurrence_366_to_730_days': lambda users: users['recurrence_days'].between(366, 2 * 365),
+              'recurrence_more_than_731_days': lambda users: users['recurrence_days'] > (2 * 365) + 1,
+              'known_age': lambda users: users['age'].notna(),
+              'null_age': lambda users: users['age'].isna(),
+              'age_less_than_25': lambda users: users['age'] < 25,
+              'age_25_to_29': lambda users: users['age'].between(25, 29),
+              'age_30_to_39': lambda users: users['age'].between(30, 39),
+              'age_40_to_49': lambda users: users['age'].between(40, 49),
+              'age_50_to_59': lambda users: users['age'].between(50, 59),
+              'age_more_than_59': lambda users: users['age'] > 59,
+              'privacy_policies': lambda users: users['privacy_policies'],
+              'osoigo_policy_displayed': lambda users: users['osoigo_policy_displayed'],
+              'privacy_policy_accepted': lambda users: users['privacy_policy_accepted']}
+
+# Conditions on the deliveries of a user within the report dates, other than being delivered: they cannot be
+# aggregated by delivery date (see 'DailyCube') and their groups are calculated from the deliveries of every user
+NON_SUMMABLE_CONDITIONS = ['recurrence_up_to_30_days', 'recurrence_31_to_90_days', 'recurrence_91_to_180_days',
+                           'recurrence_181_to_365_days', 'recurrence_366_to_730_days', 'recurrence_more_than_731_days']
+
+AGGREGATIONS = ['users', 'users_by_delivery']
+DISPLAYS = ['default', 'highlight']
+
+
+class MetricRegistry:
+    """
+    Per-user metrics of the monthly report, declared in the 'report_metrics.json' configuration file. Every metric
+    has:
+        - name: row of the metric in its group.
+        - group: stats group (and workbook section) it belongs to, one of the 'groups' of the file.
+        - conditions: names of the 'CONDITIONS' that every counted user meets. Names prefixed with '~' are conditions
+        that counted users do not meet.
+        - aggregation: 'users' to count users or 'users_by_delivery' to count them in total, delivered and undelivered.
+        - display: 'highlight' to highlight its row in the workbook or 'default'.
+
+    Metrics are compiled into a single pass over the users: every condition is evaluated once, however many metrics
+    use it, users are counted by combination of conditions and every metric adds up the combinations it includes.
+    A new metric only needs a new entry in the file (and a new condition, if it is not defined yet).
+    """
+
+    config_path = os.path.join(os.path.dirname(__file__), "../config")
+    metrics_config_file = "report_metrics.json"
+
+    # default constructor
+    def __init__(self, config_file: str = None):
+        self.config_file = config_file if config_file is not None else os.path.join(self.config_path,
+                                                                                    self.metrics_config_file)
+
+        with open(self.config_file, 'r') as file:
+            config = json.load(file)
+
+        self.groups = config['groups']
+        self.metrics = config['metrics']
+
+        self._validate()
+
+        # Conditions evaluated by the pass, and conditions required and excluded by every metric
+        self.conditions = list(dict.fromkeys([condition.lstrip('~') for metric in self.metrics
+                                              for condition in metric['conditions']] + ['delivered']))
+        self.required = np.zeros((len(self.metrics), len(self.conditions)), dtype=np.int64)
+        self.excluded = np.zeros((len(self.metrics), len(self.conditions)), dtype=np.int64)
+
+        for row, metric in enumerate(self.metrics):
+            for condition in metric['conditions']:
+                if condition.startswith('~'):
+                    self.excluded[row, self.conditions.index(condition[1:])] = 1
+                else:
+                    self.required[row, self.conditions.index(condition)] = 1
+
+    def _validate(self):
+        """
+        Checks that every metric has a valid group, conditions, aggregation and display, and a unique name in its
+        group.
+
+        :return: void
+        """
+
+        names = set()
+
+        for metric in self.metrics:
+            if metric['group'] not in self.groups:
+                raise ValueError("Metric '{0}' has an unknown group '{1}'. Valid groups: {2}".format(
+                    metric['name'], metric['group'], list(self.groups.keys())))
+
+            if (metric['group'], metric['name']) in names:
+                raise ValueError("Metric '{0}' is defined twice in group '{1}'".format(metric['name'], metric['group']))
+
+            names.add((metric['group'], metric['name']))
+
+            for condition in metric['conditions']:
+                if condition.lstrip('~') not in CONDITIONS:
+                    raise ValueError("Metric '{0}' has an unknown condition '{1}'".format(metric['name'], condition))
+
+            if metric['aggregation'] not in AGGREGATIONS:
+                raise ValueError("Metric '{0}' has an unknown aggregation '{1}'. Valid aggregations: {2}".format(
+                    metric['name'], metric['aggregation'], AGGREGATIONS))
+
+            if metric['display'] not in DISPLAYS:
+                raise ValueError("Metric '{0}' has an unknown display '{1}'. Valid displays: {2}".format(
+                    metric['name'], metric['display'], DISPLAYS))
+
+    def get_metrics(self, group: str):
+        """
+        :param group: (str) stats group.
+        :return: (list) metrics of the group, in the configuration file order.
+        """
+
+        return [metric for metric in self.metrics if metric['group'] == group]
+
+    def get_title(self, group: str):
+        """
+        :param group: (str) stats group.
+        :return: (str) title of the workbook section of the group.
+        """
+
+        return self.groups[group]['title']
+
+    def get_highlight_rows(self, group: str):
+        """
+        :param group: (str) stats group.
+        :return: (list) positions of the highlighted metrics in the group.
+        """
+
+        return [row for row, metric in enumerate(self.get_metrics(group)) if metric['display'] == 'highlight']
+
+    def get_summable_groups(self):
+        """
+        :return: (list) groups whose metrics do not use any of the 'NON_SUMMABLE_CONDITIONS'.
+        """
+
+        return [group for group in self.groups.keys() if not any([condition.lstrip('~') in NON_SUMMABLE_CONDITIONS
+                                                                  for metric in self.get_metrics(group)
+                                                                  for condition in metric['conditions']])]
+
+    def get_conditions(self, groups: list = None):
+        """
+        :param groups: (list) stats groups. None to take every group.
+        :return: (list) conditions used by the metrics of the groups, including 'delivered' if any of them is counted
+        by delivery.
+        """
+
+        metrics = [metric for metric in self.metrics if (groups is None) or (metric['group'] in groups)]
+        conditions = [condition.lstrip('~') for metric in metrics for condition in metric['conditions']]
+
+        if any([metric['aggregation'] == 'users_by_delivery' for metric in metrics]):
+            conditions.append('delivered')
+
+        return [condition for condition in self.conditions if condition in conditions]
+
+    def get_flags(self, user_facts: pd.DataFrame, groups: list = None):
+        """
+        Evaluates the conditions of the metrics on every user.
+
+        :param user_facts: (pd.DataFrame) user table (see 'report_controller.get_user_facts').
+        :param groups: (list) stats groups whose conditions are evaluated. None to take every group.
+        :return: (pd.DataFrame) flags of every user, one boolean column per condition.
+        """
+
+        return pd.DataFrame({name: CONDITIONS[name](user_facts).fillna(False).to_numpy(dtype=bool)
+                             for name in self.get_conditions(groups=groups)}, index=user_facts.index)
+
+    def compute(self, user_facts: pd.DataFrame, groups: list = None):
+        """
+        Calculates the metrics of the registry.
+
+        :param user_facts: (pd.DataFrame) user table (see 'report_controller.get_user_facts').
+        :param groups: (list) stats groups to calculate. None to calculate every group.
+        :return: (dict) metrics by group (see 'count').
+        """
+
+        return self.count(flags=self.get_flags(user_facts=user_facts, groups=groups), groups=groups)
+
+    def count(self, flags: pd.DataFrame, counts=None, groups: list = None):
+        """
+        Calculates the metrics of the registry from the conditions met by a set of users.
+
+        :param flags: (pd.DataFrame) one boolean column per condition (see 'get_flags'). Missing conditions are not met.
+        :param counts: (np.ndarray) number of users of every row of 'flags'. None if every row is a user.
+        :param groups: (list) stats groups to calculate. None to calculate every group.
+        :return: (dict) metrics by group. Groups with 'users_by_delivery' metrics are DataFrames indexed by metric
+        name ('total', 'delivered' and 'undelivered'). Any other group is a dictionary of pairs metric name - users.
+        """
+
+        flags = np.column_stack([flags[name].to_numpy(dtype=bool) if name in flags.columns
+                                 else np.zeros(len(flags), dtype=bool) for name in self.conditions])
+
+        # Users by combination of conditions
+        if counts is None:
+            combinations, counts = np.unique(np.packbits(flags, axis=1), axis=0, return_counts=True)
+            combinations = np.unpackbits(combinations, axis=1, count=len(self.conditions)).astype(np.int64)
+        else:
+            combinations, counts = flags.astype(np.int64), np.asarray(counts, dtype=np.int64)
+
+        # Combinations meeting every required condition of a metric and none of its excluded conditions
+        included = (((self.required @ (1 - combinations).T) == 0) &
+                    ((self.excluded @ combinations.T) == 0)).astype(np.int64)
+
+        totals = included @ counts
+        delivered = included @ (counts * combinations[:, self.conditions.index('delivered')])
+
+        results = dict()
+
+        for group in self.groups.keys():
+            if (groups is not None) and (group not in groups):
+                continue
+
+            rows = [row for row, metric in enumerate(self.metrics) if metric['group'] == group]
+            names = [self.metrics[row]['name'] for row in rows]
+
+            if all([self.metrics[row]['aggregation'] == 'users' for row in rows]):
+                results[group] = {name: int(totals[row]) for name, row in zip(names, rows)}
+                continue
+
+            by_delivery = np.array([self.metrics[row]['aggregation'] == 'users_by_delivery' for row in rows])
+
+            group_df = pd.DataFrame({'total': totals[rows], 'delivered': np.where(by_delivery, delivered[rows], 0)},
+                                    index=names)
+            group_df['undelivered'] = np.where(by_delivery, group_df['total'] - group_df['delivered'], 0)
+
+            results[group] = group_df
+
+        return results
+
+
+@functools.lru_cache(maxsize=None)
+def get_metric_registry():
+    """
+    :return: (MetricRegistry) metrics of the 'report_metrics.json' configuration file, read once per process.
+    """
+
+    return MetricRegistry()
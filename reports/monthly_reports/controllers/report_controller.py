@@ -1,9 +1,34 @@
+import functools
+import itertools
+import os
 import pandas as pd
-from reports.data_extraction.database.controllers.database_controller import get_data
-from reports.monthly_reports.controllers.clean_controller import clean_pipeline, filter_pipeline
-
-
-def generate_report(start_date, end_date, country: str, client: str):
+from reports.data_extraction.database.controllers.database_controller import get_data, get_data_chunks
+from reports.data_extraction.database.models.database_session import DatabaseSession
+from reports.monthly_reports.controllers.clean_controller import clean_pipeline, filter_leads_creation_date, \
+    filter_pipeline, get_filter_spec
+from reports.monthly_reports.controllers.metric_controller import MetricRegistry, get_metric_registry
+from reports.utils.checkpoint_store import CheckpointStore, run_stage
+from reports.utils.profiler import profiler
+
+# Per-user columns of the personal data, taken from the first row of every user (see 'get_user_facts')
+USER_COLUMNS = ['id', 'user_id', 'created_at', 'name', 'shareMyData', 'robinson', 'emailSubscribed', 'emailConfirmed',
+                'telephone', 'telephoneConfirmed', 'facebook_id', 'twitter_id', 'given_to', 'age', 'gender']
+
+# Per-delivery columns of the personal data (see 'get_user_facts')
+DELIVERY_COLUMNS = ['id', 'user_id', 'given_to', 'given_at']
+
+# Merged columns consumed by each step of the report, as [personal data columns, privacy policy data columns]. Only
+# these columns (and the merge keys) are loaded from the database, so a new step must declare the columns it reads.
+# Stats read the user and delivery tables built by 'get_user_facts' and 'get_privacy_facts'
+CONSUMED_COLUMNS = {'filter_pipeline': [['created_at', 'given_at', 'name', 'given_to'], []],
+                    'clean_pipeline': [['telephone', 'age', 'birthday'], []],
+                    'get_user_facts': [USER_COLUMNS + DELIVERY_COLUMNS, []],
+                    'get_privacy_facts': [[], ['id', 'privacy_policies_checkbox_id', 'checked']]}
+
+
+def generate_report(start_date, end_date, country: str, client: str, max_workers=1, snapshot_path=None,
+                    sql_joins=False, sorted_merges=False, chunksize=None, db_name='local_backup', db_url=None,
+                    arrow=False, partitions=1, max_processes=None, checkpoint=None, query_report=None, cube=None):
     """
     Gets the data ready to generate the report. It is responsible for collecting the data and get the stats.
 
@@ -11,16 +36,165 @@ def generate_report(start_date, end_date, country: str, client: str):
     :param end_date: (datetime) maximum (closest) date in which leads were created. None to take the entire database.
     :param country: (str) country where leads were created. None to take the entire database of leads.
     :param client: (str) client to which the leads have been sent. None to omit this filter.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sql_joins: (bool) flag to run the table merges in the database.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param chunksize: (int) number of rows read, filtered and cleaned at a time. None to read the whole data at once.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param partitions: (int) number of shards, by user id, merged and summarized in a process pool. 1 to run the whole
+    report in this process.
+    :param max_processes: (int) maximum number of shards processed in parallel. None to use one process per core.
+    :param checkpoint: (CheckpointStore) checkpoints of the run (see 'get_checkpoint'). The report resumes from the
+    last stored stage: stats, cleaned data, merged trees or extracted tables. None to run every stage.
+    :param query_report: (str) JSON file where the SQL, timings, bytes, rows and EXPLAIN output of every table load are
+    written. None to omit it.
+    :param cube: (DailyCube) pre-aggregated report data. The stats are calculated from it, without reading the database,
+    if it can answer the report dates (see 'DailyCube.can_answer'). None to omit it.
     :return:
     """
 
-    report_data = get_report_data(start_date=start_date, end_date=end_date, country=country, client=client)
-    report_stats = get_stats(data=report_data)
+    if (cube is not None) and cube.can_answer(start_date=start_date, end_date=end_date):
+        return cube.get_stats(start_date=start_date, end_date=end_date, country=country, client=client)
+
+    report_stats = checkpoint.load('stats') if checkpoint is not None else None
+
+    if report_stats is not None:
+        return report_stats
+
+    if partitions > 1:
+        if chunksize is not None:
+            raise ValueError("Partitioned reports are merged in memory: 'partitions' cannot be combined with "
+                             "'chunksize'")
+
+        report_stats = get_partitioned_stats(start_date=start_date, end_date=end_date, country=country, client=client,
+                                             partitions=partitions, max_processes=max_processes,
+                                             max_workers=max_workers, snapshot_path=snapshot_path, sql_joins=sql_joins,
+                                             sorted_merges=sorted_merges, db_name=db_name, db_url=db_url, arrow=arrow,
+                                             checkpoint=checkpoint)
+    else:
+        report_data = run_stage(checkpoint, 'cleaned', get_report_data, start_date=start_date, end_date=end_date,
+                                country=country, client=client, max_workers=max_workers,
+                                snapshot_path=snapshot_path, sql_joins=sql_joins, sorted_merges=sorted_merges,
+                                chunksize=chunksize, db_name=db_name, db_url=db_url, arrow=arrow,
+                                checkpoint=checkpoint, query_report=query_report)
+        report_stats = get_stats(data=report_data)
+
+    if checkpoint is not None:
+        checkpoint.save('stats', report_stats)
 
     return report_stats
 
 
-def get_report_data(start_date, end_date, country: str, client: str):
+@profiler.profile()
+def generate_batch_reports(periods: list, countries: list, clients: list, max_workers=1, snapshot_path=None,
+                           sql_joins=False, db_name='local_backup', db_url=None, arrow=False, cube=None):
+    """
+    Batch version of 'generate_report': gets the stats of every combination of period, country and client. The data
+    of all of them is extracted, merged and cleaned once, every period is split by country and every country by client
+    with a single groupby, instead of filtering the data once per report.
+
+    :param periods: (list) periods of the reports, as pairs (start date, end date) (see 'generate_report').
+    :param countries: (list) countries of the reports. A None country takes the entire database of leads. None to
+    get only that report.
+    :param clients: (list) clients of the reports. A None client omits this filter. None to get only that report.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sql_joins: (bool) flag to run the table merges in the database.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param cube: (DailyCube) pre-aggregated report data. The stats are calculated from it, without reading the database,
+    if it can answer every period (see 'DailyCube.can_answer'). None to omit it.
+    :return: (dict) stats of every report, as returned by 'get_stats', by (start date, end date, country, client).
+    """
+
+    countries = countries if countries is not None else [None]
+    clients = clients if clients is not None else [None]
+
+    combinations = list(itertools.product(periods, countries, clients))
+
+    if (cube is not None) and all([cube.can_answer(start_date=start_date, end_date=end_date)
+                                   for start_date, end_date in periods]):
+        return {(start_date, end_date, country, client): cube.get_stats(start_date=start_date, end_date=end_date,
+                                                                         country=country, client=client)
+                for (start_date, end_date), country, client in combinations}
+
+    # Filters of the union of the reports
+    start_dates = [start_date for start_date, end_date in periods]
+    end_dates = [end_date for start_date, end_date in periods]
+
+    filters = get_filter_spec(start_date=None if None in start_dates else min(start_dates),
+                              end_date=None if None in end_dates else max(end_dates),
+                              country=countries[0] if len(countries) == 1 else None,
+                              client=clients[0] if len(clients) == 1 else None)
+
+    data = get_data(report_type='database_dashboard', filters=filters, max_workers=max_workers,
+                    snapshot_path=snapshot_path, sql_joins=sql_joins, db_name=db_name, db_url=db_url,
+                    required_columns=get_required_columns(), arrow=arrow)
+
+    # Cleaning works row by row, so the data of every report is cleaned at once
+    cleaned_data = clean_pipeline(data[0])
+
+    report_stats = dict()
+
+    for start_date, end_date in periods:
+        period_data = filter_leads_creation_date(lead_dataset=cleaned_data, start_date=start_date, end_date=end_date)
+
+        for country, country_data in _split_by(data=period_data, column='name', values=countries).items():
+            for client, client_data in _split_by(data=country_data, column='given_to', values=clients).items():
+                report_stats[(start_date, end_date, country, client)] = get_stats(data=[client_data, data[1]])
+
+    return report_stats
+
+
+def _split_by(data: pd.DataFrame, column: str, values: list):
+    """
+    Splits a dataset by the values of a column with a single groupby, as 'filter_pipeline' filters it by one value.
+
+    :param data: (pd.DataFrame) dataset to split.
+    :param column: (str) column to split the dataset by.
+    :param values: (list) values to keep. None to keep the whole dataset.
+    :return: (dict) rows of every value. Values without rows get an empty dataset.
+    """
+
+    groups = dict()
+    if any([value is not None for value in values]):
+        groups = dict(list(data.groupby(column, observed=True, sort=False)))
+
+    return {value: data if value is None else groups.get(value, data.iloc[0:0]) for value in values}
+
+
+def get_checkpoint(checkpoint_path: str, start_date, end_date, country: str, client: str, db_name='local_backup',
+                   db_url=None, arrow=False):
+    """
+    Gets the checkpoints of a monthly report run, keyed by its parameters, the database it reads and the
+    'report_config.json' and 'report_metrics.json' configuration files.
+
+    :param checkpoint_path: (str) folder where the checkpoints are stored.
+    :param start_date: (datetime) minimum (earlier) date in which leads were created.
+    :param end_date: (datetime) maximum (closest) date in which leads were created.
+    :param country: (str) country where leads were created.
+    :param client: (str) client to which the leads have been sent.
+    :param db_name: (str) entry of the credentials file with the database the run reads.
+    :param db_url: (str) SQLAlchemy URL of the database the run reads. None if it connects with the credentials file.
+    :param arrow: (bool) flag of the runs that fetch the data as Arrow record batches (their tables have other dtypes).
+    :return: (CheckpointStore) checkpoints of the run.
+    """
+
+    return CheckpointStore(checkpoint_path=checkpoint_path, report_type='monthly_report',
+                           params={'start_date': start_date, 'end_date': end_date, 'country': country,
+                                   'client': client, 'db_name': db_name, 'db_url': db_url, 'arrow': arrow},
+                           config_files=[os.path.join(DatabaseSession.config_path, DatabaseSession.db_config_file),
+                                         os.path.join(MetricRegistry.config_path, MetricRegistry.metrics_config_file)])
+
+
+@profiler.profile()
+def get_report_data(start_date, end_date, country: str, client: str, max_workers=1, snapshot_path=None,
+                    sql_joins=False, sorted_merges=False, chunksize=None, db_name='local_backup', db_url=None,
+                    arrow=False, checkpoint=None, query_report=None):
     """
     Executes the data collection pipeline to get all the required data to generate the 'Database monthly report' with
     all the lead data collected and generated within the month and year received as parameter.
@@ -29,10 +203,44 @@ def get_report_data(start_date, end_date, country: str, client: str):
     :param end_date: (datetime) maximum (closest) date in which leads were created. None to take the entire database.
     :param country: (str) country where leads were created. None to take the entire database of leads.
     :param client: (str) client to which the leads have been sent. None to omit this filter.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sql_joins: (bool) flag to run the table merges in the database.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param chunksize: (int) number of rows read, filtered and cleaned at a time. None to read the whole data at once.
+    Chunked reads always run the table merges in the database.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param checkpoint: (CheckpointStore) checkpoints of the extracted tables and merged trees. None to omit them.
+    :param query_report: (str) JSON file with the stats of every table load. None to omit it.
     :return: (pd.DataFrame) dataset with the clean data generated within the month and year received as parameter.
     """
 
-    data = get_data(report_type='database_dashboard')
+    filters = get_filter_spec(start_date=start_date, end_date=end_date, country=country, client=client)
+    required_columns = get_required_columns()
+
+    if chunksize is not None:
+        data = get_data_chunks(report_type='database_dashboard', filters=filters, chunksize=chunksize,
+                               db_name=db_name, db_url=db_url, required_columns=required_columns)
+
+        # 1) PERSONAL DATA
+        # Chunks are filtered and cleaned as they arrive, so only the selected rows are kept in memory
+        cleaned_data = pd.concat([clean_pipeline(filter_pipeline(data=chunk, start_date=start_date, end_date=end_date,
+                                                                 country=country, client=client))
+                                  for chunk in data[0]], ignore_index=True)
+
+        # 2) PRIVACY POLICY DATA
+        # Only the privacy choices of the selected leads are used by the report
+        user_ids = cleaned_data['id'].unique()
+        privacy_data = pd.concat([chunk[chunk['id'].isin(user_ids)] for chunk in data[1]], ignore_index=True)
+
+        return [cleaned_data, privacy_data]
+
+    data = get_data(report_type='database_dashboard', filters=filters, max_workers=max_workers,
+                    snapshot_path=snapshot_path, sql_joins=sql_joins, sorted_merges=sorted_merges, db_name=db_name,
+                    db_url=db_url, required_columns=required_columns, arrow=arrow, checkpoint=checkpoint,
+                    query_report=query_report)
 
     # 1) PERSONAL DATA
     # Filter the data
@@ -46,351 +254,274 @@ def get_report_data(start_date, end_date, country: str, client: str):
     return [cleaned_data, data[1]]
 
 
-def get_stats(data: list):
+def get_required_columns():
     """
-    Generates all the stats and gets aggregated data to compose the 'Database monthly report'.
-    It works by creating a dictionary of pairs key-value for each of these topics:
-        1. Total volume of users.
-        2. Connectivity and user participation.
-        3. User typology.
-        4. Count of leads delivered.
-        5. Users by age.
-    In the end, all of the partial dictionaries are stacked together and will contribute to the generation of the final
-    report.
+    Gets the merged columns consumed by the whole report, from the columns declared by each step in
+    'CONSUMED_COLUMNS'.
 
-    :param data: (list) datasets with the clean data that will be used to generate the report.
-    :return: (list) datasets containing the calculated metrics.
+    :return: (list) [personal data columns, privacy policy data columns].
     """
 
-    result = []
+    required_columns = [list(), list()]
 
-    # 1) Personal data
-    if not data[0].empty:
-        connectivity_results = _get_connectivity_stats(data[0])
-        typology_results = _get_typology_stats(data[0])
-        delivery_results_list = _get_deliveries_stats(data[0])
-        recurrence_results = _get_recurrence_stats(data[0])
-        age_results = _get_age_stats(data[0])
-        privacy_results = _get_privacy_stats(personal_data=data[0], privacy_data=data[1])
+    for step_columns in CONSUMED_COLUMNS.values():
+        for dataset_columns, columns in zip(required_columns, step_columns):
+            dataset_columns.extend([name for name in columns if name not in dataset_columns])
 
-        result = [connectivity_results, typology_results, delivery_results_list, recurrence_results, age_results,
-                  privacy_results]
+    return required_columns
 
-    return result
 
-
-def _get_connectivity_stats(data: pd.DataFrame):
+@profiler.profile()
+def get_partitioned_stats(start_date, end_date, country: str, client: str, partitions: int, max_processes=None,
+                          max_workers=1, snapshot_path=None, sql_joins=False, sorted_merges=False,
+                          db_name='local_backup', db_url=None, arrow=False, checkpoint=None):
     """
-    Gets all required connectivity stats from the given data.
+    Parallel version of 'get_report_data' + 'get_stats'. The extracted tables are hash-partitioned by user id and each
+    shard is merged, filtered, cleaned and summarized in a process pool. Shards hold disjoint sets of users, so their
+    stats are combined by 'combine_stats'.
 
-    :param data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dict) connectivity stats.
+    :param start_date: (datetime) minimum (earlier) date in which leads were created. None to take the entire database.
+    :param end_date: (datetime) maximum (closest) date in which leads were created. None to take the entire database.
+    :param country: (str) country where leads were created. None to take the entire database of leads.
+    :param client: (str) client to which the leads have been sent. None to omit this filter.
+    :param partitions: (int) number of shards.
+    :param max_processes: (int) maximum number of shards processed in parallel. None to use one process per core.
+    :param max_workers: (int) maximum number of database tables loaded in parallel.
+    :param snapshot_path: (str) folder with the local snapshots of the database tables. None to omit them.
+    :param sql_joins: (bool) flag to run the table merges in the database. Not supported by partitioned reports.
+    :param sorted_merges: (bool) flag to load the tables ordered by their merge keys and merge them on sorted indexes.
+    :param db_name: (str) entry of the credentials file with the database to connect to (server or local replica).
+    :param db_url: (str) SQLAlchemy URL of the database. None to connect with the credentials file.
+    :param arrow: (bool) flag to fetch the data as Arrow record batches into pyarrow-backed DataFrames.
+    :param checkpoint: (CheckpointStore) checkpoints of the extracted tables. None to omit them.
+    :return: (list) datasets containing the calculated metrics, as returned by 'get_stats'.
     """
 
-    # Group 1: connectivity and participation
-    group1_metrics = ['number_users',
-                      'null_id',
-                      'share_data_with_sponsors',
-                      'dont_share_data_with_sponsors',
-                      'null_share_data',
-                      'robinson',
-                      'null_robinson',
-                      'allow_notifications',
-                      'null_allow_notifications',
-                      'verified_email',
-                      'not_verified_email',
-                      'null_verified_email',
-                      'null_valued_leads']
+    filters = get_filter_spec(start_date=start_date, end_date=end_date, country=country, client=client)
+    shard_function = functools.partial(_get_shard_stats, start_date=start_date, end_date=end_date, country=country,
+                                       client=client)
 
-    # Creating dictionary from keys
-    group1_dict = dict.fromkeys(group1_metrics, None)
+    shard_stats = get_data(report_type='database_dashboard', filters=filters, max_workers=max_workers,
+                           snapshot_path=snapshot_path, sql_joins=sql_joins, sorted_merges=sorted_merges,
+                           db_name=db_name, db_url=db_url, required_columns=get_required_columns(), arrow=arrow,
+                           partitions=partitions, max_processes=max_processes, shard_function=shard_function,
+                           checkpoint=checkpoint)
 
-    # Filling the dictionary with values
-    group1_dict['number_users'] = data['id'].nunique()
+    return combine_stats(shard_stats=shard_stats)
 
-    group1_data = data.loc[:, ['id', 'shareMyData', 'robinson', 'emailSubscribed', 'emailConfirmed']].drop_duplicates(
-        subset=['id'])
 
-    group1_dict['null_id'] = group1_data['id'].isna().sum()
-    group1_dict['share_data_with_sponsors'] = group1_data['shareMyData'].value_counts().reindex([1], fill_value=0)[1]
-    group1_dict['dont_share_data_with_sponsors'] = group1_data['shareMyData'].value_counts().reindex([0], fill_value=0)[0]
-    group1_dict['null_share_data'] = group1_data['shareMyData'].isna().sum()
-    group1_dict['robinson'] = group1_data['robinson'].value_counts().reindex([1], fill_value=0)[1]
-    group1_dict['null_robinson'] = group1_data['robinson'].isna().sum()
-    group1_dict['allow_notifications'] = group1_data['emailSubscribed'].value_counts().reindex([1], fill_value=0)[1]
-    group1_dict['null_allow_notifications'] = group1_data['emailSubscribed'].isna().sum()
-    group1_dict['verified_email'] = group1_data['emailConfirmed'].value_counts().reindex([1], fill_value=0)[1]
-    group1_dict['not_verified_email'] = group1_data['emailConfirmed'].value_counts().reindex([0], fill_value=0)[0]
-    group1_dict['null_verified_email'] = group1_data['emailConfirmed'].isna().sum()
+def _get_shard_stats(data: list, start_date, end_date, country: str, client: str):
+    """
+    Runs the report pipeline over the merged tables of one shard.
 
-    null_valued_leads = set()
-    for column in group1_data.columns:
-        null_valued_leads.update(group1_data[group1_data[column].isnull()].id.tolist())
+    :param data: (list) merged personal and privacy policy data of the shard.
+    :param start_date: (datetime) minimum (earlier) date in which leads were created.
+    :param end_date: (datetime) maximum (closest) date in which leads were created.
+    :param country: (str) country where leads were created. None to take the entire database of leads.
+    :param client: (str) client to which the leads have been sent. None to omit this filter.
+    :return: (list) stats of the shard, as returned by 'get_stats'.
+    """
 
-    group1_dict['null_valued_leads'] = len(null_valued_leads)
+    filtered_data = filter_pipeline(data=data[0], start_date=start_date, end_date=end_date, country=country,
+                                    client=client)
+    cleaned_data = clean_pipeline(filtered_data)
 
-    return group1_dict
+    return get_stats(data=[cleaned_data, data[1]])
 
 
-def _get_typology_stats(data: pd.DataFrame):
+def combine_stats(shard_stats: list):
     """
-    Gets user typology metrics.
+    Combines the stats of shards with disjoint sets of users: user counts are added, the per-user tables are stacked
+    and the tables derived from them are recalculated.
 
-    :param data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dataframe) dataframe containing the whole set of metrics related with user typology.
+    :param shard_stats: (list) stats of every shard, as returned by 'get_stats'.
+    :return: (list) stats of the whole data, as returned by 'get_stats'.
     """
 
-    group2_data = data.loc[:, ['id', 'telephone', 'emailConfirmed', 'telephoneConfirmed', 'facebook_id',
-                               'twitter_id', 'given_to', 'age', 'gender']].drop_duplicates(subset=['id'])
-
-    # Conditions
-    verified_email = group2_data['emailConfirmed'] == 1
-    verified_phone = group2_data['telephoneConfirmed'] == 1
-    facebook_user = group2_data['facebook_id'].notna()
-    twitter_user = group2_data['twitter_id'].notna()
-    form_user = (group2_data['facebook_id'].isna()) & (group2_data['twitter_id'].isna())
-    phone_included = group2_data['telephone'].notna()
-    delivered = group2_data['given_to'].notna()
-    age_enough = group2_data['age'] >= 30
-    man = group2_data['gender'] == 'male'
-    woman = group2_data['gender'] == 'female'
-
-    # Group 2: user typology
-    group2_metrics = {'DELIVERABLE_LEADS': phone_included & age_enough,
-                      'deliverable_leads_men': phone_included & age_enough & man,
-                      'deliverable_leads_women': phone_included & age_enough & woman,
-                      'deliverable_leads_without_gender': phone_included & age_enough & ~(man | woman),
-                      'VERIFIED_MAIL_VERIFIED_PHONE': verified_email & verified_phone,
-                      'verified_mail_verified_phone_facebook': verified_email & verified_phone & facebook_user,
-                      'verified_mail_verified_phone_twitter': verified_email & verified_phone & twitter_user,
-                      'verified_mail_verified_phone_form': verified_email & verified_phone & form_user,
-                      'VERIFIED_PHONE': ~verified_email & verified_phone,
-                      'verified_phone_facebook': ~verified_email & verified_phone & facebook_user,
-                      'verified_phone_twitter': ~verified_email & verified_phone & twitter_user,
-                      'verified_phone_form': ~verified_email & verified_phone & form_user,
-                      'VERIFIED_MAIL_INCLUDED_PHONE': verified_email & ~verified_phone & phone_included,
-                      'verified_mail_included_phone_facebook': verified_email & ~verified_phone & phone_included & facebook_user,
-                      'verified_mail_included_phone_twitter': verified_email & ~verified_phone & phone_included & twitter_user,
-                      'verified_mail_included_phone_form': verified_email & ~verified_phone & phone_included & form_user,
-                      'VERIFIED_MAIL_MISSING_PHONE': verified_email & ~verified_phone & ~phone_included,
-                      'verified_mail_missing_phone_facebook': verified_email & ~verified_phone & ~phone_included & facebook_user,
-                      'verified_mail_missing_phone_twitter': verified_email & ~verified_phone & ~phone_included & twitter_user,
-                      'verified_mail_missing_phone_form': verified_email & ~verified_phone & ~phone_included & form_user,
-                      'INCLUDED_PHONE': ~verified_email & ~verified_phone & phone_included,
-                      'included_phone_facebook': ~verified_email & ~verified_phone & phone_included & facebook_user,
-                      'included_phone_twitter': ~verified_email & ~verified_phone & phone_included & twitter_user,
-                      'included_phone_form': ~verified_email & ~verified_phone & phone_included & form_user,
-                      'MISSING_PHONE': ~verified_email & ~verified_phone & ~phone_included,
-                      'missing_phone_facebook': ~verified_email & ~verified_phone & ~phone_included & facebook_user,
-                      'missing_phone_twitter': ~verified_email & ~verified_phone & ~phone_included & twitter_user,
-                      'missing_phone_form': ~verified_email & ~verified_phone & ~phone_included & form_user,
-                      'null_email_confirmed': None,
-                      'null_telephone_confirmed': None,
-                      'null_valued_leads': None
-                      }
+    shard_stats = [stats for stats in shard_stats if len(stats) > 0]
 
-    # Creating dictionary from keys
-    group2_dict = dict.fromkeys(group2_metrics.keys(), [0, 0])
+    if len(shard_stats) == 0:
+        return []
 
-    # Creating dataframe from dictionary
-    group2_df = pd.DataFrame.from_dict(group2_dict, orient='index',
-                                       columns=['total', 'delivered'])
+    connectivity_results, typology_results, delivery_results_lists, recurrence_results, age_results, \
+        privacy_results = zip(*shard_stats)
 
-    for key in group2_metrics.keys():
-        if group2_metrics[key] is not None:
-            group2_df.loc[key, 'total'] = group2_data[group2_metrics[key]].shape[0]
-            group2_df.loc[key, 'delivered'] = group2_data[delivered & group2_metrics[key]].shape[0]
+    times_delivered_df = pd.concat([delivery_results[1] for delivery_results in delivery_results_lists],
+                                   ignore_index=True)
+    times_delivered_df = times_delivered_df.sort_values('times_delivered', ascending=False, kind='mergesort',
+                                                        ignore_index=True)
 
-    group2_df['undelivered'] = group2_df['total'] - group2_df['delivered']
+    leads_by_ong_df = pd.concat([delivery_results[3] for delivery_results in delivery_results_lists],
+                                ignore_index=True).groupby('ong_name', sort=False, observed=True)['leads_volume'].sum()
+    leads_by_ong_df = leads_by_ong_df.sort_values(ascending=False, kind='mergesort').reset_index()
 
-    group2_df.loc['null_email_confirmed', 'total'] = group2_data['emailConfirmed'].isna().sum()
-    group2_df.loc['null_telephone_confirmed', 'total'] = group2_data['telephoneConfirmed'].isna().sum()
+    delivery_results_list = [_add_dicts([delivery_results[0] for delivery_results in delivery_results_lists]),
+                             times_delivered_df,
+                             get_leads_by_times_delivered(times_delivered_df=times_delivered_df),
+                             leads_by_ong_df]
 
-    null_valued_leads = set()
-    for column in ['emailConfirmed', 'telephoneConfirmed']:
-        null_valued_leads.update(group2_data[group2_data[column].isnull()].id.tolist())
+    return [_add_dicts(connectivity_results), _add_dataframes(typology_results), delivery_results_list,
+            _add_dicts(recurrence_results), _add_dicts(age_results), _add_dataframes(privacy_results)]
 
-    group2_df.loc['null_valued_leads', 'total'] = len(null_valued_leads)
 
-    return group2_df
+def _add_dicts(dictionaries: list):
+    return {key: sum([dictionary[key] for dictionary in dictionaries]) for key in dictionaries[0].keys()}
 
 
-def _get_deliveries_stats(data: pd.DataFrame):
-    """
-    Gets all required deliveries stats from the given data.
+def _add_dataframes(dataframes: list):
+    return functools.reduce(lambda left, right: left.add(right, fill_value=0), dataframes)
 
-    :param data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dataframe) dataframe containing the whole set of metrics related with deliveries.
+
+@profiler.profile()
+def get_stats(data: list):
     """
+    Generates all the stats and gets aggregated data to compose the 'Database monthly report'.
+    It works by creating a dictionary of pairs key-value for each of these topics:
+        1. Total volume of users.
+        2. Connectivity and user participation.
+        3. User typology.
+        4. Count of leads delivered.
+        5. Users by age.
+    In the end, all of the partial dictionaries are stacked together and will contribute to the generation of the final
+    report.
 
-    # Group 3: leads delivered
-    group3_metrics = ['delivered_leads',
-                      'undelivered_leads']
+    The personal data is reduced once to a table of users and a table of deliveries (see 'get_user_facts'), which
+    every topic reads instead of the merged rows. The per-user metrics (connectivity, typology, recurrence, age and
+    privacy policies) are declared in the 'report_metrics.json' configuration file and calculated in a single pass (see
+    'MetricRegistry').
 
-    # Creating dictionary from keys
-    group3_dict = dict.fromkeys(group3_metrics, None)
+    :param data: (list) datasets with the clean data that will be used to generate the report.
+    :return: (list) datasets containing the calculated metrics.
+    """
 
-    group3_data = data.loc[:, ['id', 'given_to']]
+    result = []
 
-    undelivered = group3_data['given_to'].isna()
+    # 1) Personal data
+    if not data[0].empty:
+        user_facts, delivery_facts = get_user_facts(data[0])
+        user_facts = get_privacy_facts(user_facts=user_facts, privacy_data=data[1])
 
-    group3_dict['delivered_leads'] = group3_data.drop_duplicates(subset=['id'], keep='first').loc[~undelivered].shape[0]
-    group3_dict['undelivered_leads'] = group3_data.drop_duplicates(subset=['id'], keep='first').loc[
-        undelivered].shape[0]
+        metric_results = get_metric_registry().compute(user_facts)
+        delivery_results_list = _get_deliveries_stats(user_facts=user_facts, delivery_facts=delivery_facts)
 
-    # Volume of leads by times delivered
-    #   Leads with nan have not been delivered
-    times_delivered_df = group3_data.dropna()['id'].value_counts().reset_index()
-    times_delivered_df.columns = ['user_id', 'times_delivered']
-    leads_by_times_delivered_df = times_delivered_df.set_index(keys='user_id', drop=True).value_counts().sort_index().\
-        reset_index()
-    leads_by_times_delivered_df.columns = ['times_delivered', 'leads_volume']
-    # volume_delivered.add_prefix('delivered_to_').add_suffix('_ONGs')
+        result = [metric_results['connectivity'], metric_results['typology'], delivery_results_list,
+                  metric_results['recurrence'], metric_results['age'], metric_results['privacy']]
 
-    # Volume of leads delivered by ONG
-    leads_by_ong_df = group3_data['given_to'].value_counts().reset_index()
-    leads_by_ong_df.columns = ['ong_name', 'leads_volume']
-
-    return [group3_dict, times_delivered_df, leads_by_times_delivered_df, leads_by_ong_df]
+    return result
 
 
-def _get_recurrence_stats(data: pd.DataFrame):
+def get_user_facts(data: pd.DataFrame):
     """
-    Gets all required recurrence stats from the given data.
+    Reduces the personal data, which has one row per user and delivery, to:
+        - A user table: one row per user with its 'USER_COLUMNS' (taken from its first row), its number of deliveries
+        ('deliveries'), the dates of its two latest deliveries ('last_given_at' and 'previous_given_at') and the days
+        between them, for the users with a profile ('recurrence_days').
+        - A delivery table: the 'DELIVERY_COLUMNS' of the delivered rows.
 
     :param data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dict) dictionary containing the whole set of metrics related with user recurrence.
+    :return: (tuple) user table and delivery table.
     """
 
-    # Group 4: recurrence of users (time between deliveries)
-    group4_metrics = ['one_month',
-                      'one_to_three_months',
-                      'six_months',
-                      'one_year',
-                      'two_years',
-                      'more_than_two_years']
+    user_facts = data.loc[:, USER_COLUMNS].drop_duplicates(subset=['id'])
+    delivery_facts = data.loc[data['given_to'].notna(), DELIVERY_COLUMNS]
 
-    # Creating dictionary from keys
-    group4_dict = dict.fromkeys(group4_metrics, None)
+    user_facts = user_facts.join(get_latest_deliveries(delivery_facts), on='id')
+    user_facts['deliveries'] = user_facts['deliveries'].fillna(0).astype(int)
+    user_facts['recurrence_days'] = user_facts['recurrence_days'].where(user_facts['user_id'].notna())
 
-    # Tidy data attending to:
-    #   1) It only has delivered registers.
-    #   2) Lead deliveries are sorted by date in descending order.
-    #   3) We only keep a maximum of two deliveries for each lead.
-    group4_data = data[data.given_to.notnull()].loc[:, ['user_id', 'given_to', 'given_at']]. \
-        sort_values(by=['user_id', 'given_at'], ascending=[True, False]). \
-        groupby('user_id').head(2)
+    return user_facts, delivery_facts
 
-    # Getting difference (in months) between the two latest deliveries
-    group4_data['diff_days'] = group4_data.groupby('user_id')['given_at'].diff(periods=-1)
-    group4_data.dropna(subset=['diff_days'], inplace=True)
 
-    group4_data['diff_days'] = group4_data['diff_days'].dt.days
+def get_latest_deliveries(delivery_facts: pd.DataFrame):
+    """
+    :param delivery_facts: (pd.DataFrame) delivery table (see 'get_user_facts').
+    :return: (pd.DataFrame) number of deliveries ('deliveries'), dates of the two latest deliveries ('last_given_at'
+    and 'previous_given_at') and days between them ('recurrence_days') of every delivered user, indexed by user id.
+    """
 
-    one_month = group4_data['diff_days'] <= 30
-    one_to_three_months = group4_data['diff_days'].between(31, 3 * 30)
-    six_months = group4_data['diff_days'].between((3 * 30) + 1, 6 * 30)
-    one_year = group4_data['diff_days'].between((6 * 30) + 1, 365)
-    two_years = group4_data['diff_days'].between(366, 2 * 365)
-    more_than_two_years = group4_data['diff_days'] > (2 * 365) + 1
+    # Deliveries of every user, latest first
+    deliveries = delivery_facts.loc[delivery_facts['id'].notna(), ['id', 'given_at']].sort_values(
+        by=['id', 'given_at'], ascending=[True, False])
+    delivery_order = deliveries.groupby('id').cumcount()
 
-    group4_dict['one_month'] = group4_data.loc[one_month].shape[0]
-    group4_dict['one_to_three_months'] = group4_data.loc[one_to_three_months].shape[0]
-    group4_dict['six_months'] = group4_data.loc[six_months].shape[0]
-    group4_dict['one_year'] = group4_data.loc[one_year].shape[0]
-    group4_dict['two_years'] = group4_data.loc[two_years].shape[0]
-    group4_dict['more_than_two_years'] = group4_data.loc[more_than_two_years].shape[0]
+    latest_deliveries = pd.DataFrame({'deliveries': deliveries['id'].value_counts()})
+    latest_deliveries['last_given_at'] = deliveries.loc[delivery_order == 0].set_index('id')['given_at']
+    latest_deliveries['previous_given_at'] = deliveries.loc[delivery_order == 1].set_index('id')['given_at']
+    latest_deliveries['recurrence_days'] = (latest_deliveries['last_given_at'] -
+                                            latest_deliveries['previous_given_at']).dt.days
 
-    return group4_dict
+    return latest_deliveries
 
 
-def _get_age_stats(data: pd.DataFrame):
+def get_privacy_facts(user_facts: pd.DataFrame, privacy_data: pd.DataFrame):
     """
-    Gets all required age stats from the given data.
-
-    :param data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dict) dictionary containing the whole set of metrics related with age.
+    Adds the privacy policy choices of every user to the user table: whether the user is in the privacy policy data
+    ('privacy_policies'), whether the Osoigo policy was displayed to the user, so it is a non-sponsored user
+    ('osoigo_policy_displayed'), and whether the user accepted any privacy policy ('privacy_policy_accepted').
+    The privacy policy data is the users table left-joined with their choices, so 'privacy_policies' holds for every
+    user it was loaded for, whether or not the user made any choice.
+
+    :param user_facts: (pd.DataFrame) user table (see 'get_user_facts').
+    :param privacy_data: (pd.DataFrame) dataset with the privacy policy choices of the users.
+    :return: (pd.DataFrame) user table with the privacy policy columns.
     """
 
-    # Group 5: birthday analysis
-    group5_metrics = ['without_age',
-                      'with_age',
-                      'less_than_25',
-                      'from_25_to_29',
-                      'from_30_to_39',
-                      'from_40_to_49',
-                      'from_50_to_59',
-                      'more_than_59']
-
-    # Creating dictionary from keys
-    group5_dict = dict.fromkeys(group5_metrics, None)
-
-    group5_data = data.loc[:, ['id', 'age']].drop_duplicates(subset=['id'])
+    privacy_data = privacy_data.loc[:, ['id', 'privacy_policies_checkbox_id', 'checked']]
 
-    less_than_25 = group5_data['age'] < 25
-    from_25_to_29 = group5_data['age'].between(25, 29)
-    from_30_to_39 = group5_data['age'].between(30, 39)
-    from_40_to_49 = group5_data['age'].between(40, 49)
-    from_50_to_59 = group5_data['age'].between(50, 59)
-    more_than_59 = group5_data['age'] > 59
+    osoigo_policy_displayed = (privacy_data['privacy_policies_checkbox_id'] == 1).fillna(False)
+    privacy_policy_accepted = (privacy_data['checked'] == 1).fillna(False)
 
-    group5_dict['without_age'] = group5_data['age'].isna().sum()
-    group5_dict['with_age'] = group5_data['age'].notna().sum()
-    group5_dict['less_than_25'] = group5_data.loc[less_than_25].shape[0]
-    group5_dict['from_25_to_29'] = group5_data.loc[from_25_to_29].shape[0]
-    group5_dict['from_30_to_39'] = group5_data.loc[from_30_to_39].shape[0]
-    group5_dict['from_40_to_49'] = group5_data.loc[from_40_to_49].shape[0]
-    group5_dict['from_50_to_59'] = group5_data.loc[from_50_to_59].shape[0]
-    group5_dict['more_than_59'] = group5_data.loc[more_than_59].shape[0]
+    user_facts['privacy_policies'] = user_facts['id'].isin(privacy_data['id'])
+    user_facts['osoigo_policy_displayed'] = user_facts['id'].isin(privacy_data.loc[osoigo_policy_displayed, 'id'])
+    user_facts['privacy_policy_accepted'] = user_facts['id'].isin(privacy_data.loc[privacy_policy_accepted, 'id'])
 
-    return group5_dict
+    return user_facts
 
 
-def _get_privacy_stats(personal_data: pd.DataFrame, privacy_data: pd.DataFrame):
+def _get_deliveries_stats(user_facts: pd.DataFrame, delivery_facts: pd.DataFrame):
     """
-    Gets all required privacy policy stats from the given data.
+    Gets all required deliveries stats from the given data.
 
-    :param personal_data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :param privacy_data: (pd.DataFrame) dataset with the clean data that will be used to generate the report.
-    :return: (dict) (dataframe) dataframe containing the whole set of metrics related with privacy policy terms.
+    :param user_facts: (pd.DataFrame) user table (see 'get_user_facts').
+    :param delivery_facts: (pd.DataFrame) delivery table (see 'get_user_facts').
+    :return: (dataframe) dataframe containing the whole set of metrics related with deliveries.
     """
 
-    group3_data = personal_data.loc[:, ['id', 'given_to']].drop_duplicates(subset=['id'])
-    group6_data = privacy_data.loc[:, ['id', 'privacy_policies_checkbox_id', 'checked']]
+    # Group 3: leads delivered
+    group3_metrics = ['delivered_leads',
+                      'undelivered_leads']
+
+    # Creating dictionary from keys
+    group3_dict = dict.fromkeys(group3_metrics, None)
 
-    # Get from group6 data, those leads from the selected time period (those included in group3 data)
-    group6_data = group6_data.loc[group6_data['id'].isin(group3_data.id.to_list())]
+    undelivered = user_facts['given_to'].isna()
 
-    # Conditions
-    osoigo_policy_displayed = group6_data['privacy_policies_checkbox_id'] == 1
-    privacy_policy_accepted = group6_data['checked'] == 1
-    privacy_policy_rejected = ~group6_data.id.isin(list(set(group6_data[privacy_policy_accepted]['id'])))
-    id_non_sponsored_users = list(set(group6_data[osoigo_policy_displayed]['id']))
-    non_sponsored_users = group6_data.id.isin(id_non_sponsored_users)
+    group3_dict['delivered_leads'] = (~undelivered).sum()
+    group3_dict['undelivered_leads'] = undelivered.sum()
 
-    id_delivered = list(set(group3_data.loc[group3_data['given_to'].notna()]['id']))
-    delivered = group6_data.id.isin(id_delivered)
+    # Volume of leads by times delivered
+    #   Leads with nan have not been delivered
+    times_delivered_df = delivery_facts['id'].dropna().value_counts().reset_index()
+    times_delivered_df.columns = ['user_id', 'times_delivered']
+    leads_by_times_delivered_df = get_leads_by_times_delivered(times_delivered_df=times_delivered_df)
+    # volume_delivered.add_prefix('delivered_to_').add_suffix('_ONGs')
 
-    # Group 6: privacy policy analysis
-    group6_metrics = {'SPONSORED USERS': ~non_sponsored_users,
-                      'sponsored_users_ACCEPTED_ANY_privacy_policy': ~non_sponsored_users & privacy_policy_accepted,
-                      'sponsored_users_REJECTED_ALL_privacy_policy': ~non_sponsored_users & privacy_policy_rejected,
-                      'NON-SPONSORED_USERS': non_sponsored_users,
-                      'non-sponsored_users_ACCEPTED_ANY_privacy_policy': non_sponsored_users & privacy_policy_accepted,
-                      'non-sponsored_users_REJECTED_ALL_privacy_policy': non_sponsored_users & privacy_policy_rejected}
+    # Volume of leads delivered by ONG
+    #   Clients are stored as categories: those without leads in the selection are not listed
+    leads_by_ong_df = delivery_facts['given_to'].value_counts().loc[lambda counts: counts > 0].reset_index()
+    leads_by_ong_df.columns = ['ong_name', 'leads_volume']
 
-    # Creating dictionary from keys
-    group6_dict = dict.fromkeys(group6_metrics.keys(), [0, 0])
+    return [group3_dict, times_delivered_df, leads_by_times_delivered_df, leads_by_ong_df]
 
-    # Creating dataframe from dictionary
-    group6_df = pd.DataFrame.from_dict(group6_dict, orient='index',
-                                       columns=['total', 'delivered'])
 
-    for key in group6_metrics.keys():
-        if group6_metrics[key] is not None:
-            group6_df.loc[key, 'total'] = group6_data[group6_metrics[key]].drop_duplicates(['id']).shape[0]
-            group6_df.loc[key, 'delivered'] = group6_data[delivered & group6_metrics[key]].drop_duplicates(['id']).shape[0]
+def get_leads_by_times_delivered(times_delivered_df: pd.DataFrame):
+    """
+    :param times_delivered_df: (pd.DataFrame) times each lead has been delivered ('user_id', 'times_delivered').
+    :return: (pd.DataFrame) volume of leads by times delivered ('times_delivered', 'leads_volume').
+    """
 
-    group6_df['undelivered'] = group6_df['total'] - group6_df['delivered']
+    leads_by_times_delivered_df = times_delivered_df.set_index(keys='user_id', drop=True).value_counts().sort_index().\
+        reset_index()
+    leads_by_times_delivered_df.columns = ['times_delivered', 'leads_volume']
 
-    return group6_df
+    return leads_by_times_delivered_df
@@ -0,0 +1,153 @@
+import click
+import sys
+import datetime
+
+sys.path.append(r'C:\Users\borja\PycharmProjects\osoigo_ia')
+
+from reports.monthly_reports.controllers.cube_controller import DailyCube, refresh_cube
+from reports.monthly_reports.controllers.report_controller import generate_batch_reports
+from reports.monthly_reports.controllers.excel_controller import to_excel
+from reports.utils.profiler import profiler
+
+
+@click.command()
+@click.option('--period', '-p',
+              multiple=True,
+              required=True,
+              help='period (yyyy-mm-dd:yyyy-mm-dd format, end not included) for which you want to obtain the stats. '
+                   'It can be repeated')
+@click.option('--country', '-c',
+              multiple=True,
+              help='country name for which you want to obtain the stats, or "all". It can be repeated (all by default)')
+@click.option('--ong', '-o',
+              multiple=True,
+              help='client name for which you want to obtain the stats, or "all". It can be repeated (all by default)')
+@click.option('--workers', '-w',
+              default=1,
+              required=False,
+              type=click.IntRange(min=1),
+              help='maximum number of database tables loaded in parallel')
+@click.option('--snapshots',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder where local snapshots of the database tables are kept and incrementally refreshed')
+@click.option('--sql-joins',
+              is_flag=True,
+              default=False,
+              help='run the table merges in the database instead of in memory')
+@click.option('--arrow',
+              is_flag=True,
+              default=False,
+              help='fetch the database tables as Arrow record batches into pyarrow-backed columns')
+@click.option('--cube',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder with the pre-aggregated daily cube the stats are calculated from (refreshed if it is '
+                   'missing or older than the periods)')
+@click.option('--db',
+              default='local_backup',
+              required=False,
+              help='entry of the database credentials file to connect to (MariaDB server or SQLite/DuckDB replica)')
+@click.option('--profile',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON file where the time, rows and memory of every stage of the run are written')
+def command_line_interface(period: tuple, country: tuple, ong: tuple, workers: int, snapshots: str, sql_joins: bool,
+                           arrow: bool, cube: str, db: str, profile: str):
+    """
+    Command line user interface used to generate the monthly reports of every combination of periods, countries and
+    clients at once. The database is read once for all of them and one workbook is written per report.
+
+    :param period: (tuple) periods of the reports, as 'start date:end date'.
+        :example: -p 2021-01-01:2021-02-01 -p 2021-02-01:2021-03-01 --> two monthly periods
+    :param country: (tuple) countries of the reports. 'all' (or none) to consider every country.
+        :example: -c España -c México --> country = (España, México)
+        :example:                     --> country = (all)
+    :param ong: (tuple) ONG names of the reports. 'all' (or none) to consider every client.
+        :example: -o acnur -o all --> ong = (acnur, all)
+        :example:                 --> ong = (all)
+    :param workers: (int) maximum number of database tables loaded in parallel.
+        :example: -w 4      --> workers = 4
+        :example:           --> workers = 1
+    :param snapshots: (string) folder with the local snapshots of the database tables. None to omit them.
+        :example: --snapshots ./snapshots --> snapshots = ./snapshots
+        :example:                         --> snapshots = None
+    :param sql_joins: (bool) flag to run the table merges in the database.
+        :example: --sql-joins --> sql_joins = True
+        :example:             --> sql_joins = False
+    :param arrow: (bool) flag to fetch the database tables as Arrow record batches.
+        :example: --arrow --> arrow = True
+        :example:         --> arrow = False
+    :param cube: (string) folder with the daily cube (see 'monthly_cli'). It is refreshed if it is missing, out of date
+    or it was last refreshed before the end of any period. None to omit it.
+        :example: --cube ./cube --> cube = ./cube
+        :example:               --> cube = None
+    :param db: (string) entry of the database credentials file to connect to.
+        :example: --db local_sqlite --> db = local_sqlite
+        :example:                   --> db = local_backup
+    :param profile: (string) JSON trace file with the cost of every stage of the run. None to omit profiling.
+        :example: --profile trace.json --> profile = trace.json
+        :example:                      --> profile = None
+    :return: void
+    """
+
+    if profile is not None:
+        profiler.enable()
+
+    with profiler.stage('monthly_batch_report'):
+        periods, countries, clients = _format_params(periods=period, countries=country, clients=ong)
+
+        daily_cube = None
+        if cube is not None:
+            daily_cube = DailyCube(cube_path=cube)
+
+            if not daily_cube.is_refreshed_until(end_date=max([end_date for start_date, end_date in periods])):
+                refresh_cube(cube=daily_cube, max_workers=workers, snapshot_path=snapshots, db_name=db, arrow=arrow)
+
+        report_stats = generate_batch_reports(periods=periods, countries=countries, clients=clients,
+                                              max_workers=workers, snapshot_path=snapshots, sql_joins=sql_joins,
+                                              db_name=db, arrow=arrow, cube=daily_cube)
+
+        for (start, end, country_name, client), data in report_stats.items():
+            to_excel(start_date=start, end_date=end, country=country_name, client=client, data=data)
+
+    if profile is not None:
+        profiler.print_summary()
+        profiler.write(profile)
+        profiler.disable()
+
+
+def _format_params(periods: tuple, countries: tuple, clients: tuple):
+    """
+    It takes the periods, countries and clients selected by the user and transforms them as 'monthly_cli' does:
+    - Periods: they are split into start and end dates.
+    - 'all' values and unfilled lists: they are set to None.
+
+    :param periods: (tuple) periods, as 'start date:end date'.
+    :param countries: (tuple) country names.
+    :param clients: (tuple) client names.
+    :return: (3x list) formatted periods, countries and clients.
+    """
+
+    formatted_periods = list()
+
+    for value in periods:
+        try:
+            start_date, end_date = [datetime.datetime.strptime(date, '%Y-%m-%d') for date in value.split(':')]
+        except ValueError:
+            raise click.BadParameter("'{0}' is not a 'yyyy-mm-dd:yyyy-mm-dd' period".format(value),
+                                     param_hint='--period')
+
+        formatted_periods.append((start_date, end_date))
+
+    countries = [None if country.lower() == 'all' else country.title() for country in countries] or [None]
+    clients = [None if client.lower() == 'all' else client.lower() for client in clients] or [None]
+
+    return formatted_periods, list(dict.fromkeys(countries)), list(dict.fromkeys(clients))
+
+
+if __name__ == '__main__':
+    command_line_interface()
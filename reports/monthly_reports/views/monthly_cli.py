@@ -4,8 +4,10 @@ import datetime
 
 sys.path.append(r'C:\Users\borja\PycharmProjects\osoigo_ia')
 
-from reports.monthly_reports.controllers.report_controller import generate_report
+from reports.monthly_reports.controllers.cube_controller import DailyCube, refresh_cube
+from reports.monthly_reports.controllers.report_controller import generate_report, get_checkpoint
 from reports.monthly_reports.controllers.excel_controller import to_excel
+from reports.utils.profiler import profiler
 
 current_date = datetime.datetime.now()
 
@@ -29,7 +31,81 @@ current_date = datetime.datetime.now()
               default=None,
               required=False,
               help='client name for which you want to obtain the stats')
-def command_line_interface(start: datetime, end: datetime, country: str, ong: str):
+@click.option('--workers', '-w',
+              default=1,
+              required=False,
+              type=click.IntRange(min=1),
+              help='maximum number of database tables loaded in parallel')
+@click.option('--snapshots',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder where local snapshots of the database tables are kept and incrementally refreshed')
+@click.option('--sql-joins',
+              is_flag=True,
+              default=False,
+              help='run the table merges in the database instead of in memory')
+@click.option('--sorted-merges',
+              is_flag=True,
+              default=False,
+              help='load the database tables ordered by their merge keys and merge them on sorted indexes')
+@click.option('--chunksize',
+              default=None,
+              required=False,
+              type=click.IntRange(min=1),
+              help='number of rows read, filtered and cleaned at a time (merges are run in the database)')
+@click.option('--arrow',
+              is_flag=True,
+              default=False,
+              help='fetch the database tables as Arrow record batches into pyarrow-backed columns')
+@click.option('--partitions', '-p',
+              default=1,
+              required=False,
+              type=click.IntRange(min=1),
+              help='number of shards, by user id, merged and summarized in parallel processes')
+@click.option('--processes',
+              default=None,
+              required=False,
+              type=click.IntRange(min=1),
+              help='maximum number of shards processed in parallel (one per core by default)')
+@click.option('--checkpoints',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder where the output of every stage is kept, so a failed run resumes from its last stage')
+@click.option('--query-report',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON file where the SQL, timings, bytes, rows and EXPLAIN output of every table load are written')
+@click.option('--cube',
+              default=None,
+              required=False,
+              type=click.Path(file_okay=False),
+              help='folder with the pre-aggregated daily cube the stats are calculated from (built if it is missing)')
+@click.option('--refresh-cube', 'refresh',
+              is_flag=True,
+              default=False,
+              help='refresh the daily cube with the users created since --refresh-since before the report')
+@click.option('--refresh-since',
+              default=None,
+              required=False,
+              type=click.DateTime(),
+              help='creation date (yyyy-mm-dd format) from which the daily cube is refreshed (90 days before the '
+                   'last refresh by default)')
+@click.option('--db',
+              default='local_backup',
+              required=False,
+              help='entry of the database credentials file to connect to (MariaDB server or SQLite/DuckDB replica)')
+@click.option('--profile',
+              default=None,
+              required=False,
+              type=click.Path(dir_okay=False),
+              help='JSON file where the time, rows and memory of every stage of the run are written')
+def command_line_interface(start: datetime, end: datetime, country: str, ong: str, workers: int, snapshots: str,
+                           sql_joins: bool, sorted_merges: bool, chunksize: int, arrow: bool, partitions: int,
+                           processes: int, checkpoints: str, query_report: str, cube: str, refresh: bool,
+                           refresh_since: datetime, db: str, profile: str):
     """
     Command line user interface developed used to interact with the monthly report script stack.
 
@@ -43,15 +119,93 @@ def command_line_interface(start: datetime, end: datetime, country: str, ong: st
     :param ong: (string) ONG name for which the data will be obtained. None to consider every client.
         :example: -o acnur  --> ong = acnur
         :example:           --> ong = None
+    :param workers: (int) maximum number of database tables loaded in parallel.
+        :example: -w 4      --> workers = 4
+        :example:           --> workers = 1
+    :param snapshots: (string) folder with the local snapshots of the database tables. None to omit them.
+        :example: --snapshots ./snapshots --> snapshots = ./snapshots
+        :example:                         --> snapshots = None
+    :param sql_joins: (bool) flag to run the table merges in the database.
+        :example: --sql-joins --> sql_joins = True
+        :example:             --> sql_joins = False
+    :param sorted_merges: (bool) flag to merge the tables on sorted indexes.
+        :example: --sorted-merges --> sorted_merges = True
+        :example:                 --> sorted_merges = False
+    :param chunksize: (int) number of rows read, filtered and cleaned at a time. None to read the whole data at once.
+        :example: --chunksize 100000 --> chunksize = 100000
+        :example:                    --> chunksize = None
+    :param arrow: (bool) flag to fetch the database tables as Arrow record batches.
+        :example: --arrow --> arrow = True
+        :example:         --> arrow = False
+    :param partitions: (int) number of shards processed in parallel processes. 1 to run the report in one process.
+        :example: -p 8      --> partitions = 8
+        :example:           --> partitions = 1
+    :param processes: (int) maximum number of shards processed in parallel. None to use one process per core.
+        :example: --processes 4 --> processes = 4
+        :example:               --> processes = None
+    :param checkpoints: (string) folder with the checkpoints of the run. They are removed once the run succeeds. None to
+    omit them.
+        :example: --checkpoints ./checkpoints --> checkpoints = ./checkpoints
+        :example:                             --> checkpoints = None
+    :param query_report: (string) JSON run report with the stats of every table load. None to omit it.
+        :example: --query-report queries.json --> query_report = queries.json
+        :example:                             --> query_report = None
+    :param cube: (string) folder with the daily cube. The report is calculated from it, if it can answer its dates.
+    None to omit it.
+        :example: --cube ./cube --> cube = ./cube
+        :example:               --> cube = None
+    :param refresh: (bool) flag to refresh the daily cube before the report. It is always refreshed if it is missing,
+    out of date or it was last refreshed before the end date.
+        :example: --refresh-cube --> refresh = True
+        :example:                --> refresh = False
+    :param refresh_since: (datetime) creation date from which the daily cube is refreshed. None to refresh it from 90
+    days before its last refresh.
+        :example: --refresh-since 2021-01-01 --> refresh_since = 2021-01-01
+        :example:                            --> refresh_since = None
+    :param db: (string) entry of the database credentials file to connect to.
+        :example: --db local_sqlite --> db = local_sqlite
+        :example:                   --> db = local_backup
+    :param profile: (string) JSON trace file with the cost of every stage of the run. None to omit profiling.
+        :example: --profile trace.json --> profile = trace.json
+        :example:                      --> profile = None
     :return: void
     """
 
-    start, end, country, client = _format_params(start_date=start, end_date=end, country=country, client=ong)
+    if profile is not None:
+        profiler.enable()
+
+    with profiler.stage('monthly_report'):
+        start, end, country, client = _format_params(start_date=start, end_date=end, country=country, client=ong)
+
+        checkpoint = None
+        if checkpoints is not None:
+            checkpoint = get_checkpoint(checkpoint_path=checkpoints, start_date=start, end_date=end, country=country,
+                                        client=client, db_name=db, arrow=arrow)
+
+        daily_cube = None
+        if cube is not None:
+            daily_cube = DailyCube(cube_path=cube)
+
+            if refresh or not daily_cube.is_refreshed_until(end_date=end):
+                refresh_cube(cube=daily_cube, since=refresh_since, max_workers=workers, snapshot_path=snapshots,
+                             db_name=db, arrow=arrow)
+
+        # Getting raw data from the database
+        data = generate_report(start_date=start, end_date=end, country=country, client=client, max_workers=workers,
+                               snapshot_path=snapshots, sql_joins=sql_joins, sorted_merges=sorted_merges,
+                               chunksize=chunksize, db_name=db, arrow=arrow, partitions=partitions,
+                               max_processes=processes, checkpoint=checkpoint, query_report=query_report,
+                               cube=daily_cube)
+
+        to_excel(start_date=start, end_date=end, country=country, client=ong, data=data)
 
-    # Getting raw data from the database
-    data = generate_report(start_date=start, end_date=end, country=country, client=client)
+        if checkpoint is not None:
+            checkpoint.clear()
 
-    to_excel(start_date=start, end_date=end, country=country, client=ong, data=data)
+    if profile is not None:
+        profiler.print_summary()
+        profiler.write(profile)
+        profiler.disable()
 
 
 def _format_params(start_date: datetime, end_date: datetime, country: str, client: str):
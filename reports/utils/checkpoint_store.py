@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+
+
+class CheckpointStore:
+    """
+    Local cache of the output of every stage of a report run (extracted tables, merged trees, cleaned data, stats...),
+    so a failed run can be resumed from its last successful stage instead of going back to the database:
+        [checkpoint_path]/[report type]_[key]/[stage].pickle
+
+    The key is a hash of the report type, the content of the configuration files and the report parameters, so a
+    checkpoint is never reused by a run with other parameters or after the configuration changes. The database content
+    is not part of the key: checkpoints must be cleared (see 'clear') once the run they belong to succeeds.
+    """
+
+    # default constructor
+    def __init__(self, checkpoint_path: str, report_type: str, params: dict, config_files: list = None):
+        self.report_type = report_type
+        self.key = get_checkpoint_key(report_type=report_type, params=params, config_files=config_files)
+        self.path = os.path.join(checkpoint_path, '{0}_{1}'.format(report_type, self.key))
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_file(self, stage: str):
+        """
+        :param stage: (str) stage name.
+        :return: (str) checkpoint file path of the stage.
+        """
+
+        return os.path.join(self.path, stage + '.pickle')
+
+    def load(self, stage: str):
+        """
+        Reads the output of a stage.
+
+        :param stage: (str) stage name.
+        :return: (object) stage output. None if the stage has no checkpoint.
+        """
+
+        file = self.get_file(stage)
+
+        if not os.path.exists(file):
+            return None
+
+        print('checkpoint={0} stage={1} resumed'.format(self.path, stage))
+
+        return pd.read_pickle(file)
+
+    def save(self, stage: str, data):
+        """
+        Stores the output of a stage replacing the previous one.
+
+        :param stage: (str) stage name.
+        :param data: (object) stage output (any picklable object: DataFrames, lists and dictionaries of them, etc.).
+        :return: void
+        """
+
+        file = self.get_file(stage)
+
+        # Written aside and then moved, so a failed run never leaves a truncated checkpoint behind
+        pd.to_pickle(data, file + '.tmp')
+        os.replace(file + '.tmp', file)
+
+    def clear(self):
+        """
+        Removes every checkpoint of the run.
+
+        :return: void
+        """
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def run_stage(store: CheckpointStore, stage: str, function, **kwargs):
+    """
+    Runs a stage of a report, unless it has a checkpoint, and stores its output.
+
+    :param store: (CheckpointStore) checkpoints of the run. None to always run the stage. It is not named 'checkpoint',
+    so the stage function can also receive the checkpoints of the run in 'kwargs'.
+    :param stage: (str) stage name.
+    :param function: (function) function that runs the stage.
+    :param kwargs: arguments of the function.
+    :return: (object) stage output.
+    """
+
+    if store is None:
+        return function(**kwargs)
+
+    data = store.load(stage)
+
+    if data is None:
+        data = function(**kwargs)
+        store.save(stage, data)
+
+    return data
+
+
+def get_checkpoint_key(report_type: str, params: dict, config_files: list = None):
+    """
+    :param report_type: (str) report type.
+    :param params: (dict) report parameters. Values are hashed through their string representation.
+    :param config_files: (list) configuration files the report output depends on. None to omit them.
+    :return: (str) checkpoint key.
+    """
+
+    key_hash = hashlib.md5(report_type.encode('utf-8'))
+    key_hash.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+
+    for file in config_files or list():
+        with open(file, 'rb') as config_file:
+            key_hash.update(config_file.read())
+
+    return key_hash.hexdigest()[:12]
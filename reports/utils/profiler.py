@@ -0,0 +1,254 @@
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+
+class Profiler:
+    """
+    Records the cost of every stage of a report run: wall time, CPU time, rows in/out and peak memory.
+
+    Stages are opened with the 'stage' context manager or the 'profile' decorator and can be nested (e.g. every table
+    load inside 'get_data'). Nothing is recorded until the profiler is enabled, so the instrumentation can stay in the
+    code at no cost:
+        profiler.enable()
+        with profiler.stage('filter_pipeline', rows_in=data.shape[0]) as record:
+            data = filter_pipeline(data)
+            record['rows_out'] = data.shape[0]
+        profiler.write('trace.json')
+
+    Peak memory is the highest memory traced by 'tracemalloc' (Python and numpy allocations) while the stage is open.
+    Peak RSS is the highest resident memory of the whole process so far, so it also counts the memory not traced by
+    'tracemalloc' (e.g. database drivers and Arrow buffers). CPU time is the CPU time of the whole process. Peak memory
+    and CPU time include the stages run simultaneously in other threads (e.g. parallel table loads), so they are
+    approximate for those stages.
+    """
+
+    # default constructor
+    def __init__(self):
+        self.enabled = False
+        self.records = list()
+
+        self._start = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        """
+        Starts recording stages and tracing memory allocations.
+
+        :return: void
+        """
+
+        self.enabled = True
+        self.records = list()
+        self._start = time.perf_counter()
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        """
+        Stops recording stages and tracing memory allocations.
+
+        :return: void
+        """
+
+        self.enabled = False
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name: str, **attributes):
+        """
+        Context manager that records a stage. The record it yields can be completed inside the block (e.g. with the
+        'rows_out' key).
+
+        :param name: (str) stage name.
+        :param attributes: extra keys stored in the stage record (e.g. rows_in=100, table='users').
+        :return: (context manager) yields the stage record (dict).
+        """
+
+        return _Stage(profiler=self, name=name, attributes=attributes)
+
+    def profile(self, name: str = None):
+        """
+        Decorator that records every call of a function as a stage. Rows in are counted from the first DataFrame (or
+        list of DataFrames) argument and rows out from the returned value.
+
+        :param name: (str) stage name. None to use the function name.
+        :return: (function) decorator.
+        """
+
+        def decorator(function):
+            stage_name = name if name is not None else function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+
+                rows_in = None
+                for argument in list(args) + list(kwargs.values()):
+                    rows_in = count_rows(argument)
+                    if rows_in is not None:
+                        break
+
+                with self.stage(stage_name, rows_in=rows_in) as record:
+                    result = function(*args, **kwargs)
+                    record['rows_out'] = count_rows(result)
+
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def write(self, file: str):
+        """
+        Stores the recorded stages in a JSON trace file.
+
+        :param file: (str) trace file path.
+        :return: void
+        """
+
+        with open(file, 'w', encoding='utf-8') as trace_file:
+            json.dump({'peak_rss_mb': get_peak_rss_mb(), 'stages': self.records}, trace_file, indent=2, default=str)
+
+    def print_summary(self):
+        """
+        Prints one line per recorded stage, indented by nesting level.
+
+        :return: void
+        """
+
+        for record in sorted(self.records, key=lambda stage_record: stage_record['start']):
+            print('{0}stage={1} wall={2:.3f}s cpu={3:.3f}s rows_in={4} rows_out={5} peak_memory={6:.1f}MB'.format(
+                '  ' * record['depth'], record['name'], record['wall_seconds'], record['cpu_seconds'],
+                record['rows_in'], record['rows_out'], record['peak_memory_mb']))
+
+        peak_rss = get_peak_rss_mb()
+        print('peak_rss={0}'.format('{0:.1f}MB'.format(peak_rss) if peak_rss is not None else 'unknown'))
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+
+        return self._local.stack
+
+
+class _Stage:
+    """
+    Context manager returned by 'Profiler.stage'.
+    """
+
+    # default constructor
+    def __init__(self, profiler: Profiler, name: str, attributes: dict):
+        self.profiler = profiler
+        self.record = {'name': name, 'rows_in': None, 'rows_out': None}
+        self.record.update(attributes)
+
+        self._wall_start = None
+        self._cpu_start = None
+        self._peak = 0
+
+    def __enter__(self):
+        if not self.profiler.enabled:
+            return self.record
+
+        stack = self.profiler._get_stack()
+
+        # The traced peak is reset for this stage, so the peak reached so far is kept by the enclosing stages first
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            for stage in stack:
+                stage._peak = max(stage._peak, peak)
+            tracemalloc.reset_peak()
+
+        self.record['parent'] = stack[-1].record['name'] if len(stack) > 0 else None
+        self.record['depth'] = len(stack)
+        stack.append(self)
+
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._wall_start is None:
+            return False
+
+        self.record['start'] = self._wall_start - self.profiler._start
+        self.record['wall_seconds'] = time.perf_counter() - self._wall_start
+        self.record['cpu_seconds'] = time.process_time() - self._cpu_start
+
+        stack = self.profiler._get_stack()
+        stack.remove(self)
+
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            self._peak = max(self._peak, peak)
+            for stage in stack:
+                stage._peak = max(stage._peak, self._peak)
+
+        self.record['peak_memory_mb'] = self._peak / 2 ** 20
+        self.record['peak_rss_mb'] = get_peak_rss_mb()
+        self.record['failed'] = exc_type is not None
+
+        with self.profiler._lock:
+            self.profiler.records.append(self.record)
+
+        return False
+
+
+def count_rows(data):
+    """
+    Counts the rows of a DataFrame or of a list of DataFrames.
+
+    :param data: (object) any value.
+    :return: (int) number of rows. None if the value is not a DataFrame or a list of DataFrames.
+    """
+
+    if isinstance(data, pd.DataFrame):
+        return data.shape[0]
+
+    if isinstance(data, (list, tuple)):
+        rows = [count_rows(item) for item in data]
+        rows = [row_count for row_count in rows if row_count is not None]
+
+        return sum(rows) if len(rows) > 0 else None
+
+    return None
+
+
+def get_peak_rss_mb():
+    """
+    Gets the peak resident set size (RSS) of the process, from the 'resource' module on Unix or from the optional
+    'psutil' package on Windows.
+
+    :return: (float) peak RSS in MB. None if it cannot be read.
+    """
+
+    try:
+        import resource
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Linux reports it in KB and macOS in bytes
+        return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    except (ImportError, AttributeError):
+        return None
+
+
+# Profiler shared by the whole application. It is disabled until a run asks for profiling (e.g. '--profile' flag)
+profiler = Profiler()
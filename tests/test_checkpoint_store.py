@@ -0,0 +1,63 @@
+import datetime
+import pandas as pd
+import pytest
+
+from reports.benchmark.dataset_generator import generate_dataset
+from reports.lead_report.controllers import lead_report_controller as lead_report
+from reports.monthly_reports.controllers import report_controller as monthly_report
+from reports.utils.checkpoint_store import CheckpointStore, run_stage
+
+START_DATE = datetime.datetime(2021, 1, 1)
+END_DATE = datetime.datetime(2021, 2, 1)
+
+
+@pytest.fixture(scope='module')
+def db_url(tmp_path_factory):
+    database = tmp_path_factory.mktemp('database') / 'reports.sqlite'
+    generate_dataset(file=str(database), users=500)
+
+    return 'sqlite:///' + str(database)
+
+
+def test_run_stage_passes_checkpoint_to_the_stage(tmp_path):
+    store = CheckpointStore(checkpoint_path=str(tmp_path), report_type='test', params={})
+    calls = list()
+
+    def stage(value, checkpoint=None):
+        calls.append(checkpoint)
+        return value
+
+    assert run_stage(None, 'stage', stage, value=1, checkpoint=None) == 1
+    assert run_stage(store, 'stage', stage, value=2, checkpoint=store) == 2
+    assert run_stage(store, 'stage', stage, value=3, checkpoint=store) == 2
+    assert calls == [None, store]
+
+
+def test_monthly_report_with_and_without_checkpoints(db_url, tmp_path):
+    stats = monthly_report.generate_report(start_date=START_DATE, end_date=END_DATE, country=None, client=None,
+                                           db_url=db_url)
+
+    checkpoint = monthly_report.get_checkpoint(checkpoint_path=str(tmp_path), start_date=START_DATE,
+                                               end_date=END_DATE, country=None, client=None, db_url=db_url)
+
+    for run in range(2):
+        checkpoint_stats = monthly_report.generate_report(start_date=START_DATE, end_date=END_DATE, country=None,
+                                                          client=None, db_url=db_url, checkpoint=checkpoint)
+
+        assert checkpoint.load('stats') is not None
+        assert checkpoint_stats[0] == stats[0]
+        pd.testing.assert_frame_equal(checkpoint_stats[1], stats[1])
+
+
+def test_lead_report_with_and_without_checkpoints(db_url, tmp_path):
+    leads_report, clients_config = lead_report.generate_report(clients=['msf'], db_url=db_url)
+
+    checkpoint = lead_report.get_checkpoint(checkpoint_path=str(tmp_path), clients=['msf'], db_url=db_url)
+
+    for run in range(2):
+        checkpoint_report, checkpoint_config = lead_report.generate_report(clients=['msf'], db_url=db_url,
+                                                                           checkpoint=checkpoint)
+
+        assert checkpoint.load('leads') is not None
+        assert len(checkpoint_report) == len(leads_report)
+        assert len(checkpoint_config) == len(clients_config)
@@ -0,0 +1,57 @@
+import datetime
+import sqlite3
+import pandas as pd
+
+from reports.benchmark.dataset_generator import generate_dataset
+from reports.data_extraction.database.controllers.database_controller import get_data
+from reports.data_extraction.database.utils.snapshot_store import SnapshotStore
+
+
+def _sorted(dataframe: pd.DataFrame):
+    # Snapshot rows come before the new ones, so tables are compared regardless of their row order
+    dataframe = dataframe.astype(str)
+
+    return dataframe.sort_values(list(dataframe.columns)).reset_index(drop=True)
+
+
+def test_read_returns_python_watermarks(tmp_path):
+    store = SnapshotStore(snapshot_path=str(tmp_path))
+    columns = ['id', 'given_at']
+    dataframe = pd.DataFrame({'id': [1, 2, 3],
+                              'given_at': pd.to_datetime(['2021-01-01', '2021-01-02', None])})
+
+    store.write(table_name='user_given_to', columns=columns, dataframe=dataframe, full_read=True)
+
+    snapshot, last_value = store.read(table_name='user_given_to', columns=columns, watermark='id')
+    assert type(last_value) is int
+    assert last_value == 3
+
+    snapshot, last_value = store.read(table_name='user_given_to', columns=columns, watermark='given_at')
+    assert type(last_value) is datetime.datetime
+    assert last_value == datetime.datetime(2021, 1, 2)
+
+    # Rows sharing the last watermark and rows without watermark are read again from the database
+    assert snapshot['id'].tolist() == [1]
+
+
+def test_incremental_load_matches_full_load(tmp_path):
+    database = tmp_path / 'reports.sqlite'
+    generate_dataset(file=str(database), users=300)
+    db_url = 'sqlite:///' + str(database)
+    snapshot_path = str(tmp_path / 'snapshots')
+
+    get_data(report_type='database_dashboard', snapshot_path=snapshot_path, db_url=db_url)
+
+    with sqlite3.connect(str(database)) as connexion:
+        connexion.execute("INSERT INTO users (id, created_at, first_name, last_name, email) "
+                          "VALUES (301, '2022-01-01 10:00:00', 'ana', 'lopez', 'user301@example.com')")
+        connexion.executemany("INSERT INTO user_given_to (user_id, given_to, given_at) VALUES (?, ?, ?)",
+                              [(301, 'msf', '2022-01-02 10:00:00'), (1, 'acnur', None)])
+
+    # The second run reads the new rows from the last watermark on, the third one only the rows without watermark
+    for run in range(2):
+        incremental_data = get_data(report_type='database_dashboard', snapshot_path=snapshot_path, db_url=db_url)
+        full_data = get_data(report_type='database_dashboard', db_url=db_url)
+
+        for incremental_table, full_table in zip(incremental_data, full_data):
+            pd.testing.assert_frame_equal(_sorted(incremental_table), _sorted(full_table))